@@ -4,18 +4,30 @@ Telegram-бот для получения уведомлений о запися
 Уведомления приходят автоматически с сайта при каждой новой записи.
 Слоты добавляются вручную в файл content/bookings/available-slots.json
 """
+import atexit
+import bisect
+import copy
+import errno
+import functools
 import json
 import os
+import queue
 import re
 import hmac
 import hashlib
+import html
 import secrets
+import shutil
 import sqlite3
 import subprocess
 import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
 from datetime import date, datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
-from typing import Dict, Literal, Optional
+from typing import Any, Callable, Dict, Literal, Optional
 
 # Загрузка .env из корня проекта
 try:
@@ -25,28 +37,240 @@ try:
 except ImportError:
     pass
 
+# orjson заметно быстрее stdlib json; без него работаем через json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+import requests
 import telebot
-from telebot import types
+from telebot import apihelper, types
 
 BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 if not BOT_TOKEN:
     raise ValueError("Задайте переменную окружения TELEGRAM_BOT_TOKEN")
 
-bot = telebot.TeleBot(BOT_TOKEN)
-def _parse_admin_chat_ids() -> set[str]:
+
+# Сколько обработчиков может работать одновременно (разные чаты не ждут друг друга)
+BOT_NUM_THREADS = int(os.environ.get("TELEGRAM_BOT_THREADS") or 8)
+
+# Лимиты Telegram на исходящие сообщения: (токенов в секунду, запас на короткий всплеск).
+# Держимся под ними сами, чтобы не ловить 429 и повторные отправки.
+SEND_RATE_GLOBAL = (30.0, 30)
+SEND_RATE_PRIVATE_CHAT = (1.0, 3)
+SEND_RATE_GROUP_CHAT = (20 / 60, 5)
+# Раз в столько секунд SendThrottle забывает вёдра чатов, которые успели наполниться
+SEND_THROTTLE_SWEEP_INTERVAL = 60.0
+
+
+class _TokenBucket:
+    """
+    Ведро токенов: rate токенов в секунду, не больше capacity про запас.
+    """
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def is_full(self, now: float) -> bool:
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+    def reserve(self, now: float) -> float:
+        """
+        Забирает токен (в долг, если их нет) и возвращает, сколько секунд подождать до отправки.
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class SendThrottle:
+    """
+    Выравнивает исходящие сообщения по общему лимиту бота и по лимиту каждого чата.
+    Поток, которому не хватило токена, просто спит нужное время перед отправкой.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._global = _TokenBucket(*SEND_RATE_GLOBAL)
+        self._chats: Dict[str, _TokenBucket] = {}
+        self._next_sweep = time.monotonic() + SEND_THROTTLE_SWEEP_INTERVAL
+
+    def wait(self, chat_id) -> None:
+        key = str(chat_id)
+        with self._lock:
+            now = time.monotonic()
+            if now >= self._next_sweep:
+                # Полное ведро ничем не отличается от нового — хранить его незачем
+                self._chats = {k: b for k, b in self._chats.items() if not b.is_full(now)}
+                self._next_sweep = now + SEND_THROTTLE_SWEEP_INTERVAL
+            bucket = self._chats.get(key)
+            if bucket is None:
+                # У групп и каналов id отрицательный
+                rate = SEND_RATE_GROUP_CHAT if key.startswith("-") else SEND_RATE_PRIVATE_CHAT
+                bucket = self._chats[key] = _TokenBucket(*rate)
+            delay = max(self._global.reserve(now), bucket.reserve(now))
+        if delay > 0:
+            time.sleep(delay)
+
+
+_send_throttle = SendThrottle()
+
+
+class _SiteTeleBot(telebot.TeleBot):
+    """
+    TeleBot бота сайта.
+    После каждой пачки апдейтов сохраняет last_update_id на диск,
+    чтобы после перезапуска не обрабатывать те же апдейты повторно.
+    Всё, что бот отправляет в чаты, проходит через SendThrottle.
+    Обработчики выполняются в пуле потоков, но апдейты одного чата — строго по очереди:
+    диалоги (ChatCtx) рассчитаны на последовательные шаги. Очередь у каждого чата своя,
+    и в пул попадает только её голова — долгий обработчик одного чата не занимает
+    чужие потоки пула ожиданием своей очереди.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # chat_id -> ожидающие задачи; ключ есть, пока у чата что-то выполняется
+        self._chat_queues: Dict[int, deque] = {}
+        self._chat_queues_guard = threading.Lock()
+
+    def _exec_task(self, task, *args, **kwargs):
+        # Message — сам апдейт, у CallbackQuery чат лежит в .message
+        first = args[0] if args else None
+        chat = getattr(getattr(first, "message", first), "chat", None)
+        chat_id = getattr(chat, "id", None)
+        if chat_id is None:
+            return super()._exec_task(task, *args, **kwargs)
+
+        with self._chat_queues_guard:
+            pending = self._chat_queues.get(chat_id)
+            if pending is not None:
+                pending.append((task, args, kwargs))
+                return None
+            self._chat_queues[chat_id] = deque()
+        return super()._exec_task(self._run_chat_task, chat_id, task, args, kwargs)
+
+    def _run_chat_task(self, chat_id: int, task, args, kwargs):
+        try:
+            return task(*args, **kwargs)
+        finally:
+            # Следующая задача чата уходит в пул только после завершения текущей
+            with self._chat_queues_guard:
+                pending = self._chat_queues[chat_id]
+                nxt = pending.popleft() if pending else None
+                if nxt is None:
+                    del self._chat_queues[chat_id]
+            if nxt is not None:
+                super()._exec_task(self._run_chat_task, chat_id, *nxt)
+
+    def process_new_updates(self, updates):
+        super().process_new_updates(updates)
+        if updates:
+            _save_update_offset(self.last_update_id)
+
+    # Всё, что пишет в чат, проходит через SendThrottle (reply_to вызывает send_message)
+    def send_message(self, chat_id, *args, **kwargs):
+        _send_throttle.wait(chat_id)
+        return super().send_message(chat_id, *args, **kwargs)
+
+    def send_photo(self, chat_id, *args, **kwargs):
+        _send_throttle.wait(chat_id)
+        return super().send_photo(chat_id, *args, **kwargs)
+
+    def send_audio(self, chat_id, *args, **kwargs):
+        _send_throttle.wait(chat_id)
+        return super().send_audio(chat_id, *args, **kwargs)
+
+    def send_video(self, chat_id, *args, **kwargs):
+        _send_throttle.wait(chat_id)
+        return super().send_video(chat_id, *args, **kwargs)
+
+    def send_document(self, chat_id, *args, **kwargs):
+        _send_throttle.wait(chat_id)
+        return super().send_document(chat_id, *args, **kwargs)
+
+    def edit_message_text(self, text, chat_id=None, *args, **kwargs):
+        if chat_id is not None:
+            _send_throttle.wait(chat_id)
+        return super().edit_message_text(text, chat_id, *args, **kwargs)
+
+
+bot = _SiteTeleBot(BOT_TOKEN, num_threads=BOT_NUM_THREADS)
+
+# Обработчики inline‑кнопок: префикс callback_data (до первого ':') -> функция.
+# Вместо десятков фильтров startswith(...) на каждый callback — один поиск в dict.
+_CALLBACK_HANDLERS: Dict[str, Callable[[types.CallbackQuery], None]] = {}
+
+
+def on_callback(*keys: str):
+    """
+    Регистрирует обработчик inline‑кнопок для одного или нескольких префиксов callback_data.
+    """
+    def decorator(func):
+        for key in keys:
+            _CALLBACK_HANDLERS[key] = func
+        return func
+    return decorator
+
+
+@bot.callback_query_handler(func=lambda c: True)
+def dispatch_callback(call: types.CallbackQuery):
+    handler = _CALLBACK_HANDLERS.get((call.data or "").partition(":")[0])
+    if handler is None:
+        # Неизвестная кнопка — просто убираем «часики»
+        bot.answer_callback_query(call.id)
+        return
+    handler(call)
+
+
+# Обработчики кнопок reply‑клавиатуры: текст кнопки -> функция.
+# Один фильтр на все кнопки вместо отдельного func=lambda у каждого обработчика.
+_BUTTON_HANDLERS: Dict[str, Callable[[types.Message], None]] = {}
+
+
+def on_button(*texts: str):
+    """
+    Регистрирует обработчик для одной или нескольких кнопок reply‑клавиатуры.
+    """
+    def decorator(func):
+        for text in texts:
+            _BUTTON_HANDLERS[text] = func
+        return func
+    return decorator
+
+
+# Регистрируется раньше handle_text: нажатая кнопка важнее текущего шага диалога
+@bot.message_handler(func=lambda m: m.text in _BUTTON_HANDLERS)
+def dispatch_button(message: types.Message):
+    _BUTTON_HANDLERS[message.text](message)
+
+
+def _parse_admin_chat_ids() -> frozenset[int]:
     many_raw = (os.environ.get("TELEGRAM_ADMIN_CHAT_IDS") or "").strip()
     single_raw = (os.environ.get("TELEGRAM_ADMIN_CHAT_ID") or "").strip()
-    values: set[str] = set()
+    values: set[int] = set()
 
     for chunk in [many_raw, single_raw]:
         if not chunk:
             continue
         for item in chunk.split(","):
             normalized = item.strip()
-            if normalized:
-                values.add(normalized)
+            if not normalized:
+                continue
+            # chat.id в апдейтах — int (у групп отрицательный): храним в том же виде,
+            # чтобы проверка прав не переводила id в строку на каждом сообщении
+            try:
+                values.add(int(normalized))
+            except ValueError:
+                print(f"Пропускаю некорректный id администратора: {normalized!r}")
 
-    return values
+    return frozenset(values)
 
 
 ADMIN_CHAT_IDS = _parse_admin_chat_ids()
@@ -59,6 +283,7 @@ PAGE_SIZE_POSTS = 5
 PUBLIC_DIR = BASE_DIR / "public"
 PACKAGES_FILE = BASE_DIR / "content" / "yoga" / "packages.json"
 VIDEOS_DIR = BASE_DIR / "public" / "videos"
+NOTGALLERY_DIR = BASE_DIR / "public" / "notgallery"  # превью, которые не должны попадать в галерею
 PAGE_SIZE_PKGS = 5
 ADMIN_TOKEN_DB_PATH = Path(
     (os.environ.get("ADMIN_TOKEN_DB_PATH") or str(BASE_DIR / "data" / "admin-auth.sqlite")).strip()
@@ -66,6 +291,78 @@ ADMIN_TOKEN_DB_PATH = Path(
 ADMIN_TOKEN_HASH_SECRET = (os.environ.get("ADMIN_TOKEN_HASH_SECRET") or "").strip()
 ADMIN_TOKEN_TTL_SECONDS = 4 * 60 * 60
 
+# Webhook вместо long polling: если задан TELEGRAM_WEBHOOK_URL (публичный https‑адрес,
+# который прокси на сервере переадресует на WEBHOOK_LISTEN:WEBHOOK_PORT), Telegram сам
+# присылает апдейты. Без него бот работает через getUpdates, как раньше.
+WEBHOOK_URL = (os.environ.get("TELEGRAM_WEBHOOK_URL") or "").strip()
+WEBHOOK_LISTEN = (os.environ.get("TELEGRAM_WEBHOOK_LISTEN") or "127.0.0.1").strip()
+WEBHOOK_PORT = int(os.environ.get("TELEGRAM_WEBHOOK_PORT") or 8443)
+# Telegram присылает секрет в заголовке каждого запроса — чужие POST отбрасываем
+WEBHOOK_SECRET = (os.environ.get("TELEGRAM_WEBHOOK_SECRET") or "").strip() or secrets.token_urlsafe(32)
+UPDATE_OFFSET_FILE = BASE_DIR / "data" / "telegram-update-offset.json"
+# Отпечаток папок контента на момент последней успешной синхронизации с GitHub
+CONTENT_SYNC_STATE_FILE = BASE_DIR / "data" / "telegram-content-sync.json"
+# Папки контента, которые бот коммитит и пушит при деплое
+CONTENT_SYNC_PATHS = (
+    "content/posts",
+    "public/photos",
+    "public/audio",
+    "public/videos",
+    "content/playlist",
+)
+
+# Папки, с которыми работает бот, создаём один раз при старте, а не перед каждой записью
+for _managed_dir in (
+    SLOTS_FILE.parent,
+    POSTS_DIR,
+    PUBLIC_DIR,
+    PACKAGES_FILE.parent,
+    VIDEOS_DIR,
+    NOTGALLERY_DIR,
+    UPDATE_OFFSET_FILE.parent,
+):
+    _managed_dir.mkdir(parents=True, exist_ok=True)
+
+IMAGE_EXTS = frozenset({".jpg", ".jpeg", ".png", ".gif", ".webp"})
+VIDEO_EXTS = frozenset({".mp4", ".mov", ".avi"})
+AUDIO_EXTS = frozenset({".mp3", ".wav"})
+MEDIA_EXTS = IMAGE_EXTS | VIDEO_EXTS | AUDIO_EXTS
+
+# Тексты кнопок reply‑клавиатур, по которым срабатывают обработчики
+SYSTEM_BUTTONS = frozenset({"Деплой", "Получить токен"})
+SCHEDULE_BUTTONS = frozenset({"Показать слоты", "Добавить слот", "Удалить слот", "Отменить запись"})
+MAIN_MENU_BUTTONS = frozenset({
+    "Управление расписанием",
+    "Управление блогом",
+    "Управление уроками",
+    "Системные функции",
+    "⬅️ В главное меню",
+})
+# Префиксы callback_data списков пакетов (см. send_packages_list)
+PKG_LIST_PREFIXES = frozenset({"delpkg", "addvid", "delvid", "editpkg"})
+# Уровни пакетов видеоуроков в порядке показа на кнопках
+PKG_LEVELS = ("Начинающий", "Средний", "Продвинутый", "Все уровни")
+
+# Форматы даты/времени, которые принимает бот (см. parse_date_time)
+# (\A…\Z, а не ^…$: '$' пропустил бы строку с завершающим переводом строки)
+_match_iso_date = re.compile(r"\A\d{4}-\d{2}-\d{2}\Z").match
+_match_iso_date_time = re.compile(r"\A(\d{4}-\d{2}-\d{2})\s+(\d{2}:\d{2})\Z").match
+_match_dmy_time = re.compile(r"\A(\d{2})[.\-](\d{2})[.\-](\d{4})\s+(\d{2}:\d{2})\Z").match
+_match_dm_time = re.compile(r"\A(\d{2})[.\-](\d{2})\s+(\d{2}:\d{2})\Z").match
+_match_time = re.compile(r"\A\d{2}:\d{2}\Z").match
+
+# Генерация id пакета из названия: чистка символов и транслитерация
+_PKG_NAME_JUNK_RE = re.compile(r"[^a-zA-Zа-яА-ЯёЁ0-9\s-]")
+_WHITESPACE_RUN_RE = re.compile(r"\s+")
+_DASH_RUN_RE = re.compile(r"-+")
+_RU_TRANSLIT = str.maketrans({
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ё": "yo",
+    "ж": "zh", "з": "z", "и": "i", "й": "y", "к": "k", "л": "l", "м": "m",
+    "н": "n", "о": "o", "п": "p", "р": "r", "с": "s", "т": "t", "у": "u",
+    "ф": "f", "х": "kh", "ц": "ts", "ч": "ch", "ш": "sh", "щ": "shch",
+    "ъ": "", "ы": "y", "ь": "", "э": "e", "ю": "yu", "я": "ya",
+})
+
 # Простое состояние диалога по chat_id:
 #   None                 — обычный режим
 #   "add_slot"           — ждём дату и время слота для добавления
@@ -103,25 +400,54 @@ StateType = Optional[
         "edit_pkg_position",
     ]
 ]
-chat_state: Dict[int, StateType] = {}
 
-# Для добавления/редактирования постов и файлов: временно храним имя файла/папки на пользователя
-chat_post_files: Dict[int, str] = {}            # для нового поста (add_post_preview)
-chat_edit_post_files: Dict[int, str] = {}       # для редактирования существующего поста
-chat_upload_dirs: Dict[int, str] = {}           # для загрузки файлов в public/<dir>
-chat_rename_targets: Dict[int, tuple[str, str]] = {}  # (dir_name, filename) для переименования
 
-# Yoga packages
-chat_pkg_draft: Dict[int, dict] = {}       # черновик нового пакета {name, level, description}
-chat_pkg_target: Dict[int, str] = {}       # ID пакета для действий (добавление/удаление видео)
-chat_video_draft: Dict[int, dict] = {}     # черновик нового видео {title, duration, position}
-chat_edit_vid_idx: Dict[int, int] = {}     # индекс видео для редактирования
+@dataclass(slots=True)
+class ChatCtx:
+    """
+    Состояние диалога одного чата: режим и временные данные текущего сценария.
+    """
+    state: StateType = None
+    # Для добавления/редактирования постов и файлов: временно храним имя файла/папки
+    post_file: Optional[str] = None                      # для нового поста (add_post_preview)
+    edit_post_file: Optional[str] = None                 # для редактирования существующего поста
+    upload_dir: Optional[str] = None                     # для загрузки файлов в public/<dir>
+    rename_target: Optional[tuple[str, str]] = None      # (dir_name, filename) для переименования
+    # Yoga packages
+    pkg_draft: dict = field(default_factory=dict)        # черновик нового пакета {name, level, description}
+    pkg_target: Optional[str] = None                     # ID пакета для действий (добавление/удаление видео)
+    video_draft: dict = field(default_factory=dict)      # черновик нового видео {title, duration, position}
+    edit_vid_idx: Optional[int] = None                   # индекс видео для редактирования
+
+
+chat_ctx: Dict[int, ChatCtx] = {}
+
+
+def get_ctx(chat_id: int) -> ChatCtx:
+    ctx = chat_ctx.get(chat_id)
+    if ctx is None:
+        ctx = chat_ctx[chat_id] = ChatCtx()
+    return ctx
+
+
+_EMPTY_CTX = ChatCtx()
+
+
+def clear_state(chat_id: int) -> None:
+    """
+    Сбрасывает режим чата. Контекст без данных удаляется из chat_ctx,
+    чтобы словарь рос по числу активных диалогов, а не всех чатов за время работы.
+    """
+    ctx = chat_ctx.get(chat_id)
+    if ctx is None:
+        return
+    ctx.state = None
+    if ctx == _EMPTY_CTX:
+        del chat_ctx[chat_id]
 
 
 def is_admin_chat(chat_id: int) -> bool:
-    if not ADMIN_CHAT_IDS:
-        return False
-    return str(chat_id) in ADMIN_CHAT_IDS
+    return chat_id in ADMIN_CHAT_IDS
 
 
 def ensure_admin(chat_id: int) -> bool:
@@ -131,9 +457,27 @@ def ensure_admin(chat_id: int) -> bool:
     return False
 
 
-def _open_admin_token_db() -> sqlite3.Connection:
+# Одно соединение с базой токенов на весь процесс: схема и PRAGMA настраиваются
+# один раз, а не при каждой выдаче токена. Доступ из потоков бота — под замком.
+_admin_db_conn: Optional[sqlite3.Connection] = None
+_admin_db_lock = threading.Lock()
+
+
+def _admin_token_db() -> sqlite3.Connection:
+    """
+    Возвращает общее соединение с базой токенов (вызывать под _admin_db_lock).
+    """
+    global _admin_db_conn
+    if _admin_db_conn is not None:
+        return _admin_db_conn
     ADMIN_TOKEN_DB_PATH.parent.mkdir(parents=True, exist_ok=True)
-    conn = sqlite3.connect(ADMIN_TOKEN_DB_PATH)
+    # isolation_level=None — транзакции открываем сами (BEGIN IMMEDIATE)
+    conn = sqlite3.connect(ADMIN_TOKEN_DB_PATH, check_same_thread=False, isolation_level=None)
+    # WAL — как и у сайта (lib/admin-token-store.ts): чтение сайтом не ждёт записи бота
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA busy_timeout = 5000")
+    conn.execute("PRAGMA temp_store = MEMORY")
     conn.execute(
         """
         CREATE TABLE IF NOT EXISTS admin_auth_token (
@@ -145,16 +489,37 @@ def _open_admin_token_db() -> sqlite3.Connection:
         );
         """
     )
-    conn.commit()
+    _admin_db_conn = conn
     return conn
 
 
+# Хэш токена должен совпадать с тем, что проверяет сайт (lib/admin-token-store.ts:
+# HMAC-SHA256 в hex), поэтому алгоритм не меняем. Ключ подготавливаем один раз,
+# а на каждый токен копируем уже инициализированное состояние HMAC.
+_admin_token_hmac = (
+    hmac.new(ADMIN_TOKEN_HASH_SECRET.encode("utf-8"), digestmod=hashlib.sha256)
+    if ADMIN_TOKEN_HASH_SECRET
+    else None
+)
+
+
 def _hash_admin_token(raw_token: str) -> str:
-    return hmac.new(
-        ADMIN_TOKEN_HASH_SECRET.encode("utf-8"),
-        raw_token.encode("utf-8"),
-        hashlib.sha256,
-    ).hexdigest()
+    h = _admin_token_hmac.copy()
+    h.update(raw_token.encode("utf-8"))
+    return h.hexdigest()
+
+
+# Один и тот же объект строки при каждом вызове — sqlite3 берёт уже подготовленный
+# statement из кэша соединения, без повторного разбора SQL
+_UPSERT_ADMIN_TOKEN_SQL = """
+    INSERT INTO admin_auth_token (id, token_hash, issued_at, expires_at, created_by)
+    VALUES (1, ?, ?, ?, ?)
+    ON CONFLICT(id) DO UPDATE SET
+        token_hash = excluded.token_hash,
+        issued_at = excluded.issued_at,
+        expires_at = excluded.expires_at,
+        created_by = excluded.created_by
+"""
 
 
 def issue_admin_token(chat_id: int) -> tuple[str, int]:
@@ -166,23 +531,15 @@ def issue_admin_token(chat_id: int) -> tuple[str, int]:
     expires_at = issued_at + ADMIN_TOKEN_TTL_SECONDS
     token_hash = _hash_admin_token(raw_token)
 
-    conn = _open_admin_token_db()
-    try:
-        conn.execute(
-            """
-            INSERT INTO admin_auth_token (id, token_hash, issued_at, expires_at, created_by)
-            VALUES (1, ?, ?, ?, ?)
-            ON CONFLICT(id) DO UPDATE SET
-                token_hash = excluded.token_hash,
-                issued_at = excluded.issued_at,
-                expires_at = excluded.expires_at,
-                created_by = excluded.created_by
-            """,
-            (token_hash, issued_at, expires_at, str(chat_id)),
-        )
-        conn.commit()
-    finally:
-        conn.close()
+    with _admin_db_lock:
+        conn = _admin_token_db()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(_UPSERT_ADMIN_TOKEN_SQL, (token_hash, issued_at, expires_at, str(chat_id)))
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
 
     return raw_token, expires_at
 
@@ -196,38 +553,115 @@ def _trim_output(text: str, max_chars: int = 3000) -> str:
     return "...\n" + text[-max_chars:]
 
 
+# Сколько последних строк вывода команды держим в памяти (в чат всё равно уходит хвост)
+CMD_OUTPUT_TAIL_LINES = 200
+
+
 def _run_cmd(args: list[str], timeout: int = 120) -> tuple[int, str]:
-    completed = subprocess.run(
+    """
+    Запускает команду и возвращает (код выхода, хвост вывода).
+    stdout и stderr идут одним потоком, а в памяти остаются только последние
+    CMD_OUTPUT_TAIL_LINES строк — лог сборки на мегабайты целиком не копится.
+    """
+    tail: deque = deque(maxlen=CMD_OUTPUT_TAIL_LINES)
+    with subprocess.Popen(
         args,
         cwd=BASE_DIR,
-        capture_output=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
         text=True,
-        timeout=timeout,
-    )
-    output = _trim_output((completed.stdout or "") + "\n" + (completed.stderr or ""))
-    return completed.returncode, output
+        errors="replace",
+    ) as proc:
+        reader = threading.Thread(target=tail.extend, args=(proc.stdout,), daemon=True)
+        reader.start()
+        try:
+            returncode = proc.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            raise
+        finally:
+            # Дочерние процессы (npm) могут держать pipe открытым — долго не ждём
+            reader.join(timeout=5)
+    return returncode, _trim_output("".join(tail))
+
+
+def _content_fingerprint() -> list:
+    """
+    [число записей, хэш] по всем папкам CONTENT_SYNC_PATHS. В хэш входят относительные
+    пути, размеры и st_mtime_ns файлов и самих папок: переименование файл не трогает
+    (mtime у него прежний), но меняет путь и mtime родительской папки.
+    """
+    items = []
+    stack = [BASE_DIR / p for p in CONTENT_SYNC_PATHS]
+    base = str(BASE_DIR)
+    while stack:
+        root = stack.pop()
+        try:
+            st = root.stat()
+            with os.scandir(root) as entries:
+                items.append(f"{os.path.relpath(root, base)}/\0{st.st_mtime_ns}")
+                for entry in entries:
+                    try:
+                        est = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(Path(entry.path))
+                    else:
+                        rel = os.path.relpath(entry.path, base)
+                        items.append(f"{rel}\0{est.st_size}\0{est.st_mtime_ns}")
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+    items.sort()
+    digest = hashlib.sha256("\n".join(items).encode("utf-8", "surrogateescape")).hexdigest()
+    return [len(items), digest]
+
+
+def _remember_synced_content(fingerprint: list) -> None:
+    try:
+        _write_json_atomic(CONTENT_SYNC_STATE_FILE, {"fingerprint": fingerprint}, durable=False)
+    except Exception as e:
+        print(f"Не удалось сохранить состояние синхронизации контента: {e}")
 
 
 def sync_bot_content_to_github(chat_id: int) -> tuple[bool, str]:
-    tracked_paths = [
-        "content/posts",
-        "public/photos",
-        "public/audio",
-        "public/videos",
-        "content/playlist",
-    ]
+    tracked_paths = list(CONTENT_SYNC_PATHS)
 
-    status_code, status_output = _run_cmd(
-        ["git", "status", "--porcelain", "--", *tracked_paths],
+    # Если с прошлой успешной синхронизации в папках контента ничего не менялось,
+    # git не запускаем вовсе. Отпечаток снимаем до git-команд: то, что изменится
+    # во время синхронизации, попадёт уже в следующую.
+    fingerprint = _content_fingerprint()
+    if _cached_json(CONTENT_SYNC_STATE_FILE, {}).get("fingerprint") == fingerprint:
+        return True, "Изменений контента для GitHub не найдено."
+
+    # Вывод status нужен целиком (а не хвост из _run_cmd): по нему выбираем файлы для git add
+    status = subprocess.run(
+        ["git", "status", "--porcelain", "-z", "--", *tracked_paths],
+        cwd=BASE_DIR,
+        capture_output=True,
         timeout=60,
     )
-    if status_code != 0:
+    if status.returncode != 0:
+        status_output = _trim_output(status.stderr.decode("utf-8", "replace"))
         return False, f"Не удалось проверить git status.\n{status_output}"
 
-    if not status_output.strip() or status_output.strip() == "нет вывода":
+    # Записи вида "XY путь\0"; у переименований следом идёт ещё и старый путь
+    changed_paths = []
+    fields = iter(status.stdout.decode("utf-8", "surrogateescape").split("\0"))
+    for entry in fields:
+        if len(entry) < 4:
+            continue
+        changed_paths.append(entry[3:])
+        if entry[0] in "RC":
+            old_path = next(fields, "")
+            if old_path:
+                changed_paths.append(old_path)
+    if not changed_paths:
+        _remember_synced_content(fingerprint)
         return True, "Изменений контента для GitHub не найдено."
 
-    add_code, add_output = _run_cmd(["git", "add", "--", *tracked_paths], timeout=120)
+    # Индексируем только изменившиеся файлы, а не обходим заново все папки контента
+    add_code, add_output = _run_cmd(["git", "add", "-A", "--", *changed_paths], timeout=120)
     if add_code != 0:
         return False, f"Ошибка git add.\n{add_output}"
 
@@ -235,12 +669,14 @@ def sync_bot_content_to_github(chat_id: int) -> tuple[bool, str]:
     commit_code, commit_output = _run_cmd(["git", "commit", "-m", commit_message], timeout=120)
     if commit_code != 0:
         if "nothing to commit" in commit_output.lower() or "нет изменений" in commit_output.lower():
+            _remember_synced_content(fingerprint)
             return True, "После git add не осталось изменений для коммита."
         return False, f"Ошибка git commit.\n{commit_output}"
 
     push_code, push_output = _run_cmd(["git", "push", "origin", "main"], timeout=180)
     if push_code != 0:
         return False, f"Ошибка git push.\n{push_output}"
+    _remember_synced_content(fingerprint)
 
     return True, f"Изменения контента отправлены в GitHub.\n{push_output}"
 
@@ -294,55 +730,379 @@ def run_site_rebuild(chat_id: int) -> None:
         bot.send_message(chat_id, f"❌ Ошибка запуска пересборки: {e}")
 
 
+# Деплои выполняются строго по одному в отдельном потоке: параллельные
+# npm run build портили бы друг другу .next. Пока идёт сборка, в очереди
+# может ждать ещё один запрос — он подхватит всё, что изменилось за это время.
+_deploy_queue: "queue.Queue[int]" = queue.Queue(maxsize=1)
+_deploy_running = threading.Event()
+
+
+def _deploy_worker() -> None:
+    while True:
+        chat_id = _deploy_queue.get()
+        _deploy_running.set()
+        try:
+            run_site_rebuild(chat_id)
+        finally:
+            _deploy_running.clear()
+
+
+threading.Thread(target=_deploy_worker, name="deploy", daemon=True).start()
+
+
+def request_deploy(chat_id: int) -> None:
+    """
+    Ставит деплой в очередь; повторные нажатия, пока один деплой уже ждёт, отбрасываются.
+    """
+    running = _deploy_running.is_set()
+    try:
+        _deploy_queue.put_nowait(chat_id)
+    except queue.Full:
+        bot.send_message(chat_id, "⏳ Деплой уже запланирован и начнётся после текущего.")
+        return
+    if running:
+        bot.send_message(chat_id, "⏳ Деплой уже выполняется — следующий начнётся сразу после него.")
+
+
+def _stat_or_none(p: Path) -> Optional[os.stat_result]:
+    """
+    Один stat() вместо пары exists() + stat(): None, если файла нет.
+    """
+    try:
+        return p.stat()
+    except FileNotFoundError:
+        return None
+
+
+# Кэш разобранных JSON-файлов: путь -> ((st_mtime_ns, st_size), данные).
+# Файл перечитывается, только если он изменился на диске (в том числе сайтом);
+# размер страхует от двух записей с одинаковой mtime на ФС с грубыми метками времени.
+# Данные из кэша общие для всех потоков и только для чтения: обработчики, которые
+# меняют их перед записью, берут личную копию (см. _cached_json_copy).
+_json_cache: Dict[Path, tuple[tuple[int, int], Any]] = {}
+
+
+def _json_loads(raw: bytes):
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def _json_dumps(data) -> bytes:
+    # Формат тот же, что у json.dumps(..., ensure_ascii=False, indent=2)
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    return json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+
+
+def _cached_json(path: Path, default):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        _json_cache.pop(path, None)
+        return default
+    key = (st.st_mtime_ns, st.st_size)
+    cached = _json_cache.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    data = _json_loads(path.read_bytes())
+    _json_cache[path] = (key, data)
+    return data
+
+
+def _cached_json_copy(path: Path, default):
+    """
+    Личная копия данных из _cached_json — для чтения‑изменения‑записи: пока обработчик
+    правит её, другие чаты продолжают читать прежнюю версию и не видят несохранённых правок.
+    """
+    return copy.deepcopy(_cached_json(path, default))
+
+
+def _write_bytes_atomic(path: Path, data: bytes, durable: bool = False) -> None:
+    """
+    Пишет данные во временный файл рядом с целевым и подменяет его через os.replace,
+    чтобы читатели (бот и сайт) никогда не видели наполовину записанный файл.
+    durable=True — ещё и fsync перед подменой: после сбоя питания на месте файла
+    окажутся либо старые, либо новые данные, но не пустой файл.
+    """
+    # Своё имя временного файла у каждого потока: два чата могут писать один файл одновременно
+    tmp = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+def _write_json_atomic(path: Path, data, durable: bool = True) -> None:
+    """
+    Атомарно пишет JSON (см. _write_bytes_atomic).
+    Записанные данные сразу кладутся в кэш, чтобы следующее чтение не разбирало файл заново:
+    после записи вызывающий больше не должен их менять.
+    """
+    try:
+        _write_bytes_atomic(path, _json_dumps(data), durable)
+        st = os.stat(path)
+        _json_cache[path] = ((st.st_mtime_ns, st.st_size), data)
+    except Exception:
+        _json_cache.pop(path, None)
+        raise
+
+
 def read_slots():
-    if not SLOTS_FILE.exists():
-        return {}
-    with open(SLOTS_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
+    return _cached_json(SLOTS_FILE, {})
+
+
+def read_slots_for_update():
+    return _cached_json_copy(SLOTS_FILE, {})
 
 
 def write_slots(data: Dict[str, list]) -> None:
-    SLOTS_FILE.parent.mkdir(parents=True, exist_ok=True)
-    with open(SLOTS_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    _write_json_atomic(SLOTS_FILE, data)
 
 
 def read_bookings():
-    if not BOOKINGS_FILE.exists():
+    return _cached_json(BOOKINGS_FILE, [])
+
+
+def write_bookings(data: list) -> None:
+    _write_json_atomic(BOOKINGS_FILE, data)
+
+
+@dataclass(slots=True)
+class BookingsIndex:
+    """
+    Записи, сгруппированные по слоту (дата, время) и занятые времена по датам.
+    by_date — упорядоченное множество (dict с None): времена уже отсортированы.
+    """
+    by_slot: Dict[tuple[str, str], list] = field(default_factory=dict)
+    by_date: Dict[str, Dict[str, None]] = field(default_factory=dict)
+
+
+# Индекс строится один раз на каждую загруженную версию bookings.json:
+# (список из кэша read_bookings, индекс по нему)
+_bookings_index: Optional[tuple[list, BookingsIndex]] = None
+
+
+def bookings_index(bookings: Optional[list] = None) -> BookingsIndex:
+    global _bookings_index
+    if bookings is None:
+        bookings = read_bookings()
+    cached = _bookings_index
+    if cached is not None and cached[0] is bookings:
+        return cached[1]
+    index = BookingsIndex()
+    for b in bookings:
+        d, t = b.get("date", ""), b.get("time")
+        index.by_slot.setdefault((d, t), []).append(b)
+    # Сортируем один раз при построении, а не при каждом нажатии кнопки
+    for d, t in sorted(index.by_slot, key=lambda k: (k[0], k[1] or "")):
+        index.by_date.setdefault(d, {})[t] = None
+    _bookings_index = (bookings, index)
+    return index
+
+
+def cancel_slot_bookings(date_str: str, time_str: str) -> list:
+    """
+    Убирает из bookings.json все записи на слот и возвращает отменённые.
+    Индекс обновляется без повторного разбора файла.
+    """
+    global _bookings_index
+    bookings = read_bookings()
+    index = bookings_index(bookings)
+    key = (date_str, time_str)
+    cancelled = index.by_slot.get(key)
+    if not cancelled:
         return []
-    with open(BOOKINGS_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
+    remaining = [b for b in bookings if (b.get("date", ""), b.get("time")) != key]
+    write_bookings(remaining)
+    # Прежний индекс могут читать другие чаты — собираем новый из его частей
+    by_slot = dict(index.by_slot)
+    del by_slot[key]
+    by_date = dict(index.by_date)
+    times = by_date.get(date_str)
+    if times is not None:
+        times = {t: None for t in times if t != time_str}
+        if times:
+            by_date[date_str] = times
+        else:
+            del by_date[date_str]
+    _bookings_index = (remaining, BookingsIndex(by_slot=by_slot, by_date=by_date))
+    return cancelled
+
+
+_MONTHS_RU = (
+    "",
+    "января", "февраля", "марта", "апреля", "мая", "июня",
+    "июля", "августа", "сентября", "октября", "ноября", "декабря",
+)
+
+
+def _load_update_offset() -> int:
+    try:
+        return int(_cached_json(UPDATE_OFFSET_FILE, {}).get("offset", 0))
+    except Exception:
+        return 0
+
+
+# Offset меняется на каждую пачку апдейтов, поэтому пишется не сразу, а фоновым
+# потоком после OFFSET_FLUSH_DELAY секунд затишья: серия нажатий — одна запись.
+# Потеря последнего значения при падении означает лишь повторную обработку пары апдейтов.
+OFFSET_FLUSH_DELAY = 1.0
+_offset_pending: Optional[int] = None
+_offset_written: Optional[int] = None
+_offset_dirty = threading.Event()
+_offset_flush_lock = threading.Lock()
+
+
+def _save_update_offset(offset: int) -> None:
+    global _offset_pending
+    _offset_pending = offset
+    _offset_dirty.set()
+
+
+def _flush_update_offset() -> None:
+    global _offset_written
+    with _offset_flush_lock:
+        offset = _offset_pending
+        if offset is None or offset == _offset_written:
+            return
+        try:
+            _write_json_atomic(UPDATE_OFFSET_FILE, {"offset": offset}, durable=False)
+            _offset_written = offset
+        except Exception as e:
+            print(f"Не удалось сохранить offset апдейтов: {e}")
+
+
+def _offset_writer() -> None:
+    while True:
+        _offset_dirty.wait()
+        # Ждём, пока поток апдейтов затихнет: каждое новое значение продлевает паузу
+        while True:
+            _offset_dirty.clear()
+            time.sleep(OFFSET_FLUSH_DELAY)
+            if not _offset_dirty.is_set():
+                break
+        _flush_update_offset()
+
+
+threading.Thread(target=_offset_writer, name="offset-writer", daemon=True).start()
+# При штатной остановке (Ctrl+C) дописываем последнее значение
+atexit.register(_flush_update_offset)
 
 
+# Набор дат в расписании невелик, а форматируются они на каждый показ слотов/записей
+@functools.lru_cache(maxsize=1024)
 def format_date_ru(date_str):
-    months = {
-        "01": "января", "02": "февраля", "03": "марта", "04": "апреля",
-        "05": "мая", "06": "июня", "07": "июля", "08": "августа",
-        "09": "сентября", "10": "октября", "11": "ноября", "12": "декабря",
-    }
+    y, _, rest = date_str.partition("-")
+    m, _, d = rest.partition("-")
     try:
-        y, m, d = date_str.split("-")
-        return f"{int(d)} {months.get(m, m)} {y}"
+        month = int(m)
+        month_name = _MONTHS_RU[month] if 1 <= month <= 12 else m
+        return f"{int(d)} {month_name} {y}"
     except Exception:
         return date_str
 
 
 def read_packages() -> list:
-    if not PACKAGES_FILE.exists():
-        return []
-    with open(PACKAGES_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
+    return _cached_json(PACKAGES_FILE, [])
+
+
+def read_packages_for_update() -> list:
+    return _cached_json_copy(PACKAGES_FILE, [])
+
+
+def read_packages_slice(start: int, end: int) -> tuple[list, int]:
+    """
+    Возвращает (пакеты[start:end], общее число пакетов) — для постраничного вывода.
+    """
+    packages = read_packages()
+    return packages[start:end], len(packages)
 
 
 def write_packages(packages: list) -> None:
-    PACKAGES_FILE.parent.mkdir(parents=True, exist_ok=True)
-    with open(PACKAGES_FILE, "w", encoding="utf-8") as f:
-        json.dump(packages, f, ensure_ascii=False, indent=2)
+    global _packages_index
+    # Список мог измениться на месте (добавление/удаление пакета) — индекс строим заново
+    _packages_index = None
+    _write_json_atomic(PACKAGES_FILE, packages)
+
+
+# Индекс пакетов по id для текущей версии списка из read_packages:
+# (список, {id: пакет}); сбрасывается при записи
+_packages_index: Optional[tuple[list, Dict[str, dict]]] = None
+
+
+def get_package(pkg_id: Optional[str], packages: Optional[list] = None) -> Optional[dict]:
+    """
+    Пакет по id (None, если такого нет). packages — уже прочитанный список,
+    если вызывающему он нужен для последующей записи.
+    Индекс держим только для общего списка из кэша; в личной копии
+    (read_packages_for_update) пакет ищется простым проходом — она живёт один обработчик.
+    """
+    global _packages_index
+    if not pkg_id:
+        return None
+    shared = read_packages()
+    if packages is not None and packages is not shared:
+        return next((p for p in packages if p.get("id") == pkg_id), None)
+    cached = _packages_index
+    if cached is None or cached[0] is not shared:
+        cached = _packages_index = (shared, {p["id"]: p for p in shared})
+    return cached[1].get(pkg_id)
 
 
+class _FrozenKeyboardMixin:
+    """
+    Готовая статичная клавиатура: JSON собран один раз при создании,
+    добавлять в неё кнопки нельзя, чтобы не отправить устаревшую разметку.
+    """
+
+    _json: str
+
+    def to_json(self):
+        return self._json
+
+    def add(self, *args, **kwargs):
+        raise TypeError("Готовую клавиатуру менять нельзя")
+
+    def row(self, *args, **kwargs):
+        raise TypeError("Готовую клавиатуру менять нельзя")
+
+
+class _FrozenReplyKeyboard(_FrozenKeyboardMixin, types.ReplyKeyboardMarkup):
+    pass
+
+
+class _FrozenInlineKeyboard(_FrozenKeyboardMixin, types.InlineKeyboardMarkup):
+    pass
+
+
+def _freeze_keyboard(kb):
+    """
+    Статичная клавиатура больше не меняется — сериализуем её в JSON один раз,
+    а не при каждой отправке сообщения. Возвращает новый объект, исходный
+    не трогает.
+    """
+    if isinstance(kb, types.InlineKeyboardMarkup):
+        frozen = _FrozenInlineKeyboard.__new__(_FrozenInlineKeyboard)
+    else:
+        frozen = _FrozenReplyKeyboard.__new__(_FrozenReplyKeyboard)
+    frozen.__dict__.update(kb.__dict__)
+    frozen._json = kb.to_json()
+    return frozen
+
+
+@functools.cache
 def make_main_keyboard() -> types.ReplyKeyboardMarkup:
     """
     Главное меню: два крупных раздела.
+    Reply‑клавиатуры статичны, поэтому каждая собирается один раз и дальше переиспользуется
+    (вызывающий код их не меняет).
     """
     kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
     kb.row(
@@ -357,17 +1117,19 @@ def make_main_keyboard() -> types.ReplyKeyboardMarkup:
     kb.row(
         types.KeyboardButton("Системные функции"),
     )
-    return kb
+    return _freeze_keyboard(kb)
 
 
+@functools.cache
 def make_system_keyboard() -> types.ReplyKeyboardMarkup:
     kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
     kb.row(types.KeyboardButton("Деплой"))
     kb.row(types.KeyboardButton("Получить токен"))
     kb.row(types.KeyboardButton("⬅️ В главное меню"))
-    return kb
+    return _freeze_keyboard(kb)
 
 
+@functools.cache
 def make_schedule_keyboard() -> types.ReplyKeyboardMarkup:
     """
     Меню управления расписанием.
@@ -380,9 +1142,10 @@ def make_schedule_keyboard() -> types.ReplyKeyboardMarkup:
     )
     kb.row(types.KeyboardButton("Отменить запись"))
     kb.row(types.KeyboardButton("⬅️ В главное меню"))
-    return kb
+    return _freeze_keyboard(kb)
 
 
+@functools.cache
 def make_yoga_keyboard() -> types.ReplyKeyboardMarkup:
     """
     Меню управления пакетами видеоуроков.
@@ -399,9 +1162,10 @@ def make_yoga_keyboard() -> types.ReplyKeyboardMarkup:
         types.KeyboardButton("Удалить видео из пакета"),
     )
     kb.row(types.KeyboardButton("⬅️ В главное меню"))
-    return kb
+    return _freeze_keyboard(kb)
 
 
+@functools.cache
 def make_blog_keyboard() -> types.ReplyKeyboardMarkup:
     """
     Меню управления блогом (пока заглушки).
@@ -412,22 +1176,108 @@ def make_blog_keyboard() -> types.ReplyKeyboardMarkup:
     kb.row(types.KeyboardButton("Редактировать пост"))
     kb.row(types.KeyboardButton("Управление файлами"))
     kb.row(types.KeyboardButton("⬅️ В главное меню"))
-    return kb
+    return _freeze_keyboard(kb)
+
+
+@functools.cache
+def make_pkg_level_keyboard() -> types.InlineKeyboardMarkup:
+    """
+    Выбор уровня при создании пакета (шаг 2): кнопки не зависят от пакета.
+    """
+    kb = types.InlineKeyboardMarkup(
+        keyboard=[
+            [types.InlineKeyboardButton(text=level, callback_data=f"pkg_level:{level}")]
+            for level in PKG_LEVELS
+        ]
+    )
+    return _freeze_keyboard(kb)
+
+
+# Ответы Telegram, после которых сообщение остаётся как есть или отправляется заново
+_EDIT_NOT_MODIFIED = "message is not modified"
+_EDIT_IMPOSSIBLE = ("message to edit not found", "message can't be edited")
+
+
+def edit_or_send(call: types.CallbackQuery, text: str, **kwargs) -> None:
+    """
+    Подменяет сообщение, на кнопку которого нажали, новым текстом и inline‑клавиатурой.
+    Если сообщение отредактировать нельзя (старое, удалено и т.п.) — отправляет новое;
+    если менять нечего (повторное нажатие той же кнопки) — ничего не делает.
+    """
+    try:
+        bot.edit_message_text(
+            text,
+            chat_id=call.message.chat.id,
+            message_id=call.message.message_id,
+            **kwargs,
+        )
+    except apihelper.ApiTelegramException as e:
+        description = (getattr(e, "description", None) or str(e)).lower()
+        if _EDIT_NOT_MODIFIED in description:
+            return
+        if not any(reason in description for reason in _EDIT_IMPOSSIBLE):
+            raise
+        bot.send_message(call.message.chat.id, text, **kwargs)
+
+
+# Файлы с серверов Telegram качаем кусками, а не целиком в память
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+def download_telegram_file(file_path: str, target: Path) -> None:
+    """
+    Скачивает файл Telegram (file_path из get_file) потоком прямо в target.
+    Пишем во временный файл рядом и подменяем target, чтобы при обрыве не оставить огрызок.
+    """
+    url = (apihelper.FILE_URL or "https://api.telegram.org/file/bot{0}/{1}").format(BOT_TOKEN, file_path)
+    tmp = target.with_name(target.name + ".part")
+    try:
+        with requests.get(url, stream=True, timeout=(10, 60), proxies=apihelper.proxy) as resp:
+            resp.raise_for_status()
+            # Копируем сырой поток ответа в файл фиксированным буфером, без промежуточных bytes-чанков
+            resp.raw.decode_content = True
+            with open(tmp, "wb") as f:
+                shutil.copyfileobj(resp.raw, f, DOWNLOAD_CHUNK_SIZE)
+        os.replace(tmp, target)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+def file_stamp() -> str:
+    """
+    Текущее время для имён файлов и id: ГГГГММДД-ЧЧММСС.
+    """
+    now = datetime.now()
+    return f"{now.year:04d}{now.month:02d}{now.day:02d}-{now.hour:02d}{now.minute:02d}{now.second:02d}"
 
 
 def create_blog_post_file(markdown_text: str) -> str:
     """
     Создаёт новый markdown‑файл поста в content/posts.
     Ожидается, что текст уже в нужном формате (как пример return-to-yoga-after-illness.md).
-    Имя файла генерируется автоматически, например: post-20260203-153045.md
+    Имя файла генерируется автоматически, например: post-20260203-153045-123456.md
+    (последняя часть — микросекунды, чтобы посты в пределах одной секунды не затирали друг друга).
     Возвращает имя файла (без пути).
     """
-    POSTS_DIR.mkdir(parents=True, exist_ok=True)
-    slug = f"post-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
-    filename = f"{slug}.md"
-    target = POSTS_DIR / filename
-    target.write_text(markdown_text, encoding="utf-8")
-    return filename
+    # Кодируем один раз: при коллизии имени повторяется только open()
+    data = markdown_text.encode("utf-8")
+    while True:
+        ns = time.time_ns()
+        now = datetime.fromtimestamp(ns // 1_000_000_000)
+        slug = (
+            f"post-{now.year:04d}{now.month:02d}{now.day:02d}"
+            f"-{now.hour:02d}{now.minute:02d}{now.second:02d}"
+            f"-{ns // 1000 % 1_000_000:06d}"
+        )
+        filename = f"{slug}.md"
+        try:
+            # "x" — не перезаписываем существующий файл молча
+            with open(POSTS_DIR / filename, "xb") as f:
+                f.write(data)
+        except FileExistsError:
+            continue
+        return filename
 
 
 def add_preview_to_post(filename: str, image_path: str) -> None:
@@ -436,92 +1286,174 @@ def add_preview_to_post(filename: str, image_path: str) -> None:
     image_path — путь вида "/photos/имяфайла.jpg".
     """
     target = POSTS_DIR / filename
-    if not target.exists():
+    try:
+        f = target.open("rb")
+    except FileNotFoundError:
         return
-    text = target.read_text(encoding="utf-8")
-    lines = text.splitlines()
+    with f:
+        # Решение принимаем по началу файла; тело поста дочитываем,
+        # только если файл действительно придётся переписать
+        data = f.read(POST_HEADER_MAX_BYTES)
+        eof = len(data) < POST_HEADER_MAX_BYTES
+        preview_line = f'previewImage: "{image_path}"'.encode("utf-8")
+        nl = data.find(b"\n")
+        first_line = data if nl < 0 else data[:nl]
+
+        if first_line.strip() != b"---":
+            # Нет шапки — просто добавим её в начало
+            if not eof:
+                data += f.read()
+            _write_bytes_atomic(target, b"---\n" + preview_line + b"\n---\n\n" + data)
+            return
+        if nl < 0:
+            # Неполная шапка — не трогаем
+            return
 
-    # Ищем границы frontmatter '---'
-    if not lines or lines[0].strip() != "---":
-        # Нет шапки — просто добавим её в начало
-        frontmatter = ["---", f'previewImage: "{image_path}"', "---", ""]
-        new_text = "\n".join(frontmatter + lines)
-        target.write_text(new_text, encoding="utf-8")
-        return
+        # Уже есть frontmatter — ищем закрывающую '---' и previewImage в пределах шапки
+        end = _FM_END_RE.search(data, nl + 1)
+        if (end is None or end.end() == len(data)) and not eof:
+            # Шапка длиннее прочитанного начала (или строка '---' обрезана на его
+            # границе) — дочитываем файл целиком
+            data += f.read()
+            eof = True
+            end = _FM_END_RE.search(data, nl + 1)
+        if end is None:
+            # Неполная шапка — не трогаем
+            return
+        if _FM_PREVIEW_RE.search(data, nl + 1, end.start()):
+            # previewImage уже есть
+            return
 
-    # Уже есть frontmatter — проверим, нет ли previewImage
-    end_idx = None
-    for i in range(1, len(lines)):
-        if lines[i].strip() == "---":
-            end_idx = i
-            break
-    if end_idx is None:
-        # Неполная шапка — не трогаем
-        return
+        if not eof:
+            data += f.read()
 
-    header_lines = lines[1:end_idx]
-    if any(l.strip().startswith("previewImage:") for l in header_lines):
-        # previewImage уже есть
-        return
+    # Вставляем previewImage первой строкой шапки, остальной текст не трогаем
+    eol = b"\r\n" if first_line.endswith(b"\r") else b"\n"
+    _write_bytes_atomic(target, data[: nl + 1] + preview_line + eol + data[nl + 1 :])
 
-    new_header = ['previewImage: "' + image_path + '"'] + header_lines
-    new_lines = ["---"] + new_header + ["---"] + lines[end_idx + 1 :]
-    target.write_text("\n".join(new_lines), encoding="utf-8")
 
+# Разобранная шапка каждого поста: путь -> ((st_mtime_ns, st_size) файла, (ключ сортировки, title))
+_post_meta_cache: Dict[Path, tuple[tuple[int, int], tuple[float, str]]] = {}
+# Шапка поста всегда в начале файла; больше этого при разборе шапки не читаем
+POST_HEADER_MAX_BYTES = 8192
+# Фронтматтер: открывающая '---', закрывающая '---' и нужные поля шапки
+_FM_START_RE = re.compile(rb"[ \t]*---[ \t]*\r?\n")
+_FM_END_RE = re.compile(rb"^[ \t]*---[ \t]*\r?$", re.MULTILINE)
+_FM_FIELD_RE = re.compile(rb"^[ \t]*(title|date):(.*)$", re.MULTILINE)
+_FM_PREVIEW_RE = re.compile(rb"^[ \t]*previewImage:", re.MULTILINE)
 
-def list_blog_posts():
+
+def _read_post_meta(path: Path, slug: str) -> tuple[str, Optional[str]]:
     """
-    Возвращает список постов блога в виде [(slug, title), ...],
-    где slug = имя файла без .md, title — из фронтматтера (если есть) или slug.
+    Достаёт title и date из фронтматтера поста (title по умолчанию — slug).
     """
-    POSTS_DIR.mkdir(parents=True, exist_ok=True)
-    posts = []
-    for path in POSTS_DIR.glob("*.md"):
-        slug = path.stem
-        title = slug
-        post_date_str = None
-        try:
-            text = path.read_text(encoding="utf-8")
-            lines = text.splitlines()
-            if lines and lines[0].strip() == "---":
-                # Ищем поля между первой и второй '---'
-                for line in lines[1:]:
-                    s = line.strip()
-                    if s == "---":
-                        break
-                    if s.startswith("title:"):
-                        raw = line.split(":", 1)[1].strip()
-                        if raw.startswith('"') and raw.endswith('"'):
-                            raw = raw[1:-1]
-                        title = raw or slug
-                    if s.startswith("date:"):
-                        raw = line.split(":", 1)[1].strip()
-                        if raw.startswith('"') and raw.endswith('"'):
-                            raw = raw[1:-1]
-                        post_date_str = raw or None
-        except Exception:
-            pass
-        posts.append((slug, title, post_date_str))
-
-    def sort_key(item):
-        slug, _title, d = item
-        # Пытаемся сортировать по дате, самые новые сначала
-        try:
-            if d:
-                dt = datetime.fromisoformat(d)
+    title = slug
+    post_date_str = None
+    try:
+        # Шапка всегда в начале файла: читаем только первые POST_HEADER_MAX_BYTES,
+        # тело поста (картинки, длинный текст) с диска не читается вовсе.
+        with path.open("rb") as f:
+            head = f.read(POST_HEADER_MAX_BYTES)
+        start = _FM_START_RE.match(head)
+        if not start:
+            return title, post_date_str
+        end = _FM_END_RE.search(head, start.end())
+        header = head[start.end():end.start() if end else len(head)]
+        for key, raw_value in _FM_FIELD_RE.findall(header):
+            raw = raw_value.decode("utf-8", "replace").strip()
+            if raw.startswith('"') and raw.endswith('"'):
+                raw = raw[1:-1]
+            if key == b"title":
+                title = raw or slug
             else:
-                dt = datetime.min
-        except Exception:
-            dt = datetime.min
-        # Сортируем по дате (новые сверху), при равенстве — по имени файла
-        return (-dt.timestamp(), slug)
+                post_date_str = raw or None
+    except Exception:
+        pass
+    return title, post_date_str
+
+
+def _post_meta(path: Path, slug: str, st: os.stat_result) -> tuple[float, str]:
+    """
+    Ключ сортировки и title поста; шапка перечитывается, только если файл изменился.
+    """
+    key = (st.st_mtime_ns, st.st_size)
+    cached = _post_meta_cache.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    title, post_date_str = _read_post_meta(path, slug)
+    # Ключ сортировки считаем один раз при разборе: новые посты сверху,
+    # посты без даты (или с кривой датой) — в самом конце
+    try:
+        sort_ts = -datetime.fromisoformat(post_date_str).timestamp()
+    except Exception:
+        sort_ts = float("inf")
+    meta = (sort_ts, title)
+    _post_meta_cache[path] = (key, meta)
+    return meta
+
+
+def get_post_title(slug: str) -> Optional[str]:
+    """
+    Заголовок поста по slug (или сам slug, если title в шапке нет).
+    None — если файла поста нет.
+    """
+    path = POSTS_DIR / f"{slug}.md"
+    st = _stat_or_none(path)
+    if st is None:
+        return None
+    return _post_meta(path, slug, st)[1]
+
 
-    posts.sort(key=sort_key)
+def list_blog_posts():
+    """
+    Возвращает список постов блога в виде [(slug, title), ...],
+    где slug = имя файла без .md, title — из фронтматтера (если есть) или slug.
+    Папку читаем при каждом вызове (правка текста поста не меняет её mtime),
+    а шапки файлов кэшируются по mtime и размеру каждого файла.
+    """
+    posts = []
+    seen = set()
+    # scandir вместо glob + stat: имена и тип файла приходят из одного чтения каталога
+    with os.scandir(POSTS_DIR) as it:
+        for entry in it:
+            name = entry.name
+            if not name.endswith(".md") or name.startswith("."):
+                continue
+            try:
+                if not entry.is_file():
+                    continue
+                st = entry.stat()
+            except OSError:
+                continue
+            path = POSTS_DIR / name
+            slug = name[:-3]
+            seen.add(path)
+            sort_ts, title = _post_meta(path, slug, st)
+            posts.append((sort_ts, slug, title))
+
+    # Забываем шапки удалённых файлов
+    for stale in _post_meta_cache.keys() - seen:
+        del _post_meta_cache[stale]
+
+    # Сортируем по дате (новые сверху), при равенстве — по имени файла
+    posts.sort()
     # Возвращаем только (slug, title)
-    return [(slug, title) for slug, title, _d in posts]
+    return [(slug, title) for _ts, slug, title in posts]
 
 
-def send_posts_page(chat_id: int, page: int):
+def _send_posts_page(
+    chat_id: int,
+    page: int,
+    prefix: str,
+    prompt: str,
+    call: Optional[types.CallbackQuery] = None,
+):
+    """
+    Отправляет пагинированный список постов с inline‑кнопками.
+    prefix — для callback_data: 'delpost' или 'editpost'
+    (кнопки '<prefix>:<slug>:<page>', '<prefix>page:<page>', 'cancel_<prefix>').
+    call — нажатие кнопки листания: тогда список меняется в том же сообщении.
+    """
     posts = list_blog_posts()
     if not posts:
         bot.send_message(
@@ -541,31 +1473,28 @@ def send_posts_page(chat_id: int, page: int):
     start = page * PAGE_SIZE_POSTS
     end = min(start + PAGE_SIZE_POSTS, total)
 
-    kb = types.InlineKeyboardMarkup()
-    for slug, title in posts[start:end]:
-        label = title
-        if len(label) > 40:
-            label = label[:37] + "..."
-        kb.add(
-            types.InlineKeyboardButton(
-                text=label,
-                callback_data=f"delpost:{slug}:{page}",
-            )
+    kb = types.InlineKeyboardMarkup(row_width=1)
+    kb.add(*[
+        types.InlineKeyboardButton(
+            text=title if len(title) <= 40 else title[:37] + "...",
+            callback_data=f"{prefix}:{slug}:{page}",
         )
+        for slug, title in posts[start:end]
+    ])
 
     nav_row = []
     if page > 0:
         nav_row.append(
             types.InlineKeyboardButton(
                 text="⬅️ Предыдущие",
-                callback_data=f"delpostpage:{page-1}",
+                callback_data=f"{prefix}page:{page-1}",
             )
         )
     if end < total:
         nav_row.append(
             types.InlineKeyboardButton(
                 text="Следующие посты ➡️",
-                callback_data=f"delpostpage:{page+1}",
+                callback_data=f"{prefix}page:{page+1}",
             )
         )
     if nav_row:
@@ -574,114 +1503,94 @@ def send_posts_page(chat_id: int, page: int):
     kb.row(
         types.InlineKeyboardButton(
             text="Отмена",
-            callback_data="cancel_delpost",
+            callback_data=f"cancel_{prefix}",
         )
     )
 
-    bot.send_message(
-        chat_id,
-        "Выберите пост для удаления:",
-        reply_markup=kb,
-    )
+    if call is not None:
+        edit_or_send(call, prompt, reply_markup=kb)
+    else:
+        bot.send_message(chat_id, prompt, reply_markup=kb)
 
 
-def send_edit_posts_page(chat_id: int, page: int):
-    posts = list_blog_posts()
-    if not posts:
-        bot.send_message(
-            chat_id,
-            "Постов в блоге пока нет.",
-            reply_markup=make_blog_keyboard(),
-        )
-        return
+def send_posts_page(chat_id: int, page: int, call: Optional[types.CallbackQuery] = None):
+    _send_posts_page(chat_id, page, "delpost", "Выберите пост для удаления:", call)
 
-    total = len(posts)
-    max_page = (total - 1) // PAGE_SIZE_POSTS
-    if page < 0:
-        page = 0
-    if page > max_page:
-        page = max_page
 
-    start = page * PAGE_SIZE_POSTS
-    end = min(start + PAGE_SIZE_POSTS, total)
+def send_edit_posts_page(chat_id: int, page: int, call: Optional[types.CallbackQuery] = None):
+    _send_posts_page(chat_id, page, "editpost", "Выберите пост для редактирования:", call)
 
-    kb = types.InlineKeyboardMarkup()
-    for slug, title in posts[start:end]:
-        label = title
-        if len(label) > 40:
-            label = label[:37] + "..."
-        kb.add(
-            types.InlineKeyboardButton(
-                text=label,
-                callback_data=f"editpost:{slug}:{page}",
-            )
-        )
 
-    nav_row = []
-    if page > 0:
-        nav_row.append(
-            types.InlineKeyboardButton(
-                text="⬅️ Предыдущие",
-                callback_data=f"editpostpage:{page-1}",
-            )
-        )
-    if end < total:
-        nav_row.append(
-            types.InlineKeyboardButton(
-                text="Следующие посты ➡️",
-                callback_data=f"editpostpage:{page+1}",
-            )
-        )
-    if nav_row:
-        kb.row(*nav_row)
+def rename_no_clobber(src: Path, dst: Path) -> None:
+    """
+    Переименовывает src в dst, не затирая существующий dst.
+    Жёсткая ссылка + удаление старого имени: os.link сам падает с FileExistsError
+    или FileNotFoundError, так что отдельные exists() перед переименованием не нужны.
+    """
+    try:
+        os.link(src, dst)
+    except (FileExistsError, FileNotFoundError):
+        raise
+    except OSError:
+        # ФС без жёстких ссылок — проверяем цель и переименовываем обычным способом
+        if os.path.lexists(dst):
+            raise FileExistsError(errno.EEXIST, "Файл уже существует", str(dst))
+        os.rename(src, dst)
+        return
+    os.unlink(src)
 
-    kb.row(
-        types.InlineKeyboardButton(
-            text="Отмена",
-            callback_data="cancel_editpost",
-        )
-    )
 
-    bot.send_message(
-        chat_id,
-        "Выберите пост для редактирования:",
-        reply_markup=kb,
-    )
+def _is_media_name(name: str) -> bool:
+    # Как os.path.splitext: точки в начале имени (.hidden) расширением не считаются
+    dot = name.rfind(".")
+    return dot > len(name) - len(name.lstrip(".")) and name[dot:].lower() in MEDIA_EXTS
+
+
+# Списки медиафайлов по папкам: путь -> (st_mtime_ns папки, [имена]).
+# Добавление, удаление и переименование файла меняют mtime папки,
+# так что листание страниц не пересканирует папку заново.
+_media_files_cache: Dict[Path, tuple[int, list]] = {}
+# Подпапки public: (st_mtime_ns папки public, [имена по алфавиту])
+_public_subdirs_cache: Optional[tuple[int, list]] = None
 
 
 def list_media_dirs():
     """
     Возвращает список папок из public, в которых есть медиафайлы (фото/видео/аудио).
     """
-    PUBLIC_DIR.mkdir(parents=True, exist_ok=True)
-    media_exts = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".mp4", ".mov", ".avi", ".mp3", ".wav"}
-    dirs = []
-    for entry in PUBLIC_DIR.iterdir():
-        if entry.is_dir():
-            has_media = any(
-                child.is_file() and child.suffix.lower() in media_exts
-                for child in entry.iterdir()
-            )
-            if has_media:
-                dirs.append(entry.name)
-    dirs.sort()
-    return dirs
+    global _public_subdirs_cache
+    # Подпапки public кэшируются по mtime самой public, а содержимое каждой —
+    # через кэш list_media_files: повторное открытие — это по одному stat на папку
+    public_mtime = PUBLIC_DIR.stat().st_mtime_ns
+    if _public_subdirs_cache is None or _public_subdirs_cache[0] != public_mtime:
+        # os.scandir отдаёт тип записи вместе с именем, без отдельного stat на каждый файл
+        with os.scandir(PUBLIC_DIR) as entries:
+            subdirs = sorted(entry.name for entry in entries if entry.is_dir())
+        _public_subdirs_cache = (public_mtime, subdirs)
+    return [name for name in _public_subdirs_cache[1] if list_media_files(name)]
 
 
 def list_media_files(dir_name: str):
     """
     Возвращает список файлов в public/<dir_name> с медиа‑расширениями.
     """
-    media_exts = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".mp4", ".mov", ".avi", ".mp3", ".wav"}
     target = PUBLIC_DIR / dir_name
-    if not target.exists() or not target.is_dir():
+    try:
+        dir_mtime = target.stat().st_mtime_ns
+        cached = _media_files_cache.get(target)
+        if cached is not None and cached[0] == dir_mtime:
+            return cached[1]
+        with os.scandir(target) as entries:
+            files = [
+                entry.name
+                for entry in entries
+                if _is_media_name(entry.name) and entry.is_file()
+            ]
+    except (FileNotFoundError, NotADirectoryError):
+        _media_files_cache.pop(target, None)
         return []
-    files = [
-        p.name
-        for p in target.iterdir()
-        if p.is_file() and p.suffix.lower() in media_exts
-    ]
     files.sort()
+    _media_files_cache[target] = (dir_mtime, files)
     return files
 
 
@@ -696,14 +1605,14 @@ def send_media_dirs(chat_id: int):
         )
         return
 
-    kb = types.InlineKeyboardMarkup()
-    for d in dirs:
-        kb.add(
-            types.InlineKeyboardButton(
-                text=d,
-                callback_data=f"mf_dir:{d}",
-            )
+    kb = types.InlineKeyboardMarkup(row_width=1)
+    kb.add(*[
+        types.InlineKeyboardButton(
+            text=d,
+            callback_data=f"mf_dir:{d}",
         )
+        for d in dirs
+    ])
     kb.row(
         types.InlineKeyboardButton(
             text="Отмена",
@@ -719,7 +1628,16 @@ def send_media_dirs(chat_id: int):
     )
 
 
-def send_media_files(chat_id: int, dir_name: str, page: int = 0):
+def send_media_files(
+    chat_id: int,
+    dir_name: str,
+    page: int = 0,
+    call: Optional[types.CallbackQuery] = None,
+):
+    """
+    Список файлов папки public/<dir_name> постранично.
+    call — нажатие кнопки листания: тогда список меняется в том же сообщении.
+    """
     files = list_media_files(dir_name)
     if not files:
         bot.send_message(
@@ -741,17 +1659,13 @@ def send_media_files(chat_id: int, dir_name: str, page: int = 0):
     start = page * PAGE_SIZE_FILES
     end = min(start + PAGE_SIZE_FILES, total)
 
-    kb = types.InlineKeyboardMarkup()
-    for name in files[start:end]:
-        label = name
-        if len(label) > 40:
-            label = label[:37] + "..."
-        kb.add(
-            types.InlineKeyboardButton(
-                text=label,
-                callback_data=f"mf_file:{dir_name}|{name}|{page}",
-            )
-        )
+    kb = types.InlineKeyboardMarkup(keyboard=[
+        [types.InlineKeyboardButton(
+            text=name if len(name) <= 40 else name[:37] + "...",
+            callback_data=f"mf_file:{dir_name}|{name}|{page}",
+        )]
+        for name in files[start:end]
+    ])
 
     nav_row = []
     if page > 0:
@@ -790,12 +1704,11 @@ def send_media_files(chat_id: int, dir_name: str, page: int = 0):
         )
     )
 
-    bot.send_message(
-        chat_id,
-        f"Файлы в папке `{dir_name}`:",
-        parse_mode="Markdown",
-        reply_markup=kb,
-    )
+    text = f"Файлы в папке `{dir_name}`:"
+    if call is not None:
+        edit_or_send(call, text, parse_mode="Markdown", reply_markup=kb)
+    else:
+        bot.send_message(chat_id, text, parse_mode="Markdown", reply_markup=kb)
 
 
 @bot.message_handler(commands=["start"])
@@ -820,20 +1733,22 @@ def cmd_slots(message):
     if not slots:
         bot.reply_to(message, "Слотов пока нет.")
         return
+    # Одна загрузка записей и один индекс на оба варианта команды
+    booked_by_date = bookings_index().by_date
 
     if len(parts) >= 2:
         date = parts[1]
-        if not re.match(r"^\d{4}-\d{2}-\d{2}$", date):
+        if not _match_iso_date(date):
             bot.reply_to(message, "Формат даты: ГГГГ-ММ-ДД (например 2025-02-10)")
             return
         if date not in slots:
             bot.reply_to(message, f"На {format_date_ru(date)} слотов нет.")
             return
         times = slots[date]
-        bookings = read_bookings()
-        booked = {b["time"] for b in bookings if b["date"] == date}
-        free = [t for t in times if t not in booked]
-        taken = [t for t in times if t in booked]
+        booked = booked_by_date.get(date, ())
+        free, taken = [], []
+        for t in times:
+            (taken if t in booked else free).append(t)
         lines = [f"📅 {format_date_ru(date)}"]
         if free:
             lines.append("Свободно: " + ", ".join(free))
@@ -844,8 +1759,7 @@ def cmd_slots(message):
         lines = ["📋 Слоты по датам:\n"]
         for d in sorted(slots.keys()):
             times = slots[d]
-            bookings = read_bookings()
-            booked = {b["time"] for b in bookings if b["date"] == d}
+            booked = booked_by_date.get(d, ())
             free = [t for t in times if t not in booked]
             status = "свободно: " + ", ".join(free) if free else "все заняты"
             lines.append(f"• {format_date_ru(d)} — {status}")
@@ -857,10 +1771,10 @@ def cmd_deploy(message):
     chat_id = message.chat.id
     if not ensure_admin(chat_id):
         return
-    threading.Thread(target=run_site_rebuild, args=(chat_id,), daemon=True).start()
+    request_deploy(chat_id)
 
 
-@bot.message_handler(func=lambda m: m.text in ["Деплой", "Получить токен"])
+@on_button(*SYSTEM_BUTTONS)
 def handle_system_actions(message):
     chat_id = message.chat.id
     text = (message.text or "").strip()
@@ -868,7 +1782,7 @@ def handle_system_actions(message):
         return
 
     if text == "Деплой":
-        threading.Thread(target=run_site_rebuild, args=(chat_id,), daemon=True).start()
+        request_deploy(chat_id)
         return
 
     if text == "Получить токен":
@@ -904,19 +1818,19 @@ def parse_date_time(text: str):
     text = text.strip()
 
     # 3) Старый формат: 2026-02-10 10:00
-    m = re.match(r"^(\d{4}-\d{2}-\d{2})\s+(\d{2}:\d{2})$", text)
+    m = _match_iso_date_time(text)
     if m:
         return m.group(1), m.group(2)
 
     # 2) ДД.ММ.ГГГГ 10.02.2026 10:00
-    m = re.match(r"^(\d{2})[.\-](\d{2})[.\-](\d{4})\s+(\d{2}:\d{2})$", text)
+    m = _match_dmy_time(text)
     if m:
         d, mth, y, t = m.groups()
         date_str = f"{y}-{mth}-{d}"
         return date_str, t
 
     # 1) ДД.ММ 10.02 10:00 -> текущий год
-    m = re.match(r"^(\d{2})[.\-](\d{2})\s+(\d{2}:\d{2})$", text)
+    m = _match_dm_time(text)
     if m:
         d, mth, t = m.groups()
         y = date.today().year
@@ -934,20 +1848,18 @@ def parse_date_range(text: str):
     2) ДД.ММ.ГГГГ ЧЧ:ММ ЧЧ:ММ     -> указанный год
     3) ГГГГ-ММ-ДД ЧЧ:ММ ЧЧ:ММ     -> ISO-формат
     """
-    parts = text.strip().split()
+    parts = text.split()
     if len(parts) < 3:
         return None, None, None
 
     date_part, start_part, end_part = parts[0], parts[1], parts[2]
 
+    # Дату разбираем один раз, у конца слота проверяем только время
     start_date, start_time = parse_date_time(f"{date_part} {start_part}")
-    end_date, end_time = parse_date_time(f"{date_part} {end_part}")
-
-    if not start_date or not start_time or not end_date or not end_time:
+    if not start_date or not start_time or not _match_time(end_part):
         return None, None, None
 
-    # на всякий случай, если форматы даты различились, берём дату старта
-    return start_date, start_time, end_time
+    return start_date, start_time, end_part
 
 
 def handle_add_slot(chat_id: int, text: str):
@@ -962,17 +1874,18 @@ def handle_add_slot(chat_id: int, text: str):
         )
         return
 
-    slots = read_slots()
-    day_slots = slots.get(date_str, [])
+    slots = read_slots_for_update()
+    day_slots = slots.setdefault(date_str, [])
 
-    if time_start in day_slots:
+    # Пока храним только время начала слота — сайт показывает именно его.
+    # Список времён на дату уже отсортирован (ЧЧ:ММ сортируются как строки),
+    # поэтому и проверка на дубль, и вставка — бинарным поиском.
+    i = bisect.bisect_left(day_slots, time_start)
+    if i < len(day_slots) and day_slots[i] == time_start:
         bot.send_message(chat_id, f"Слот {format_date_ru(date_str)} в {time_start} уже есть в списке.")
         return
 
-    # Пока храним только время начала слота — сайт показывает именно его.
-    day_slots.append(time_start)
-    day_slots = sorted(set(day_slots))
-    slots[date_str] = day_slots
+    day_slots.insert(i, time_start)
     write_slots(slots)
 
     bot.send_message(
@@ -981,7 +1894,28 @@ def handle_add_slot(chat_id: int, text: str):
         f"(в расписании сайта используется время начала: {time_start})",
         reply_markup=make_main_keyboard(),
     )
-    chat_state[chat_id] = None
+    clear_state(chat_id)
+
+
+def _remove_slot_time(slots: Dict[str, list], date_str: str, time: str) -> bool:
+    """
+    Убирает время из слотов на дату (дату без слотов — целиком). False, если такого слота нет.
+    """
+    times = slots.get(date_str)
+    if not times:
+        return False
+    i = bisect.bisect_left(times, time)
+    if i < len(times) and times[i] == time:
+        del times[i]
+    else:
+        # Список могли отредактировать вручную не по порядку — ищем перебором
+        try:
+            times.remove(time)
+        except ValueError:
+            return False
+    if not times:
+        del slots[date_str]
+    return True
 
 
 def handle_delete_slot(chat_id: int, text: str):
@@ -999,15 +1933,24 @@ def handle_delete_slot(chat_id: int, text: str):
     delete_slot_and_notify(chat_id, date_str, time)
 
 
+def _client_lines(bookings) -> list:
+    """
+    Строки «• имя, телефон: …» для списка записей (сообщения без parse_mode).
+    """
+    return [
+        f"• {b.get('name') or 'Без имени'}, телефон: {b.get('phone') or 'без телефона'}"
+        for b in bookings
+    ]
+
+
 def delete_slot_and_notify(chat_id: int, date_str: str, time: str):
-    slots = read_slots()
+    slots = read_slots_for_update()
     if date_str not in slots or time not in slots[date_str]:
         bot.send_message(chat_id, f"Слота {format_date_ru(date_str)} в {time} не найдено.")
         return
 
     # Проверяем, есть ли записи на этот слот
-    bookings = read_bookings()
-    affected = [b for b in bookings if b.get("date") == date_str and b.get("time") == time]
+    affected = bookings_index().by_slot.get((date_str, time))
 
     # Если есть записи, сначала спрашиваем подтверждение, а не удаляем сразу
     if affected:
@@ -1016,10 +1959,7 @@ def delete_slot_and_notify(chat_id: int, date_str: str, time: str):
             "",
             "Клиенты:",
         ]
-        for b in affected:
-            name = b.get("name") or "Без имени"
-            phone = b.get("phone") or "без телефона"
-            lines.append(f"• {name}, телефон: {phone}")
+        lines += _client_lines(affected)
         lines.append("")
         lines.append("Вы действительно хотите удалить этот слот?")
 
@@ -1040,38 +1980,22 @@ def delete_slot_and_notify(chat_id: int, date_str: str, time: str):
         bot.send_message(chat_id, "\n".join(lines), reply_markup=kb)
         return
 
-    # Удаляем слот
-    new_times = [t for t in slots[date_str] if t != time]
-    if new_times:
-        slots[date_str] = new_times
-    else:
-        del slots[date_str]
+    # Записей нет — удаляем слот сразу
+    _remove_slot_time(slots, date_str, time)
     write_slots(slots)
+    bot.send_message(
+        chat_id,
+        f"🗑 Слот удалён: {format_date_ru(date_str)} в {time}",
+        reply_markup=make_main_keyboard(),
+    )
 
-    if affected:
-        lines = [
-            f"⚠ Слот удалён: {format_date_ru(date_str)} в {time}.",
-            "",
-            "На этот слот уже были записи. Необходимо уведомить клиентов:",
-        ]
-        for b in affected:
-            name = b.get("name") or "Без имени"
-            phone = b.get("phone") or "без телефона"
-            lines.append(f"• {name}, телефон: {phone}")
-        bot.send_message(chat_id, "\n".join(lines), reply_markup=make_main_keyboard())
-    else:
-        bot.send_message(
-            chat_id,
-            f"🗑 Слот удалён: {format_date_ru(date_str)} в {time}",
-            reply_markup=make_main_keyboard(),
-        )
-
-    chat_state[chat_id] = None
+    clear_state(chat_id)
 
 
-@bot.message_handler(func=lambda m: m.text in ["Показать слоты", "Добавить слот", "Удалить слот", "Отменить запись"])
+@on_button(*SCHEDULE_BUTTONS)
 def handle_buttons(message):
     chat_id = message.chat.id
+    ctx = get_ctx(chat_id)
     text = (message.text or "").strip()
 
     if text == "Показать слоты":
@@ -1079,15 +2003,16 @@ def handle_buttons(message):
         slots = read_slots()
         if not slots:
             bot.send_message(chat_id, "Слотов пока нет.", reply_markup=make_main_keyboard())
-            chat_state[chat_id] = None
+            clear_state(chat_id)
             return
         lines = ["📋 Слоты по датам:\n"]
-        bookings = read_bookings()
+        booked_by_date = bookings_index().by_date
         for d in sorted(slots.keys()):
             times = slots[d]
-            booked = {b["time"] for b in bookings if b.get("date") == d}
-            free = [t for t in times if t not in booked]
-            taken = [t for t in times if t in booked]
+            booked = booked_by_date.get(d, ())
+            free, taken = [], []
+            for t in times:
+                (taken if t in booked else free).append(t)
 
             lines.append(f"📅 {format_date_ru(d)}")
             if free:
@@ -1096,11 +2021,11 @@ def handle_buttons(message):
                 lines.append("Занято: " + ", ".join(taken))
             lines.append("")  # пустая строка между датами
         bot.send_message(chat_id, "\n".join(lines), reply_markup=make_main_keyboard())
-        chat_state[chat_id] = None
+        clear_state(chat_id)
         return
 
     if text == "Добавить слот":
-        chat_state[chat_id] = "add_slot"
+        ctx.state = "add_slot"
         bot.send_message(
             chat_id,
             "Отправьте дату и *начало и конец* слота в формате:\n"
@@ -1134,27 +2059,84 @@ def handle_buttons(message):
             )
             return
 
-        kb = types.InlineKeyboardMarkup()
-        for d in available_dates:
-            kb.add(
-                types.InlineKeyboardButton(
-                    text=format_date_ru(d),
-                    callback_data=f"del_date:{d}",
-                )
-            )
+        kb = types.InlineKeyboardMarkup(keyboard=[
+            [types.InlineKeyboardButton(text=format_date_ru(d), callback_data=f"del_date:{d}")]
+            for d in available_dates
+        ])
 
         bot.send_message(
             chat_id,
             "Выберите дату, для которой нужно удалить слот:",
             reply_markup=kb,
         )
-        chat_state[chat_id] = None
+        clear_state(chat_id)
         return
 
+    if text == "Отменить запись":
+        # Выбор даты, на которую есть записи
+        bookings = read_bookings()
+        if not bookings:
+            bot.send_message(
+                chat_id,
+                "Пока нет ни одной записи — отменять нечего 🙂",
+                reply_markup=make_main_keyboard(),
+            )
+            return
+
+        today_str = date.today().isoformat()
+        # Даты в индексе уже идут по возрастанию: прошедшие отрезаем бинарным поиском
+        all_dates = list(bookings_index(bookings).by_date)
+        dates_with_bookings = all_dates[bisect.bisect_left(all_dates, today_str):]
+
+        if not dates_with_bookings:
+            bot.send_message(
+                chat_id,
+                "Нет будущих дат с записями для отмены.",
+                reply_markup=make_main_keyboard(),
+            )
+            return
+
+        kb = types.InlineKeyboardMarkup(keyboard=[
+            [types.InlineKeyboardButton(text=format_date_ru(d), callback_data=f"cancel_date:{d}")]
+            for d in dates_with_bookings
+        ])
+
+        bot.send_message(
+            chat_id,
+            "Выберите дату, для которой хотите отменить запись:",
+            reply_markup=kb,
+        )
+        clear_state(chat_id)
+        return
+
+
+_MSG_BLOG_MENU = (
+    "Раздел «Управление блогом».\n\n"
+    "Раздел позволяет добавлять, удалять и редактировать посты,\n"
+    "а также управлять файлами (фото/видео) в папке `public`.\n\n"
+    "• «Добавить пост» — новый markdown‑файл в `content/posts`\n"
+    "• «Удалить пост» — удалить выбранный пост\n"
+    "• «Редактировать пост» — изменить содержимое файла\n"
+    "• «Управление файлами» — посмотреть и скачать файлы из `public`.\n\n"
+    "Для добавления поста: нажмите «Добавить пост», затем отправьте текст в формате markdown — "
+    "как в примере файла return-to-yoga-after-illness.md (шапка `---` с полями и текст ниже)."
+)
+
+_MSG_YOGA_MENU = (
+    "Раздел «Управление уроками».\n\n"
+    "Здесь можно управлять пакетами видеоуроков йоги:\n\n"
+    "• «Показать пакеты» — список всех пакетов\n"
+    "• «Добавить пакет» — создать новый пакет\n"
+    "• «Удалить пакет» — удалить пакет\n"
+    "• «Добавить видео в пакет» — добавить видеоурок\n"
+    "• «Удалить видео из пакета» — убрать урок из пакета"
+)
+
 
-@bot.message_handler(func=lambda m: m.text in ["Управление расписанием", "Управление блогом", "Управление уроками", "Системные функции", "⬅️ В главное меню"])
+@on_button(*MAIN_MENU_BUTTONS)
 def handle_main_menus(message):
     chat_id = message.chat.id
+    ctx = get_ctx(chat_id)
     text = (message.text or "").strip()
 
     if text == "Управление расписанием":
@@ -1166,33 +2148,19 @@ def handle_main_menus(message):
         return
 
     if text == "Управление блогом":
-        chat_state[chat_id] = None
+        clear_state(chat_id)
         bot.send_message(
             chat_id,
-            "Раздел «Управление блогом».\n\n"
-            "Раздел позволяет добавлять, удалять и редактировать посты,\n"
-            "а также управлять файлами (фото/видео) в папке `public`.\n\n"
-            "• «Добавить пост» — новый markdown‑файл в `content/posts`\n"
-            "• «Удалить пост» — удалить выбранный пост\n"
-            "• «Редактировать пост» — изменить содержимое файла\n"
-            "• «Управление файлами» — посмотреть и скачать файлы из `public`.\n\n"
-            "Для добавления поста: нажмите «Добавить пост», затем отправьте текст в формате markdown — "
-            "как в примере файла return-to-yoga-after-illness.md (шапка `---` с полями и текст ниже).",
+            _MSG_BLOG_MENU,
             reply_markup=make_blog_keyboard(),
         )
         return
 
     if text == "Управление уроками":
-        chat_state[chat_id] = None
+        clear_state(chat_id)
         bot.send_message(
             chat_id,
-            "Раздел «Управление уроками».\n\n"
-            "Здесь можно управлять пакетами видеоуроков йоги:\n\n"
-            "• «Показать пакеты» — список всех пакетов\n"
-            "• «Добавить пакет» — создать новый пакет\n"
-            "• «Удалить пакет» — удалить пакет\n"
-            "• «Добавить видео в пакет» — добавить видеоурок\n"
-            "• «Удалить видео из пакета» — убрать урок из пакета",
+            _MSG_YOGA_MENU,
             reply_markup=make_yoga_keyboard(),
         )
         return
@@ -1200,7 +2168,7 @@ def handle_main_menus(message):
     if text == "Системные функции":
         if not ensure_admin(chat_id):
             return
-        chat_state[chat_id] = None
+        clear_state(chat_id)
         bot.send_message(
             chat_id,
             "Раздел «Системные функции». Выберите действие:",
@@ -1216,165 +2184,143 @@ def handle_main_menus(message):
         )
         return
 
-    if text == "Отменить запись":
-        # Выбор даты, на которую есть записи
-        bookings = read_bookings()
-        if not bookings:
-            bot.send_message(
-                chat_id,
-                "Пока нет ни одной записи — отменять нечего 🙂",
-                reply_markup=make_main_keyboard(),
-            )
-            return
-
-        today_str = date.today().isoformat()
-        dates_with_bookings = sorted(
-            {b["date"] for b in bookings if b.get("date", "") >= today_str}
-        )
-
-        if not dates_with_bookings:
-            bot.send_message(
-                chat_id,
-                "Нет будущих дат с записями для отмены.",
-                reply_markup=make_main_keyboard(),
-            )
-            return
 
-        kb = types.InlineKeyboardMarkup()
-        for d in dates_with_bookings:
-            kb.add(
-                types.InlineKeyboardButton(
-                    text=format_date_ru(d),
-                    callback_data=f"cancel_date:{d}",
-                )
-            )
+_MSG_ADD_POST_HELP = (
+    "Отправьте *одним сообщением* полный текст поста в формате markdown.\n\n"
+    "После отправки я сохраню его как новый файл в `content/posts/` и спрошу, нужно ли добавить превью‑изображение.\n\n"
+    "━━━━━━━━━━━━━━━━━━━━\n"
+    "*Справка по полям (YAML в шапке между ---)*\n\n"
+    "*Обязательные:*\n"
+    "• *title* — заголовок поста (в кавычках)\n"
+    "• *date* — дата в формате ГГГГ-ММ-ДД, например 2026-02-03\n"
+    "• *category* — категория, например «Йога», «Путешествия»\n"
+    "• *excerpt* — короткое описание поста (отображается в списке и в шапке статьи)\n\n"
+    "*Необязательные:*\n"
+    "• *emoji* — иконка к посту, например 🧘‍♀️ или 🏔\n"
+    "• *previewImage* — URL картинки для превью в списке постов и в шапке (обычно заполняется автоматически после публикации, когда вы загружаете превью через бота)\n"
+    "• *image* — основное изображение поста (URL)\n"
+    "• *video* — ссылка на видео (YouTube, Vimeo, RuTube или прямой URL); показывается в начале поста\n"
+    "• *telegram* — ссылка на пост в Telegram для встраивания\n\n"
+    "Текст под второй строкой `---` — это тело поста (markdown: заголовки, списки, картинки, ссылки)."
+)
 
-        bot.send_message(
-            chat_id,
-            "Выберите дату, для которой хотите отменить запись:",
-            reply_markup=kb,
-        )
-        chat_state[chat_id] = None
-        return
+_MSG_ADD_POST_EXAMPLE = (
+    "Пример markdown‑поста:\n"
+    "```md\n"
+    "---\n"
+    "title: \"Заголовок поста\"\n"
+    "date: \"2026-02-03\"\n"
+    "category: \"Йога\"\n"
+    "excerpt: \"Короткое описание\"\n"
+    "emoji: \"🧘‍♀️\"\n"
+    "---\n"
+    "\n"
+    "Текст поста в формате markdown...\n"
+    "\n"
+    "![Фото с Яндекс Диска](ПРЯМАЯ_ССЫЛКА_С_КНОПКИ_«СКАЧАТЬ»)\n"
+    "\n"
+    "![Фото из папки photos](/photos/primer.jpg)\n"
+    "```"
+)
 
 
-@bot.message_handler(func=lambda m: m.text == "Добавить пост")
+@on_button("Добавить пост")
 def handle_add_post_start(message):
     chat_id = message.chat.id
-    chat_state[chat_id] = "add_post"
-
-    help_text = (
-        "Отправьте *одним сообщением* полный текст поста в формате markdown.\n\n"
-        "После отправки я сохраню его как новый файл в `content/posts/` и спрошу, нужно ли добавить превью‑изображение.\n\n"
-        "━━━━━━━━━━━━━━━━━━━━\n"
-        "*Справка по полям (YAML в шапке между ---)*\n\n"
-        "*Обязательные:*\n"
-        "• *title* — заголовок поста (в кавычках)\n"
-        "• *date* — дата в формате ГГГГ-ММ-ДД, например 2026-02-03\n"
-        "• *category* — категория, например «Йога», «Путешествия»\n"
-        "• *excerpt* — короткое описание поста (отображается в списке и в шапке статьи)\n\n"
-        "*Необязательные:*\n"
-        "• *emoji* — иконка к посту, например 🧘‍♀️ или 🏔\n"
-        "• *previewImage* — URL картинки для превью в списке постов и в шапке (обычно заполняется автоматически после публикации, когда вы загружаете превью через бота)\n"
-        "• *image* — основное изображение поста (URL)\n"
-        "• *video* — ссылка на видео (YouTube, Vimeo, RuTube или прямой URL); показывается в начале поста\n"
-        "• *telegram* — ссылка на пост в Telegram для встраивания\n\n"
-        "Текст под второй строкой `---` — это тело поста (markdown: заголовки, списки, картинки, ссылки)."
-    )
-
-    example_text = (
-        "Пример markdown‑поста:\n"
-        "```md\n"
-        "---\n"
-        "title: \"Заголовок поста\"\n"
-        "date: \"2026-02-03\"\n"
-        "category: \"Йога\"\n"
-        "excerpt: \"Короткое описание\"\n"
-        "emoji: \"🧘‍♀️\"\n"
-        "---\n"
-        "\n"
-        "Текст поста в формате markdown...\n"
-        "\n"
-        "![Фото с Яндекс Диска](ПРЯМАЯ_ССЫЛКА_С_КНОПКИ_«СКАЧАТЬ»)\n"
-        "\n"
-        "![Фото из папки photos](/photos/primer.jpg)\n"
-        "```"
-    )
+    get_ctx(chat_id).state = "add_post"
 
     bot.send_message(
         chat_id,
-        help_text,
+        _MSG_ADD_POST_HELP,
         parse_mode="Markdown",
     )
     bot.send_message(
         chat_id,
-        example_text,
+        _MSG_ADD_POST_EXAMPLE,
         parse_mode="Markdown",
     )
 
 
-@bot.message_handler(func=lambda m: m.text == "Удалить пост")
+@on_button("Удалить пост")
 def handle_delete_post_start(message):
     chat_id = message.chat.id
-    chat_state[chat_id] = None
+    clear_state(chat_id)
     send_posts_page(chat_id, page=0)
 
 
-@bot.message_handler(func=lambda m: m.text == "Редактировать пост")
+@on_button("Редактировать пост")
 def handle_edit_post_start(message):
     chat_id = message.chat.id
-    chat_state[chat_id] = None
+    clear_state(chat_id)
     send_edit_posts_page(chat_id, page=0)
 
 
-@bot.message_handler(func=lambda m: m.text == "Управление файлами")
+@on_button("Управление файлами")
 def handle_manage_files_start(message):
     chat_id = message.chat.id
-    chat_state[chat_id] = None
+    clear_state(chat_id)
     send_media_dirs(chat_id)
 
 
 # ─── УПРАВЛЕНИЕ ПАКЕТАМИ ВИДЕОУРОКОВ ───────────────────────────────
 
+# Повторяющиеся ответы раздела пакетов — одна строка на модуль вместо копий по обработчикам
+_MSG_PKG_NOT_FOUND = "Пакет не найден."
+_MSG_EMPTY_TITLE = "Название не может быть пустым. Введите новое название:"
+_MSG_BAD_PRICE = "Введите корректную цену (целое число >= 0):"
+_MSG_ASK_VIDEO_FILE = (
+    "Шаг 4/4: Отправьте *видеофайл*.\n\n"
+    "• Отправьте видео или документ — файл сохранится в `public/videos/`\n"
+    "• Или отправьте текстом ссылку на видео (URL)"
+)
+
 
-def send_packages_list(chat_id: int, prefix: str, prompt: str, page: int = 0):
+def send_packages_list(
+    chat_id: int,
+    prefix: str,
+    prompt: str,
+    page: int = 0,
+    call: Optional[types.CallbackQuery] = None,
+):
     """
     Отправляет пагинированный список пакетов с inline‑кнопками.
     prefix — для callback_data, напр. 'delpkg', 'addvid', 'delvid'.
+    call — нажатие кнопки листания: тогда список меняется в том же сообщении.
     """
-    packages = read_packages()
-    if not packages:
+    if page < 0:
+        page = 0
+    start = page * PAGE_SIZE_PKGS
+    page_pkgs, total = read_packages_slice(start, start + PAGE_SIZE_PKGS)
+    if not total:
         bot.send_message(
             chat_id,
             "Пакетов пока нет.",
             reply_markup=make_yoga_keyboard(),
         )
         return
-
-    total = len(packages)
-    max_page = (total - 1) // PAGE_SIZE_PKGS
-    if page < 0:
-        page = 0
-    if page > max_page:
-        page = max_page
-
-    start = page * PAGE_SIZE_PKGS
-    end = min(start + PAGE_SIZE_PKGS, total)
-
-    kb = types.InlineKeyboardMarkup()
-    for pkg in packages[start:end]:
+    if not page_pkgs:
+        # Страница пропала (пакеты удалили, а кнопка осталась) — показываем последнюю
+        page = (total - 1) // PAGE_SIZE_PKGS
+        start = page * PAGE_SIZE_PKGS
+        page_pkgs, total = read_packages_slice(start, start + PAGE_SIZE_PKGS)
+    end = start + len(page_pkgs)
+
+    # Строки кнопок собираем списком и отдаём разметке целиком, без kb.add на каждую
+    rows = []
+    for pkg in page_pkgs:
         name = pkg.get("name", pkg["id"])
         level = pkg.get("level", "")
         vids = len(pkg.get("videos", []))
         label = f"{name} ({level}, {vids} видео)"
         if len(label) > 55:
             label = label[:52] + "..."
-        kb.add(
+        rows.append([
             types.InlineKeyboardButton(
                 text=label,
                 callback_data=f"{prefix}:{pkg['id']}:{page}",
             )
-        )
+        ])
+    kb = types.InlineKeyboardMarkup(keyboard=rows)
 
     nav_row = []
     if page > 0:
@@ -1401,13 +2347,16 @@ def send_packages_list(chat_id: int, prefix: str, prompt: str, page: int = 0):
         )
     )
 
-    bot.send_message(chat_id, prompt, reply_markup=kb)
+    if call is not None:
+        edit_or_send(call, prompt, reply_markup=kb)
+    else:
+        bot.send_message(chat_id, prompt, reply_markup=kb)
 
 
-@bot.message_handler(func=lambda m: m.text == "Показать пакеты")
+@on_button("Показать пакеты")
 def handle_show_packages(message):
     chat_id = message.chat.id
-    chat_state[chat_id] = None
+    clear_state(chat_id)
     packages = read_packages()
     if not packages:
         bot.send_message(
@@ -1425,12 +2374,13 @@ def handle_show_packages(message):
         price_str = f"{price} ₽" if price > 0 else "Бесплатно"
         vids = pkg.get("videos", [])
         available = "✅" if pkg.get("available", True) else "❌"
-        lines.append(f"{available} *{name}*")
-        lines.append(f"   Уровень: {level} | Цена: {price_str} | Видео: {len(vids)}")
+        # Названия вводятся админом и могут содержать _ * ` — в HTML их достаточно экранировать
+        lines.append(f"{available} <b>{html.escape(str(name))}</b>")
+        lines.append(f"   Уровень: {html.escape(str(level))} | Цена: {price_str} | Видео: {len(vids)}")
         if vids:
             for i, v in enumerate(vids, 1):
-                title = v.get("title", "Без названия")
-                dur = v.get("duration", "")
+                title = html.escape(str(v.get("title", "Без названия")))
+                dur = html.escape(str(v.get("duration", "")))
                 has_url = "🎬" if v.get("videoUrl") else "📝"
                 lines.append(f"   {i}. {has_url} {title} ({dur})")
         lines.append("")
@@ -1438,16 +2388,17 @@ def handle_show_packages(message):
     bot.send_message(
         chat_id,
         "\n".join(lines),
-        parse_mode="Markdown",
+        parse_mode="HTML",
         reply_markup=make_yoga_keyboard(),
     )
 
 
-@bot.message_handler(func=lambda m: m.text == "Добавить пакет")
+@on_button("Добавить пакет")
 def handle_add_package_start(message):
     chat_id = message.chat.id
-    chat_state[chat_id] = "add_pkg_name"
-    chat_pkg_draft[chat_id] = {}
+    ctx = get_ctx(chat_id)
+    ctx.state = "add_pkg_name"
+    ctx.pkg_draft = {}
     bot.send_message(
         chat_id,
         "Создание нового пакета.\n\n"
@@ -1457,38 +2408,38 @@ def handle_add_package_start(message):
     )
 
 
-@bot.message_handler(func=lambda m: m.text == "Удалить пакет")
+@on_button("Удалить пакет")
 def handle_delete_package_start(message):
     chat_id = message.chat.id
-    chat_state[chat_id] = None
+    clear_state(chat_id)
     send_packages_list(chat_id, "delpkg", "Выберите пакет для удаления:")
 
 
-@bot.message_handler(func=lambda m: m.text == "Добавить видео в пакет")
+@on_button("Добавить видео в пакет")
 def handle_add_video_start(message):
     chat_id = message.chat.id
-    chat_state[chat_id] = None
+    clear_state(chat_id)
     send_packages_list(chat_id, "addvid", "Выберите пакет, в который нужно добавить видео:")
 
 
-@bot.message_handler(func=lambda m: m.text == "Редактировать пакет")
+@on_button("Редактировать пакет")
 def handle_edit_package_start(message):
     chat_id = message.chat.id
-    chat_state[chat_id] = None
+    clear_state(chat_id)
     send_packages_list(chat_id, "editpkg", "Выберите пакет для редактирования:")
 
 
-@bot.message_handler(func=lambda m: m.text == "Удалить видео из пакета")
+@on_button("Удалить видео из пакета")
 def handle_delete_video_start(message):
     chat_id = message.chat.id
-    chat_state[chat_id] = None
+    clear_state(chat_id)
     send_packages_list(chat_id, "delvid", "Выберите пакет, из которого нужно удалить видео:")
 
 
 # ─── Callback‑обработчики пакетов ──────────────────────────────────
 
 # Пагинация списка пакетов (все три префикса)
-@bot.callback_query_handler(func=lambda c: c.data and c.data.split("_page:")[0] in ["delpkg", "addvid", "delvid", "editpkg"])
+@on_callback(*(f"{p}_page" for p in PKG_LIST_PREFIXES))
 def handle_pkg_list_page(call: types.CallbackQuery):
     chat_id = call.message.chat.id
     prefix, page_str = call.data.split("_page:", 1)
@@ -1505,11 +2456,11 @@ def handle_pkg_list_page(call: types.CallbackQuery):
         "editpkg": "Выберите пакет для редактирования:",
     }
     bot.answer_callback_query(call.id)
-    send_packages_list(chat_id, prefix, prompts.get(prefix, "Выберите пакет:"), page)
+    send_packages_list(chat_id, prefix, prompts.get(prefix, "Выберите пакет:"), page, call=call)
 
 
 # Отмена выбора пакета
-@bot.callback_query_handler(func=lambda c: c.data and c.data.split("_cancel")[0] in ["delpkg", "addvid", "delvid", "editpkg"])
+@on_callback(*(f"{p}_cancel" for p in PKG_LIST_PREFIXES))
 def handle_pkg_cancel(call: types.CallbackQuery):
     chat_id = call.message.chat.id
     bot.answer_callback_query(call.id, "Отмена.")
@@ -1522,20 +2473,18 @@ def handle_pkg_cancel(call: types.CallbackQuery):
 
 # ── Удаление пакета ──
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("delpkg:"))
+@on_callback("delpkg")
 def handle_delete_package_select(call: types.CallbackQuery):
     chat_id = call.message.chat.id
-    try:
-        _, payload = call.data.split(":", 1)
-        pkg_id, page_str = payload.rsplit(":", 1)
-    except Exception:
+    pkg_id, sep, page_str = call.data.partition(":")[2].rpartition(":")
+    if not sep:
         bot.answer_callback_query(call.id, "Ошибка.")
         return
 
     packages = read_packages()
-    pkg = next((p for p in packages if p["id"] == pkg_id), None)
+    pkg = get_package(pkg_id, packages)
     if not pkg:
-        bot.answer_callback_query(call.id, "Пакет не найден.")
+        bot.answer_callback_query(call.id, _MSG_PKG_NOT_FOUND)
         return
 
     name = pkg.get("name", pkg_id)
@@ -1564,46 +2513,53 @@ def handle_delete_package_select(call: types.CallbackQuery):
     )
 
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("confirm_delpkg:"))
-def handle_confirm_delete_package(call: types.CallbackQuery):
-    chat_id = call.message.chat.id
-    _, pkg_id = call.data.split(":", 1)
-
-    packages = read_packages()
-    pkg = next((p for p in packages if p["id"] == pkg_id), None)
-    if not pkg:
+def _unlink_public(web_path: str) -> bool:
+    """
+    Удаляет файл public/ по веб‑пути ('/videos/a.mp4'). True — если файл был удалён.
+    """
+    try:
+        (PUBLIC_DIR / web_path.lstrip("/")).unlink()
+        return True
+    except FileNotFoundError:
+        return False
+    except OSError as e:
+        print(f"Не удалось удалить {web_path}: {e}")
+        return False
+
+
+@on_callback("confirm_delpkg")
+def handle_confirm_delete_package(call: types.CallbackQuery):
+    chat_id = call.message.chat.id
+    pkg_id = call.data.partition(":")[2]
+
+    packages = read_packages_for_update()
+    pkg = get_package(pkg_id, packages)
+    if not pkg:
         bot.answer_callback_query(call.id, "Пакет уже удалён.")
         bot.send_message(chat_id, "Пакет уже не существует.", reply_markup=make_yoga_keyboard())
         return
 
     name = pkg.get("name", pkg_id)
 
-    # Удаляем файл превью из notgallery
-    deleted_files = []
-    image = pkg.get("image", "")
-    if image and image.startswith("/notgallery/"):
-        img_path = PUBLIC_DIR / image.lstrip("/")
-        if img_path.exists():
-            try:
-                img_path.unlink()
-                deleted_files.append(f"превью {img_path.name}")
-            except Exception:
-                pass
+    # Сначала убираем пакет из packages.json, чтобы сайт перестал ссылаться на файлы
+    packages = [p for p in packages if p["id"] != pkg_id]
+    write_packages(packages)
 
-    # Удаляем все видеофайлы из public/videos/
+    # Превью из notgallery и видео из public/videos/; одинаковые пути удаляем один раз
+    targets: Dict[str, str] = {}
+    image = pkg.get("image", "")
+    if image.startswith("/notgallery/"):
+        targets[image] = "превью"
     for v in pkg.get("videos", []):
         video_url = v.get("videoUrl", "")
         if video_url.startswith("/videos/"):
-            video_path = PUBLIC_DIR / video_url.lstrip("/")
-            if video_path.exists():
-                try:
-                    video_path.unlink()
-                    deleted_files.append(f"видео {video_path.name}")
-                except Exception:
-                    pass
+            targets.setdefault(video_url, "видео")
 
-    packages = [p for p in packages if p["id"] != pkg_id]
-    write_packages(packages)
+    deleted_files = [
+        f"{kind} {Path(web_path).name}"
+        for web_path, kind in targets.items()
+        if _unlink_public(web_path)
+    ]
 
     files_note = ""
     if deleted_files:
@@ -1619,25 +2575,24 @@ def handle_confirm_delete_package(call: types.CallbackQuery):
 
 # ── Добавление видео в пакет ──
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("addvid:"))
+@on_callback("addvid")
 def handle_add_video_select_package(call: types.CallbackQuery):
     chat_id = call.message.chat.id
-    try:
-        _, payload = call.data.split(":", 1)
-        pkg_id, page_str = payload.rsplit(":", 1)
-    except Exception:
+    ctx = get_ctx(chat_id)
+    pkg_id, sep, page_str = call.data.partition(":")[2].rpartition(":")
+    if not sep:
         bot.answer_callback_query(call.id, "Ошибка.")
         return
 
     packages = read_packages()
-    pkg = next((p for p in packages if p["id"] == pkg_id), None)
+    pkg = get_package(pkg_id, packages)
     if not pkg:
-        bot.answer_callback_query(call.id, "Пакет не найден.")
+        bot.answer_callback_query(call.id, _MSG_PKG_NOT_FOUND)
         return
 
-    chat_pkg_target[chat_id] = pkg_id
-    chat_video_draft[chat_id] = {}
-    chat_state[chat_id] = "add_video_title"
+    ctx.pkg_target = pkg_id
+    ctx.video_draft = {}
+    ctx.state = "add_video_title"
 
     name = pkg.get("name", pkg_id)
     bot.answer_callback_query(call.id)
@@ -1652,20 +2607,18 @@ def handle_add_video_select_package(call: types.CallbackQuery):
 
 # ── Удаление видео из пакета ──
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("delvid:"))
+@on_callback("delvid")
 def handle_delete_video_select_package(call: types.CallbackQuery):
     chat_id = call.message.chat.id
-    try:
-        _, payload = call.data.split(":", 1)
-        pkg_id, page_str = payload.rsplit(":", 1)
-    except Exception:
+    pkg_id, sep, page_str = call.data.partition(":")[2].rpartition(":")
+    if not sep:
         bot.answer_callback_query(call.id, "Ошибка.")
         return
 
     packages = read_packages()
-    pkg = next((p for p in packages if p["id"] == pkg_id), None)
+    pkg = get_package(pkg_id, packages)
     if not pkg:
-        bot.answer_callback_query(call.id, "Пакет не найден.")
+        bot.answer_callback_query(call.id, _MSG_PKG_NOT_FOUND)
         return
 
     videos = pkg.get("videos", [])
@@ -1678,19 +2631,20 @@ def handle_delete_video_select_package(call: types.CallbackQuery):
         )
         return
 
-    kb = types.InlineKeyboardMarkup()
+    rows = []
     for i, v in enumerate(videos):
         title = v.get("title", f"Видео {i+1}")
         dur = v.get("duration", "")
         label = f"{title} ({dur})" if dur else title
         if len(label) > 55:
             label = label[:52] + "..."
-        kb.add(
+        rows.append([
             types.InlineKeyboardButton(
                 text=label,
                 callback_data=f"rmvid:{pkg_id}|{i}",
             )
-        )
+        ])
+    kb = types.InlineKeyboardMarkup(keyboard=rows)
     kb.row(
         types.InlineKeyboardButton(
             text="Отмена",
@@ -1706,21 +2660,19 @@ def handle_delete_video_select_package(call: types.CallbackQuery):
     )
 
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("rmvid:"))
+@on_callback("rmvid")
 def handle_remove_video_confirm(call: types.CallbackQuery):
     chat_id = call.message.chat.id
-    try:
-        _, payload = call.data.split(":", 1)
-        pkg_id, idx_str = payload.split("|", 1)
-        idx = int(idx_str)
-    except Exception:
+    pkg_id, sep, idx_str = call.data.partition(":")[2].partition("|")
+    if not sep or not idx_str.isdecimal():
         bot.answer_callback_query(call.id, "Ошибка данных.")
         return
+    idx = int(idx_str)
 
     packages = read_packages()
-    pkg = next((p for p in packages if p["id"] == pkg_id), None)
+    pkg = get_package(pkg_id, packages)
     if not pkg:
-        bot.answer_callback_query(call.id, "Пакет не найден.")
+        bot.answer_callback_query(call.id, _MSG_PKG_NOT_FOUND)
         return
 
     videos = pkg.get("videos", [])
@@ -1753,21 +2705,19 @@ def handle_remove_video_confirm(call: types.CallbackQuery):
     )
 
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("confirm_rmvid:"))
+@on_callback("confirm_rmvid")
 def handle_confirm_remove_video(call: types.CallbackQuery):
     chat_id = call.message.chat.id
-    try:
-        _, payload = call.data.split(":", 1)
-        pkg_id, idx_str = payload.split("|", 1)
-        idx = int(idx_str)
-    except Exception:
+    pkg_id, sep, idx_str = call.data.partition(":")[2].partition("|")
+    if not sep or not idx_str.isdecimal():
         bot.answer_callback_query(call.id, "Ошибка данных.")
         return
+    idx = int(idx_str)
 
-    packages = read_packages()
-    pkg = next((p for p in packages if p["id"] == pkg_id), None)
+    packages = read_packages_for_update()
+    pkg = get_package(pkg_id, packages)
     if not pkg:
-        bot.answer_callback_query(call.id, "Пакет не найден.")
+        bot.answer_callback_query(call.id, _MSG_PKG_NOT_FOUND)
         bot.send_message(chat_id, "Пакет уже не существует.", reply_markup=make_yoga_keyboard())
         return
 
@@ -1786,13 +2736,7 @@ def handle_confirm_remove_video(call: types.CallbackQuery):
     video_url = removed.get("videoUrl", "")
     file_deleted = False
     if video_url.startswith("/videos/"):
-        video_path = PUBLIC_DIR / video_url.lstrip("/")
-        if video_path.exists():
-            try:
-                video_path.unlink()
-                file_deleted = True
-            except Exception:
-                pass
+        file_deleted = _unlink_public(video_url)
 
     file_note = "\n📁 Файл видео удалён с сервера." if file_deleted else ""
     bot.answer_callback_query(call.id, "Видео удалено.")
@@ -1805,18 +2749,19 @@ def handle_confirm_remove_video(call: types.CallbackQuery):
 
 # ── Выбор уровня при создании пакета (inline) ──
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("pkg_level:"))
+@on_callback("pkg_level")
 def handle_package_level_select(call: types.CallbackQuery):
     chat_id = call.message.chat.id
-    _, level = call.data.split(":", 1)
+    ctx = get_ctx(chat_id)
+    level = call.data.partition(":")[2]
 
-    draft = chat_pkg_draft.get(chat_id)
+    draft = ctx.pkg_draft
     if not draft:
         bot.answer_callback_query(call.id, "Ошибка: данные черновика потеряны.")
         return
 
     draft["level"] = level
-    chat_state[chat_id] = "add_pkg_desc"
+    ctx.state = "add_pkg_desc"
 
     bot.answer_callback_query(call.id)
     bot.send_message(
@@ -1830,14 +2775,17 @@ def handle_package_level_select(call: types.CallbackQuery):
 
 # ── Редактирование пакета ──
 
-def _send_edit_pkg_menu(chat_id: int, pkg_id: str):
+def _send_edit_pkg_menu(chat_id: int, pkg_id: str, notice: str = ""):
     """
     Показывает меню редактирования пакета: свойства + видеоуроки.
+    notice — результат предыдущего шага («✅ Цена изменена…»): идёт в то же сообщение,
+    чтобы не отправлять подтверждение отдельным запросом.
     """
     packages = read_packages()
-    pkg = next((p for p in packages if p["id"] == pkg_id), None)
+    pkg = get_package(pkg_id, packages)
     if not pkg:
-        bot.send_message(chat_id, "Пакет не найден.", reply_markup=make_yoga_keyboard())
+        text = f"{notice}\n\n{_MSG_PKG_NOT_FOUND}" if notice else _MSG_PKG_NOT_FOUND
+        bot.send_message(chat_id, text, reply_markup=make_yoga_keyboard())
         return
 
     name = pkg.get("name", pkg_id)
@@ -1850,17 +2798,18 @@ def _send_edit_pkg_menu(chat_id: int, pkg_id: str):
     videos = pkg.get("videos", [])
 
     image = pkg.get("image", "")
-    image_str = f"`{image}`" if image else "нет"
+    image_str = f"<code>{html.escape(image)}</code>" if image else "нет"
 
     # Текущая позиция пакета в списке
     pkg_idx = next((i for i, p in enumerate(packages) if p["id"] == pkg_id), 0)
     total_pkgs = len(packages)
 
-    lines = [
-        f"✏️ Редактирование пакета «{name}»\n",
-        f"📊 Уровень: {level}",
+    lines = [f"{html.escape(notice)}\n"] if notice else []
+    lines += [
+        f"✏️ Редактирование пакета «{html.escape(str(name))}»\n",
+        f"📊 Уровень: {html.escape(str(level))}",
         f"💰 Цена: {price_str}",
-        f"📝 {desc}",
+        f"📝 {html.escape(str(desc))}",
         f"🖼 Превью: {image_str}",
         f"🎬 Видеоуроков: {len(videos)}",
         f"📍 Позиция: {pkg_idx + 1} из {total_pkgs}",
@@ -1877,31 +2826,30 @@ def _send_edit_pkg_menu(chat_id: int, pkg_id: str):
         kb.add(types.InlineKeyboardButton(text="🎬 Редактировать видеоуроки", callback_data=f"epkg_vids:{pkg_id}"))
     kb.add(types.InlineKeyboardButton(text="⬅️ Назад", callback_data="editpkg_cancel"))
 
-    bot.send_message(chat_id, "\n".join(lines), reply_markup=kb)
+    bot.send_message(chat_id, "\n".join(lines), parse_mode="HTML", reply_markup=kb)
 
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("editpkg:"))
+@on_callback("editpkg")
 def handle_edit_package_select(call: types.CallbackQuery):
     chat_id = call.message.chat.id
-    try:
-        _, payload = call.data.split(":", 1)
-        pkg_id, page_str = payload.rsplit(":", 1)
-    except Exception:
+    pkg_id, sep, page_str = call.data.partition(":")[2].rpartition(":")
+    if not sep:
         bot.answer_callback_query(call.id, "Ошибка.")
         return
 
     bot.answer_callback_query(call.id)
-    chat_pkg_target[chat_id] = pkg_id
+    get_ctx(chat_id).pkg_target = pkg_id
     _send_edit_pkg_menu(chat_id, pkg_id)
 
 
 # Редактирование названия
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("epkg_name:"))
+@on_callback("epkg_name")
 def handle_edit_pkg_name(call: types.CallbackQuery):
     chat_id = call.message.chat.id
-    _, pkg_id = call.data.split(":", 1)
-    chat_pkg_target[chat_id] = pkg_id
-    chat_state[chat_id] = "edit_pkg_name"
+    ctx = get_ctx(chat_id)
+    pkg_id = call.data.partition(":")[2]
+    ctx.pkg_target = pkg_id
+    ctx.state = "edit_pkg_name"
     bot.answer_callback_query(call.id)
     bot.send_message(
         chat_id,
@@ -1912,47 +2860,52 @@ def handle_edit_pkg_name(call: types.CallbackQuery):
 
 
 # Редактирование уровня
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("epkg_level:"))
+@on_callback("epkg_level")
 def handle_edit_pkg_level(call: types.CallbackQuery):
     chat_id = call.message.chat.id
-    _, pkg_id = call.data.split(":", 1)
-    chat_pkg_target[chat_id] = pkg_id
+    pkg_id = call.data.partition(":")[2]
+    get_ctx(chat_id).pkg_target = pkg_id
 
-    kb = types.InlineKeyboardMarkup()
-    for level in ["Начинающий", "Средний", "Продвинутый", "Все уровни"]:
-        kb.add(types.InlineKeyboardButton(text=level, callback_data=f"epkg_setlvl:{pkg_id}|{level}"))
-    kb.add(types.InlineKeyboardButton(text="⬅️ Назад", callback_data=f"epkg_back:{pkg_id}"))
+    rows = [
+        [types.InlineKeyboardButton(text=level, callback_data=f"epkg_setlvl:{pkg_id}|{level}")]
+        for level in PKG_LEVELS
+    ]
+    rows.append([types.InlineKeyboardButton(text="⬅️ Назад", callback_data=f"epkg_back:{pkg_id}")])
+    kb = types.InlineKeyboardMarkup(keyboard=rows)
 
     bot.answer_callback_query(call.id)
     bot.send_message(chat_id, "Выберите новый *уровень* пакета:", parse_mode="Markdown", reply_markup=kb)
 
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("epkg_setlvl:"))
+@on_callback("epkg_setlvl")
 def handle_edit_pkg_set_level(call: types.CallbackQuery):
     chat_id = call.message.chat.id
-    _, payload = call.data.split(":", 1)
-    pkg_id, level = payload.split("|", 1)
+    pkg_id, sep, level = call.data.partition(":")[2].partition("|")
+    if not sep:
+        bot.answer_callback_query(call.id, "Ошибка данных.")
+        return
 
-    packages = read_packages()
-    pkg = next((p for p in packages if p["id"] == pkg_id), None)
+    packages = read_packages_for_update()
+    pkg = get_package(pkg_id, packages)
     if not pkg:
-        bot.answer_callback_query(call.id, "Пакет не найден.")
+        bot.answer_callback_query(call.id, _MSG_PKG_NOT_FOUND)
         return
 
-    pkg["level"] = level
-    write_packages(packages)
+    if pkg.get("level") != level:
+        pkg["level"] = level
+        write_packages(packages)
     bot.answer_callback_query(call.id, f"Уровень: {level}")
-    bot.send_message(chat_id, f"✅ Уровень изменён на «{level}».", reply_markup=make_yoga_keyboard())
-    _send_edit_pkg_menu(chat_id, pkg_id)
+    _send_edit_pkg_menu(chat_id, pkg_id, notice=f"✅ Уровень изменён на «{level}».")
 
 
 # Редактирование описания
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("epkg_desc:"))
+@on_callback("epkg_desc")
 def handle_edit_pkg_desc(call: types.CallbackQuery):
     chat_id = call.message.chat.id
-    _, pkg_id = call.data.split(":", 1)
-    chat_pkg_target[chat_id] = pkg_id
-    chat_state[chat_id] = "edit_pkg_desc"
+    ctx = get_ctx(chat_id)
+    pkg_id = call.data.partition(":")[2]
+    ctx.pkg_target = pkg_id
+    ctx.state = "edit_pkg_desc"
     bot.answer_callback_query(call.id)
     bot.send_message(
         chat_id,
@@ -1963,12 +2916,13 @@ def handle_edit_pkg_desc(call: types.CallbackQuery):
 
 
 # Редактирование цены
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("epkg_price:"))
+@on_callback("epkg_price")
 def handle_edit_pkg_price(call: types.CallbackQuery):
     chat_id = call.message.chat.id
-    _, pkg_id = call.data.split(":", 1)
-    chat_pkg_target[chat_id] = pkg_id
-    chat_state[chat_id] = "edit_pkg_price"
+    ctx = get_ctx(chat_id)
+    pkg_id = call.data.partition(":")[2]
+    ctx.pkg_target = pkg_id
+    ctx.state = "edit_pkg_price"
     bot.answer_callback_query(call.id)
     bot.send_message(
         chat_id,
@@ -1979,12 +2933,13 @@ def handle_edit_pkg_price(call: types.CallbackQuery):
 
 
 # Смена превью
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("epkg_img:"))
+@on_callback("epkg_img")
 def handle_edit_pkg_image(call: types.CallbackQuery):
     chat_id = call.message.chat.id
-    _, pkg_id = call.data.split(":", 1)
-    chat_pkg_target[chat_id] = pkg_id
-    chat_state[chat_id] = "edit_pkg_preview"
+    ctx = get_ctx(chat_id)
+    pkg_id = call.data.partition(":")[2]
+    ctx.pkg_target = pkg_id
+    ctx.state = "edit_pkg_preview"
     bot.answer_callback_query(call.id)
     bot.send_message(
         chat_id,
@@ -1997,12 +2952,13 @@ def handle_edit_pkg_image(call: types.CallbackQuery):
 
 
 # Смена позиции пакета
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("epkg_pos:"))
+@on_callback("epkg_pos")
 def handle_edit_pkg_position(call: types.CallbackQuery):
     chat_id = call.message.chat.id
-    _, pkg_id = call.data.split(":", 1)
-    chat_pkg_target[chat_id] = pkg_id
-    chat_state[chat_id] = "edit_pkg_position"
+    ctx = get_ctx(chat_id)
+    pkg_id = call.data.partition(":")[2]
+    ctx.pkg_target = pkg_id
+    ctx.state = "edit_pkg_position"
 
     packages = read_packages()
     total = len(packages)
@@ -2019,25 +2975,25 @@ def handle_edit_pkg_position(call: types.CallbackQuery):
 
 
 # Назад к меню редактирования пакета
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("epkg_back:"))
+@on_callback("epkg_back")
 def handle_edit_pkg_back(call: types.CallbackQuery):
     chat_id = call.message.chat.id
-    _, pkg_id = call.data.split(":", 1)
+    pkg_id = call.data.partition(":")[2]
     bot.answer_callback_query(call.id)
     _send_edit_pkg_menu(chat_id, pkg_id)
 
 
 # ── Редактирование видеоуроков внутри пакета ──
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("epkg_vids:"))
+@on_callback("epkg_vids")
 def handle_edit_pkg_videos_list(call: types.CallbackQuery):
     chat_id = call.message.chat.id
-    _, pkg_id = call.data.split(":", 1)
+    pkg_id = call.data.partition(":")[2]
 
     packages = read_packages()
-    pkg = next((p for p in packages if p["id"] == pkg_id), None)
+    pkg = get_package(pkg_id, packages)
     if not pkg:
-        bot.answer_callback_query(call.id, "Пакет не найден.")
+        bot.answer_callback_query(call.id, _MSG_PKG_NOT_FOUND)
         return
 
     videos = pkg.get("videos", [])
@@ -2045,31 +3001,34 @@ def handle_edit_pkg_videos_list(call: types.CallbackQuery):
         bot.answer_callback_query(call.id, "Видео нет.")
         return
 
-    kb = types.InlineKeyboardMarkup()
+    rows = []
     for i, v in enumerate(videos):
         title = v.get("title", f"Видео {i+1}")
         label = f"{i+1}. {title}"
         if len(label) > 55:
             label = label[:52] + "..."
-        kb.add(types.InlineKeyboardButton(text=label, callback_data=f"evid_sel:{pkg_id}|{i}"))
+        rows.append([types.InlineKeyboardButton(text=label, callback_data=f"evid_sel:{pkg_id}|{i}")])
 
-    kb.add(types.InlineKeyboardButton(text="⬅️ Назад к пакету", callback_data=f"epkg_back:{pkg_id}"))
+    rows.append([types.InlineKeyboardButton(text="⬅️ Назад к пакету", callback_data=f"epkg_back:{pkg_id}")])
+    kb = types.InlineKeyboardMarkup(keyboard=rows)
 
     bot.answer_callback_query(call.id)
     bot.send_message(chat_id, "Выберите видео для редактирования:", reply_markup=kb)
 
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("evid_sel:"))
+@on_callback("evid_sel")
 def handle_edit_video_select(call: types.CallbackQuery):
     chat_id = call.message.chat.id
-    _, payload = call.data.split(":", 1)
-    pkg_id, idx_str = payload.split("|", 1)
+    pkg_id, sep, idx_str = call.data.partition(":")[2].partition("|")
+    if not sep or not idx_str.isdecimal():
+        bot.answer_callback_query(call.id, "Ошибка данных.")
+        return
     idx = int(idx_str)
 
     packages = read_packages()
-    pkg = next((p for p in packages if p["id"] == pkg_id), None)
+    pkg = get_package(pkg_id, packages)
     if not pkg:
-        bot.answer_callback_query(call.id, "Пакет не найден.")
+        bot.answer_callback_query(call.id, _MSG_PKG_NOT_FOUND)
         return
 
     videos = pkg.get("videos", [])
@@ -2100,16 +3059,19 @@ def handle_edit_video_select(call: types.CallbackQuery):
 
 
 # Переименование видео
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("evid_rename:"))
+@on_callback("evid_rename")
 def handle_edit_video_rename(call: types.CallbackQuery):
     chat_id = call.message.chat.id
-    _, payload = call.data.split(":", 1)
-    pkg_id, idx_str = payload.split("|", 1)
+    ctx = get_ctx(chat_id)
+    pkg_id, sep, idx_str = call.data.partition(":")[2].partition("|")
+    if not sep or not idx_str.isdecimal():
+        bot.answer_callback_query(call.id, "Ошибка данных.")
+        return
     idx = int(idx_str)
 
-    chat_pkg_target[chat_id] = pkg_id
-    chat_edit_vid_idx[chat_id] = idx
-    chat_state[chat_id] = "edit_vid_title"
+    ctx.pkg_target = pkg_id
+    ctx.edit_vid_idx = idx
+    ctx.state = "edit_vid_title"
 
     bot.answer_callback_query(call.id)
     bot.send_message(
@@ -2121,15 +3083,17 @@ def handle_edit_video_rename(call: types.CallbackQuery):
 
 
 # Переместить видео выше
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("evid_up:"))
+@on_callback("evid_up")
 def handle_edit_video_up(call: types.CallbackQuery):
     chat_id = call.message.chat.id
-    _, payload = call.data.split(":", 1)
-    pkg_id, idx_str = payload.split("|", 1)
+    pkg_id, sep, idx_str = call.data.partition(":")[2].partition("|")
+    if not sep or not idx_str.isdecimal():
+        bot.answer_callback_query(call.id, "Ошибка данных.")
+        return
     idx = int(idx_str)
 
-    packages = read_packages()
-    pkg = next((p for p in packages if p["id"] == pkg_id), None)
+    packages = read_packages_for_update()
+    pkg = get_package(pkg_id, packages)
     if not pkg or idx <= 0 or idx >= len(pkg.get("videos", [])):
         bot.answer_callback_query(call.id, "Невозможно переместить.")
         return
@@ -2146,15 +3110,17 @@ def handle_edit_video_up(call: types.CallbackQuery):
 
 
 # Переместить видео ниже
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("evid_down:"))
+@on_callback("evid_down")
 def handle_edit_video_down(call: types.CallbackQuery):
     chat_id = call.message.chat.id
-    _, payload = call.data.split(":", 1)
-    pkg_id, idx_str = payload.split("|", 1)
+    pkg_id, sep, idx_str = call.data.partition(":")[2].partition("|")
+    if not sep or not idx_str.isdecimal():
+        bot.answer_callback_query(call.id, "Ошибка данных.")
+        return
     idx = int(idx_str)
 
-    packages = read_packages()
-    pkg = next((p for p in packages if p["id"] == pkg_id), None)
+    packages = read_packages_for_update()
+    pkg = get_package(pkg_id, packages)
     if not pkg or idx < 0 or idx >= len(pkg.get("videos", [])) - 1:
         bot.answer_callback_query(call.id, "Невозможно переместить.")
         return
@@ -2172,9 +3138,9 @@ def handle_edit_video_down(call: types.CallbackQuery):
 def _send_edit_video_list(chat_id: int, pkg_id: str):
     """Показывает обновлённый список видео после перемещения."""
     packages = read_packages()
-    pkg = next((p for p in packages if p["id"] == pkg_id), None)
+    pkg = get_package(pkg_id, packages)
     if not pkg:
-        bot.send_message(chat_id, "Пакет не найден.", reply_markup=make_yoga_keyboard())
+        bot.send_message(chat_id, _MSG_PKG_NOT_FOUND, reply_markup=make_yoga_keyboard())
         return
 
     videos = pkg.get("videos", [])
@@ -2186,25 +3152,26 @@ def _send_edit_video_list(chat_id: int, pkg_id: str):
     for i, v in enumerate(videos, 1):
         lines.append(f"  {i}. {v.get('title', 'Без названия')}")
 
-    kb = types.InlineKeyboardMarkup()
+    rows = []
     for i, v in enumerate(videos):
         title = v.get("title", f"Видео {i+1}")
         label = f"{i+1}. {title}"
         if len(label) > 55:
             label = label[:52] + "..."
-        kb.add(types.InlineKeyboardButton(text=label, callback_data=f"evid_sel:{pkg_id}|{i}"))
+        rows.append([types.InlineKeyboardButton(text=label, callback_data=f"evid_sel:{pkg_id}|{i}")])
 
-    kb.add(types.InlineKeyboardButton(text="⬅️ Назад к пакету", callback_data=f"epkg_back:{pkg_id}"))
+    rows.append([types.InlineKeyboardButton(text="⬅️ Назад к пакету", callback_data=f"epkg_back:{pkg_id}")])
+    kb = types.InlineKeyboardMarkup(keyboard=rows)
 
     bot.send_message(chat_id, "\n".join(lines), reply_markup=kb)
 
 
 # ─── Конец блока пакетов ───────────────────────────────────────────
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("del_date:"))
+@on_callback("del_date")
 def handle_delete_date_callback(call: types.CallbackQuery):
     chat_id = call.message.chat.id
-    _, date_str = call.data.split(":", 1)
+    date_str = call.data.partition(":")[2]
 
     slots = read_slots()
     times = slots.get(date_str, [])
@@ -2217,30 +3184,24 @@ def handle_delete_date_callback(call: types.CallbackQuery):
         )
         return
 
-    kb = types.InlineKeyboardMarkup()
-    for t in times:
-        kb.add(
-            types.InlineKeyboardButton(
-                text=t,
-                callback_data=f"del_time:{date_str}|{t}",
-            )
-        )
+    kb = types.InlineKeyboardMarkup(keyboard=[
+        [types.InlineKeyboardButton(text=t, callback_data=f"del_time:{date_str}|{t}")]
+        for t in times
+    ])
 
     bot.answer_callback_query(call.id)
-    bot.send_message(
-        chat_id,
+    edit_or_send(
+        call,
         f"Выберите слот для удаления ({format_date_ru(date_str)}):",
         reply_markup=kb,
     )
 
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("del_time:"))
+@on_callback("del_time")
 def handle_delete_time_callback(call: types.CallbackQuery):
     chat_id = call.message.chat.id
-    _, payload = call.data.split(":", 1)
-    try:
-        date_str, time = payload.split("|", 1)
-    except ValueError:
+    date_str, sep, time = call.data.partition(":")[2].partition("|")
+    if not sep:
         bot.answer_callback_query(call.id, "Ошибка данных слота.")
         return
 
@@ -2248,13 +3209,12 @@ def handle_delete_time_callback(call: types.CallbackQuery):
     bot.answer_callback_query(call.id)
 
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("cancel_date:"))
+@on_callback("cancel_date")
 def handle_cancel_date_callback(call: types.CallbackQuery):
     chat_id = call.message.chat.id
-    _, date_str = call.data.split(":", 1)
+    date_str = call.data.partition(":")[2]
 
-    bookings = read_bookings()
-    times = sorted({b["time"] for b in bookings if b.get("date") == date_str})
+    times = list(bookings_index().by_date.get(date_str, ()))
 
     if not times:
         bot.answer_callback_query(call.id, "На эту дату записей уже нет.")
@@ -2265,35 +3225,28 @@ def handle_cancel_date_callback(call: types.CallbackQuery):
         )
         return
 
-    kb = types.InlineKeyboardMarkup()
-    for t in times:
-        kb.add(
-            types.InlineKeyboardButton(
-                text=t,
-                callback_data=f"cancel_time:{date_str}|{t}",
-            )
-        )
+    kb = types.InlineKeyboardMarkup(keyboard=[
+        [types.InlineKeyboardButton(text=t, callback_data=f"cancel_time:{date_str}|{t}")]
+        for t in times
+    ])
 
     bot.answer_callback_query(call.id)
-    bot.send_message(
-        chat_id,
+    edit_or_send(
+        call,
         f"Выберите время для отмены записи ({format_date_ru(date_str)}):",
         reply_markup=kb,
     )
 
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("cancel_time:"))
+@on_callback("cancel_time")
 def handle_cancel_time_callback(call: types.CallbackQuery):
     chat_id = call.message.chat.id
-    _, payload = call.data.split(":", 1)
-    try:
-        date_str, time = payload.split("|", 1)
-    except ValueError:
+    date_str, sep, time = call.data.partition(":")[2].partition("|")
+    if not sep:
         bot.answer_callback_query(call.id, "Ошибка данных записи.")
         return
 
-    bookings = read_bookings()
-    affected = [b for b in bookings if b.get("date") == date_str and b.get("time") == time]
+    affected = bookings_index().by_slot.get((date_str, time))
 
     if not affected:
         bot.answer_callback_query(call.id, "Запись уже отсутствует.")
@@ -2308,10 +3261,7 @@ def handle_cancel_time_callback(call: types.CallbackQuery):
         f"⚠ Будут отменены записи на {format_date_ru(date_str)} в {time}:",
         "",
     ]
-    for b in affected:
-        name = b.get("name") or "Без имени"
-        phone = b.get("phone") or "без телефона"
-        lines.append(f"• {name}, телефон: {phone}")
+    lines += _client_lines(affected)
     lines.append("")
     lines.append("Вы действительно хотите отменить эти записи?")
 
@@ -2333,25 +3283,16 @@ def handle_cancel_time_callback(call: types.CallbackQuery):
     bot.send_message(chat_id, "\n".join(lines), reply_markup=kb)
 
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("confirm_cancel_booking:"))
+@on_callback("confirm_cancel_booking")
 def handle_confirm_cancel_booking_callback(call: types.CallbackQuery):
     chat_id = call.message.chat.id
-    _, payload = call.data.split(":", 1)
-    try:
-        date_str, time = payload.split("|", 1)
-    except ValueError:
+    date_str, sep, time = call.data.partition(":")[2].partition("|")
+    if not sep:
         bot.answer_callback_query(call.id, "Ошибка данных записи.")
         return
 
-    bookings = read_bookings()
-    remaining = [b for b in bookings if not (b.get("date") == date_str and b.get("time") == time)]
-    cancelled = [b for b in bookings if b.get("date") == date_str and b.get("time") == time]
-
     # Сохраняем только оставшиеся записи
-    from json import dump
-    BOOKINGS_FILE.parent.mkdir(parents=True, exist_ok=True)
-    with open(BOOKINGS_FILE, "w", encoding="utf-8") as f:
-        dump(remaining, f, ensure_ascii=False, indent=2)
+    cancelled = cancel_slot_bookings(date_str, time)
 
     if cancelled:
         lines = [
@@ -2359,10 +3300,7 @@ def handle_confirm_cancel_booking_callback(call: types.CallbackQuery):
             "",
             "Клиенты, которых нужно уведомить:",
         ]
-        for b in cancelled:
-            name = b.get("name") or "Без имени"
-            phone = b.get("phone") or "без телефона"
-            lines.append(f"• {name}, телефон: {phone}")
+        lines += _client_lines(cancelled)
         bot.send_message(chat_id, "\n".join(lines), reply_markup=make_main_keyboard())
     else:
         bot.send_message(
@@ -2374,52 +3312,50 @@ def handle_confirm_cancel_booking_callback(call: types.CallbackQuery):
     bot.answer_callback_query(call.id, "Записи отменены.")
 
 
-@bot.callback_query_handler(func=lambda c: c.data == "cancel_cancel_booking")
+@on_callback("cancel_cancel_booking")
 def handle_cancel_cancel_booking_callback(call: types.CallbackQuery):
     bot.answer_callback_query(call.id, "Отмена действий с записями.")
 
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("delpostpage:"))
+@on_callback("delpostpage")
 def handle_delete_post_page(call: types.CallbackQuery):
     chat_id = call.message.chat.id
     try:
-        _, page_str = call.data.split(":", 1)
+        page_str = call.data.partition(":")[2]
         page = int(page_str)
     except Exception:
         bot.answer_callback_query(call.id, "Ошибка номера страницы.")
         return
 
     bot.answer_callback_query(call.id)
-    send_posts_page(chat_id, page)
+    send_posts_page(chat_id, page, call=call)
 
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("editpostpage:"))
+@on_callback("editpostpage")
 def handle_edit_post_page(call: types.CallbackQuery):
     chat_id = call.message.chat.id
     try:
-        _, page_str = call.data.split(":", 1)
+        page_str = call.data.partition(":")[2]
         page = int(page_str)
     except Exception:
         bot.answer_callback_query(call.id, "Ошибка номера страницы.")
         return
 
     bot.answer_callback_query(call.id)
-    send_edit_posts_page(chat_id, page)
+    send_edit_posts_page(chat_id, page, call=call)
 
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("delpost:"))
+@on_callback("delpost")
 def handle_delete_post_select(call: types.CallbackQuery):
     chat_id = call.message.chat.id
-    try:
-        _, payload = call.data.split(":", 1)
-        slug, page_str = payload.split(":", 1)
-        _ = int(page_str)  # пока не используем, но может пригодиться
-    except Exception:
+    slug, sep, page_str = call.data.partition(":")[2].partition(":")
+    if not sep or not page_str.isdecimal():
         bot.answer_callback_query(call.id, "Ошибка данных поста.")
         return
 
-    path = POSTS_DIR / f"{slug}.md"
-    if not path.exists():
+    # Заголовок для подтверждения — из кэша шапок постов
+    title = get_post_title(slug)
+    if title is None:
         bot.answer_callback_query(call.id, "Файл поста не найден.")
         bot.send_message(
             chat_id,
@@ -2428,24 +3364,6 @@ def handle_delete_post_select(call: types.CallbackQuery):
         )
         return
 
-    # Пытаемся вытащить заголовок для подтверждения
-    title = slug
-    try:
-        text = path.read_text(encoding="utf-8")
-        lines = text.splitlines()
-        if lines and lines[0].strip() == "---":
-            for line in lines[1:]:
-                if line.strip() == "---":
-                    break
-                if line.strip().startswith("title:"):
-                    raw = line.split(":", 1)[1].strip()
-                    if raw.startswith('"') and raw.endswith('"'):
-                        raw = raw[1:-1]
-                    title = raw or slug
-                    break
-    except Exception:
-        pass
-
     kb = types.InlineKeyboardMarkup()
     kb.row(
         types.InlineKeyboardButton(
@@ -2470,42 +3388,39 @@ def handle_delete_post_select(call: types.CallbackQuery):
     )
 
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("confirm_delpost:"))
+@on_callback("confirm_delpost")
 def handle_confirm_delete_post(call: types.CallbackQuery):
     chat_id = call.message.chat.id
-    try:
-        _, slug = call.data.split(":", 1)
-    except Exception:
-        bot.answer_callback_query(call.id, "Ошибка данных поста.")
-        return
+    slug = call.data.partition(":")[2]
 
     path = POSTS_DIR / f"{slug}.md"
-    if path.exists():
-        try:
-            path.unlink()
-            bot.send_message(
-                chat_id,
-                f"🗑 Пост `{slug}.md` удалён.",
-                parse_mode="Markdown",
-                reply_markup=make_blog_keyboard(),
-            )
-        except Exception as e:
-            bot.send_message(
-                chat_id,
-                f"Не удалось удалить файл поста: {e}",
-                reply_markup=make_blog_keyboard(),
-            )
-    else:
+    try:
+        path.unlink()
+        _post_meta_cache.pop(path, None)
+        bot.send_message(
+            chat_id,
+            f"🗑 Пост `{slug}.md` удалён.",
+            parse_mode="Markdown",
+            reply_markup=make_blog_keyboard(),
+        )
+    except FileNotFoundError:
+        _post_meta_cache.pop(path, None)
         bot.send_message(
             chat_id,
             "Файл поста уже не существует.",
             reply_markup=make_blog_keyboard(),
         )
+    except Exception as e:
+        bot.send_message(
+            chat_id,
+            f"Не удалось удалить файл поста: {e}",
+            reply_markup=make_blog_keyboard(),
+        )
 
     bot.answer_callback_query(call.id, "Пост удалён.")
 
 
-@bot.callback_query_handler(func=lambda c: c.data == "cancel_delpost")
+@on_callback("cancel_delpost")
 def handle_cancel_delete_post(call: types.CallbackQuery):
     chat_id = call.message.chat.id
     bot.answer_callback_query(call.id, "Удаление поста отменено.")
@@ -2516,40 +3431,46 @@ def handle_cancel_delete_post(call: types.CallbackQuery):
     )
 
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("mf_dir:"))
+@on_callback("cancel_editpost")
+def handle_cancel_edit_post(call: types.CallbackQuery):
+    chat_id = call.message.chat.id
+    bot.answer_callback_query(call.id, "Редактирование поста отменено.")
+    bot.send_message(
+        chat_id,
+        "Редактирование поста отменено.",
+        reply_markup=make_blog_keyboard(),
+    )
+
+
+@on_callback("mf_dir")
 def handle_media_dir(call: types.CallbackQuery):
     chat_id = call.message.chat.id
-    _, dir_name = call.data.split(":", 1)
+    dir_name = call.data.partition(":")[2]
     bot.answer_callback_query(call.id)
     send_media_files(chat_id, dir_name, page=0)
 
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("mf_page:"))
+@on_callback("mf_page")
 def handle_media_page(call: types.CallbackQuery):
     chat_id = call.message.chat.id
-    try:
-        _, payload = call.data.split(":", 1)
-        dir_name, page_str = payload.split("|", 1)
-        page = int(page_str)
-    except Exception:
+    dir_name, sep, page_str = call.data.partition(":")[2].partition("|")
+    if not sep or not page_str.isdecimal():
         bot.answer_callback_query(call.id, "Ошибка номера страницы.")
         return
+    page = int(page_str)
 
     bot.answer_callback_query(call.id)
-    send_media_files(chat_id, dir_name, page=page)
+    send_media_files(chat_id, dir_name, page=page, call=call)
 
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("mf_upload:"))
+@on_callback("mf_upload")
 def handle_media_upload_start(call: types.CallbackQuery):
     chat_id = call.message.chat.id
-    try:
-        _, dir_name = call.data.split(":", 1)
-    except Exception:
-        bot.answer_callback_query(call.id, "Ошибка данных папки.")
-        return
+    ctx = get_ctx(chat_id)
+    dir_name = call.data.partition(":")[2]
 
-    chat_state[chat_id] = "upload_file"
-    chat_upload_dirs[chat_id] = dir_name
+    ctx.state = "upload_file"
+    ctx.upload_dir = dir_name
 
     bot.answer_callback_query(call.id)
     bot.send_message(
@@ -2561,18 +3482,18 @@ def handle_media_upload_start(call: types.CallbackQuery):
     )
 
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("mf_file:"))
+@on_callback("mf_file")
 def handle_media_file(call: types.CallbackQuery):
     chat_id = call.message.chat.id
-    try:
-        _, payload = call.data.split(":", 1)
-        dir_name, filename, page_str = payload.split("|", 2)
-    except Exception:
+    dir_name, sep, rest = call.data.partition(":")[2].partition("|")
+    filename, sep2, page_str = rest.partition("|")
+    if not (sep and sep2):
         bot.answer_callback_query(call.id, "Ошибка данных файла.")
         return
 
     path = PUBLIC_DIR / dir_name / filename
-    if not path.exists():
+    st = _stat_or_none(path)
+    if st is None:
         bot.answer_callback_query(call.id, "Файл не найден.")
         bot.send_message(
             chat_id,
@@ -2581,20 +3502,28 @@ def handle_media_file(call: types.CallbackQuery):
         )
         return
 
-    ext = path.suffix.lower()
+    # «Часики» снимаем сразу, а превью отправляем здесь же, в очереди этого чата:
+    # выгрузка идёт в потоке пула обработчиков, а ответы на следующие нажатия
+    # придут уже после карточки файла
     bot.answer_callback_query(call.id)
+    _send_media_file_card(chat_id, path, dir_name, filename, st.st_size)
 
-    # Размер файла для информации
-    try:
-        size_bytes = path.stat().st_size
-        if size_bytes >= 1024 * 1024:
-            size_str = f"{size_bytes / (1024 * 1024):.1f} МБ"
-        elif size_bytes >= 1024:
-            size_str = f"{size_bytes / 1024:.0f} КБ"
-        else:
-            size_str = f"{size_bytes} байт"
-    except Exception:
-        size_str = "?"
+
+def _send_media_file_card(
+    chat_id: int, path: Path, dir_name: str, filename: str, size_bytes: int
+) -> None:
+    """
+    Превью файла (фото/аудио до 20 МБ) и сообщение с кнопками действий над ним.
+    """
+    ext = path.suffix.lower()
+
+    # Размер файла для информации (stat уже сделан в обработчике нажатия)
+    if size_bytes >= 1024 * 1024:
+        size_str = f"{size_bytes / (1024 * 1024):.1f} МБ"
+    elif size_bytes >= 1024:
+        size_str = f"{size_bytes / 1024:.0f} КБ"
+    else:
+        size_str = f"{size_bytes} байт"
 
     # Пробуем отправить превью, но только для небольших файлов (< 20 МБ)
     # и фото. Для крупных видео — не пытаемся, чтобы избежать таймаутов.
@@ -2602,11 +3531,11 @@ def handle_media_file(call: types.CallbackQuery):
     MAX_SEND_SIZE = 20 * 1024 * 1024  # 20 МБ
     try:
         if size_bytes < MAX_SEND_SIZE:
-            if ext in [".jpg", ".jpeg", ".png", ".gif", ".webp"]:
+            if ext in IMAGE_EXTS:
                 with open(path, "rb") as f:
                     bot.send_photo(chat_id, f, caption=filename)
                 sent_preview = True
-            elif ext in [".mp3", ".wav"]:
+            elif ext in AUDIO_EXTS:
                 with open(path, "rb") as f:
                     bot.send_audio(chat_id, f, caption=filename)
                 sent_preview = True
@@ -2635,7 +3564,7 @@ def handle_media_file(call: types.CallbackQuery):
     )
 
     info = f"📄 `{filename}`\n📁 Папка: `{dir_name}`\n💾 Размер: {size_str}"
-    if not sent_preview and ext in [".mp4", ".mov", ".avi"]:
+    if not sent_preview and ext in VIDEO_EXTS:
         info += "\n\n⚠️ Видеофайл слишком большой для предпросмотра в Telegram."
 
     bot.send_message(
@@ -2646,14 +3575,14 @@ def handle_media_file(call: types.CallbackQuery):
     )
 
 
-@bot.callback_query_handler(func=lambda c: c.data == "mf_back_dirs")
+@on_callback("mf_back_dirs")
 def handle_media_back_dirs(call: types.CallbackQuery):
     chat_id = call.message.chat.id
     bot.answer_callback_query(call.id)
     send_media_dirs(chat_id)
 
 
-@bot.callback_query_handler(func=lambda c: c.data == "mf_cancel")
+@on_callback("mf_cancel")
 def handle_media_cancel(call: types.CallbackQuery):
     chat_id = call.message.chat.id
     bot.answer_callback_query(call.id, "Управление файлами закрыто.")
@@ -2664,51 +3593,46 @@ def handle_media_cancel(call: types.CallbackQuery):
     )
 
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("mf_delfile:"))
+@on_callback("mf_delfile")
 def handle_media_delete_file(call: types.CallbackQuery):
     chat_id = call.message.chat.id
-    try:
-        _, payload = call.data.split(":", 1)
-        dir_name, filename = payload.split("|", 1)
-    except Exception:
+    dir_name, sep, filename = call.data.partition(":")[2].partition("|")
+    if not sep:
         bot.answer_callback_query(call.id, "Ошибка данных файла.")
         return
 
     path = PUBLIC_DIR / dir_name / filename
-    if not path.exists():
+    try:
+        path.unlink()
+    except FileNotFoundError:
         bot.answer_callback_query(call.id, "Файл уже не существует.")
         bot.send_message(
             chat_id,
             "Файл уже удалён или отсутствует.",
             reply_markup=make_blog_keyboard(),
         )
-        return
-
-    try:
-        path.unlink()
-        bot.answer_callback_query(call.id, "Файл удалён.")
+    except Exception as e:
+        bot.answer_callback_query(call.id, "Не удалось удалить файл.")
         bot.send_message(
             chat_id,
-            f"🗑 Файл `{filename}` удалён из папки `{dir_name}`.",
-            parse_mode="Markdown",
+            f"Не удалось удалить файл: {e}",
             reply_markup=make_blog_keyboard(),
         )
-    except Exception as e:
-        bot.answer_callback_query(call.id, "Не удалось удалить файл.")
+    else:
+        bot.answer_callback_query(call.id, "Файл удалён.")
         bot.send_message(
             chat_id,
-            f"Не удалось удалить файл: {e}",
+            f"🗑 Файл `{filename}` удалён из папки `{dir_name}`.",
+            parse_mode="Markdown",
             reply_markup=make_blog_keyboard(),
         )
 
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("mf_keepname:"))
+@on_callback("mf_keepname")
 def handle_media_keepname(call: types.CallbackQuery):
     chat_id = call.message.chat.id
-    try:
-        _, payload = call.data.split(":", 1)
-        dir_name, filename = payload.split("|", 1)
-    except Exception:
+    dir_name, sep, filename = call.data.partition(":")[2].partition("|")
+    if not sep:
         bot.answer_callback_query(call.id, "Ошибка данных файла.")
         return
 
@@ -2721,18 +3645,18 @@ def handle_media_keepname(call: types.CallbackQuery):
     )
 
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("mf_rename:"))
+@on_callback("mf_rename")
 def handle_media_rename_file_start(call: types.CallbackQuery):
     chat_id = call.message.chat.id
-    try:
-        _, payload = call.data.split(":", 1)
-        dir_name, filename = payload.split("|", 1)
-    except Exception:
+    ctx = get_ctx(chat_id)
+    dir_name, sep, filename = call.data.partition(":")[2].partition("|")
+    if not sep:
         bot.answer_callback_query(call.id, "Ошибка данных файла.")
         return
 
-    path = PUBLIC_DIR / dir_name / filename
-    if not path.exists():
+    # Один stat сразу, чтобы не просить имя для уже удалённого файла; если файл
+    # пропадёт, пока вводится имя, это поймает шаг переименования (FileNotFoundError)
+    if _stat_or_none(PUBLIC_DIR / dir_name / filename) is None:
         bot.answer_callback_query(call.id, "Файл уже не существует.")
         bot.send_message(
             chat_id,
@@ -2741,8 +3665,8 @@ def handle_media_rename_file_start(call: types.CallbackQuery):
         )
         return
 
-    chat_state[chat_id] = "rename_file"
-    chat_rename_targets[chat_id] = (dir_name, filename)
+    ctx.state = "rename_file"
+    ctx.rename_target = (dir_name, filename)
 
     bot.answer_callback_query(call.id)
     bot.send_message(
@@ -2754,19 +3678,19 @@ def handle_media_rename_file_start(call: types.CallbackQuery):
     )
 
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("editpost:"))
+@on_callback("editpost")
 def handle_edit_post_select(call: types.CallbackQuery):
     chat_id = call.message.chat.id
-    try:
-        _, payload = call.data.split(":", 1)
-        slug, page_str = payload.split(":", 1)
-        _ = int(page_str)
-    except Exception:
+    ctx = get_ctx(chat_id)
+    slug, sep, page_str = call.data.partition(":")[2].partition(":")
+    if not sep or not page_str.isdecimal():
         bot.answer_callback_query(call.id, "Ошибка данных поста.")
         return
 
     path = POSTS_DIR / f"{slug}.md"
-    if not path.exists():
+    try:
+        content = path.read_text(encoding="utf-8")
+    except FileNotFoundError:
         bot.answer_callback_query(call.id, "Файл поста не найден.")
         bot.send_message(
             chat_id,
@@ -2774,9 +3698,6 @@ def handle_edit_post_select(call: types.CallbackQuery):
             reply_markup=make_blog_keyboard(),
         )
         return
-
-    try:
-        content = path.read_text(encoding="utf-8")
     except Exception as e:
         bot.answer_callback_query(call.id, "Не удалось прочитать файл поста.")
         bot.send_message(
@@ -2786,8 +3707,8 @@ def handle_edit_post_select(call: types.CallbackQuery):
         )
         return
 
-    chat_edit_post_files[chat_id] = f"{slug}.md"
-    chat_state[chat_id] = "edit_post"
+    ctx.edit_post_file = f"{slug}.md"
+    ctx.state = "edit_post"
 
     # Показываем текст поста в код-блоке, чтобы можно было удобно скопировать и отредактировать
     preview = content
@@ -2810,12 +3731,13 @@ def handle_edit_post_select(call: types.CallbackQuery):
 
 def _finalize_new_package(chat_id: int, image_path: str = ""):
     """
-    Создаёт пакет из черновика chat_pkg_draft и сохраняет в JSON.
+    Создаёт пакет из черновика ChatCtx.pkg_draft и сохраняет в JSON.
     """
-    draft = chat_pkg_draft.get(chat_id, {})
+    ctx = get_ctx(chat_id)
+    draft = ctx.pkg_draft
 
     new_package = {
-        "id": draft.get("id", f"pkg-{datetime.now().strftime('%Y%m%d-%H%M%S')}"),
+        "id": draft.get("id", f"pkg-{file_stamp()}"),
         "name": draft.get("name", "Новый пакет"),
         "level": draft.get("level", "Все уровни"),
         "description": draft.get("description", ""),
@@ -2825,9 +3747,8 @@ def _finalize_new_package(chat_id: int, image_path: str = ""):
         "available": True,
     }
 
-    packages = read_packages()
-    existing_ids = {p["id"] for p in packages}
-    if new_package["id"] in existing_ids:
+    packages = read_packages_for_update()
+    if get_package(new_package["id"], packages) is not None:
         new_package["id"] = f"{new_package['id']}-{datetime.now().strftime('%H%M%S')}"
 
     packages.append(new_package)
@@ -2849,36 +3770,37 @@ def _finalize_new_package(chat_id: int, image_path: str = ""):
         parse_mode="Markdown",
         reply_markup=make_yoga_keyboard(),
     )
-    chat_state[chat_id] = None
-    chat_pkg_draft.pop(chat_id, None)
+    ctx.pkg_draft = {}
+    clear_state(chat_id)
 
 
 def _save_video_to_package(chat_id: int, pkg_id: str | None, draft: dict):
     """
     Финальный шаг: сохраняем видео из draft в пакет pkg_id.
     """
+    ctx = get_ctx(chat_id)
     if not pkg_id:
         bot.send_message(
             chat_id,
             "Не удалось определить пакет. Начните заново через «Добавить видео в пакет».",
             reply_markup=make_yoga_keyboard(),
         )
-        chat_state[chat_id] = None
-        chat_pkg_target.pop(chat_id, None)
-        chat_video_draft.pop(chat_id, None)
+        ctx.pkg_target = None
+        ctx.video_draft = {}
+        clear_state(chat_id)
         return
 
-    packages = read_packages()
-    pkg = next((p for p in packages if p["id"] == pkg_id), None)
+    packages = read_packages_for_update()
+    pkg = get_package(pkg_id, packages)
     if not pkg:
         bot.send_message(
             chat_id,
             "Пакет не найден. Возможно, он был удалён.",
             reply_markup=make_yoga_keyboard(),
         )
-        chat_state[chat_id] = None
-        chat_pkg_target.pop(chat_id, None)
-        chat_video_draft.pop(chat_id, None)
+        ctx.pkg_target = None
+        ctx.video_draft = {}
+        clear_state(chat_id)
         return
 
     new_video: dict = {
@@ -2913,26 +3835,27 @@ def _save_video_to_package(chat_id: int, pkg_id: str | None, draft: dict):
         parse_mode="Markdown",
         reply_markup=make_yoga_keyboard(),
     )
-    chat_state[chat_id] = None
-    chat_pkg_target.pop(chat_id, None)
-    chat_video_draft.pop(chat_id, None)
+    ctx.pkg_target = None
+    ctx.video_draft = {}
+    clear_state(chat_id)
 
 
 @bot.message_handler(content_types=["photo", "video", "audio", "document"])
 def handle_media_message(message):
     chat_id = message.chat.id
-    state = chat_state.get(chat_id)
+    ctx = get_ctx(chat_id)
+    state = ctx.state
 
     # 1) Превью к посту
     if state == "add_post_preview":
-        filename = chat_post_files.get(chat_id)
+        filename = ctx.post_file
         if not filename:
             bot.send_message(
                 chat_id,
                 "Не удалось связать фото с постом. Попробуйте снова через «Управление блогом → Добавить пост».",
                 reply_markup=make_blog_keyboard(),
             )
-            chat_state[chat_id] = None
+            clear_state(chat_id)
             return
 
         # Берём самое большое фото
@@ -2946,8 +3869,11 @@ def handle_media_message(message):
 
         photo = message.photo[-1]
         try:
+            # Сохраняем в public/notgallery, чтобы эти превью не попадали в фотогалерею
+            img_name = f"post-preview-{file_stamp()}.jpg"
+            img_path = NOTGALLERY_DIR / img_name
             file_info = bot.get_file(photo.file_id)
-            downloaded = bot.download_file(file_info.file_path)
+            download_telegram_file(file_info.file_path, img_path)
         except Exception as e:
             bot.send_message(
                 chat_id,
@@ -2956,14 +3882,6 @@ def handle_media_message(message):
             )
             return
 
-        # Сохраняем в public/notgallery, чтобы эти превью не попадали в фотогалерею
-        photos_dir = BASE_DIR / "public" / "notgallery"
-        photos_dir.mkdir(parents=True, exist_ok=True)
-        img_name = f"post-preview-{datetime.now().strftime('%Y%m%d-%H%M%S')}.jpg"
-        img_path = photos_dir / img_name
-        with open(img_path, "wb") as f:
-            f.write(downloaded)
-
         # Добавляем previewImage в markdown‑файл
         web_path = f"/notgallery/{img_name}"
         try:
@@ -2974,8 +3892,8 @@ def handle_media_message(message):
                 f"Пост сохранён, но не удалось прописать previewImage: {e}",
                 reply_markup=make_blog_keyboard(),
             )
-            chat_state[chat_id] = None
-            chat_post_files.pop(chat_id, None)
+            ctx.post_file = None
+            clear_state(chat_id)
             return
 
         bot.send_message(
@@ -2985,8 +3903,8 @@ def handle_media_message(message):
             parse_mode="Markdown",
             reply_markup=make_blog_keyboard(),
         )
-        chat_state[chat_id] = None
-        chat_post_files.pop(chat_id, None)
+        ctx.post_file = None
+        clear_state(chat_id)
         return
 
     # 2) Превью при создании нового пакета
@@ -3002,19 +3920,13 @@ def handle_media_message(message):
 
         photo = message.photo[-1]
         try:
+            img_name = f"pkg-preview-{file_stamp()}.jpg"
             file_info = bot.get_file(photo.file_id)
-            downloaded = bot.download_file(file_info.file_path)
+            download_telegram_file(file_info.file_path, NOTGALLERY_DIR / img_name)
         except Exception as e:
             bot.send_message(chat_id, f"Не удалось скачать фото: {e}", reply_markup=make_yoga_keyboard())
             return
 
-        photos_dir = BASE_DIR / "public" / "notgallery"
-        photos_dir.mkdir(parents=True, exist_ok=True)
-        img_name = f"pkg-preview-{datetime.now().strftime('%Y%m%d-%H%M%S')}.jpg"
-        img_path = photos_dir / img_name
-        with open(img_path, "wb") as f:
-            f.write(downloaded)
-
         web_path = f"/notgallery/{img_name}"
         _finalize_new_package(chat_id, image_path=web_path)
         return
@@ -3029,57 +3941,44 @@ def handle_media_message(message):
             )
             return
 
-        pkg_id = chat_pkg_target.get(chat_id)
+        pkg_id = ctx.pkg_target
         if not pkg_id:
             bot.send_message(chat_id, "Ошибка: пакет не определён.", reply_markup=make_yoga_keyboard())
-            chat_state[chat_id] = None
+            clear_state(chat_id)
+            return
+
+        packages = read_packages_for_update()
+        pkg = get_package(pkg_id, packages)
+        if not pkg:
+            bot.send_message(chat_id, _MSG_PKG_NOT_FOUND, reply_markup=make_yoga_keyboard())
+            clear_state(chat_id)
             return
 
+        # Сохраняем новое (до удаления старого, чтобы при ошибке превью не пропало)
         photo = message.photo[-1]
         try:
+            img_name = f"pkg-preview-{file_stamp()}.jpg"
             file_info = bot.get_file(photo.file_id)
-            downloaded = bot.download_file(file_info.file_path)
+            download_telegram_file(file_info.file_path, NOTGALLERY_DIR / img_name)
         except Exception as e:
             bot.send_message(chat_id, f"Не удалось скачать фото: {e}", reply_markup=make_yoga_keyboard())
             return
 
-        packages = read_packages()
-        pkg = next((p for p in packages if p["id"] == pkg_id), None)
-        if not pkg:
-            bot.send_message(chat_id, "Пакет не найден.", reply_markup=make_yoga_keyboard())
-            chat_state[chat_id] = None
-            return
-
         # Удаляем старое превью
         old_image = pkg.get("image", "")
         if old_image and old_image.startswith("/notgallery/"):
             old_path = PUBLIC_DIR / old_image.lstrip("/")
-            if old_path.exists():
-                try:
-                    old_path.unlink()
-                except Exception:
-                    pass
-
-        # Сохраняем новое
-        photos_dir = BASE_DIR / "public" / "notgallery"
-        photos_dir.mkdir(parents=True, exist_ok=True)
-        img_name = f"pkg-preview-{datetime.now().strftime('%Y%m%d-%H%M%S')}.jpg"
-        img_path = photos_dir / img_name
-        with open(img_path, "wb") as f:
-            f.write(downloaded)
+            try:
+                old_path.unlink()
+            except Exception:
+                pass
 
         web_path = f"/notgallery/{img_name}"
         pkg["image"] = web_path
         write_packages(packages)
 
-        bot.send_message(
-            chat_id,
-            f"✅ Превью обновлено: `{web_path}`",
-            parse_mode="Markdown",
-            reply_markup=make_yoga_keyboard(),
-        )
-        chat_state[chat_id] = None
-        _send_edit_pkg_menu(chat_id, pkg_id)
+        clear_state(chat_id)
+        _send_edit_pkg_menu(chat_id, pkg_id, notice=f"✅ Превью обновлено: {web_path}")
         return
 
     # 4) Загрузка видео для пакета уроков
@@ -3106,7 +4005,6 @@ def handle_media_message(message):
                 return
 
             file_info = bot.get_file(file_id)
-            data = bot.download_file(file_info.file_path)
         except Exception as e:
             bot.send_message(
                 chat_id,
@@ -3116,11 +4014,10 @@ def handle_media_message(message):
             return
 
         # Сохраняем в public/videos/
-        VIDEOS_DIR.mkdir(parents=True, exist_ok=True)
         if message.document and message.document.file_name:
             filename = message.document.file_name
         else:
-            filename = f"video-{datetime.now().strftime('%Y%m%d-%H%M%S')}{ext}"
+            filename = f"video-{file_stamp()}{ext}"
 
         target_path = VIDEOS_DIR / filename
         # Если файл уже существует, добавляем суффикс
@@ -3131,18 +4028,17 @@ def handle_media_message(message):
             target_path = VIDEOS_DIR / filename
 
         try:
-            with open(target_path, "wb") as f:
-                f.write(data)
+            download_telegram_file(file_info.file_path, target_path)
         except Exception as e:
             bot.send_message(
                 chat_id,
-                f"Не удалось сохранить видеофайл: {e}",
+                f"Не удалось скачать или сохранить видеофайл: {e}",
                 reply_markup=make_yoga_keyboard(),
             )
             return
 
-        pkg_id = chat_pkg_target.get(chat_id)
-        draft = chat_video_draft.get(chat_id, {})
+        pkg_id = ctx.pkg_target
+        draft = ctx.video_draft
         draft["videoUrl"] = f"/videos/{filename}"
 
         _save_video_to_package(chat_id, pkg_id, draft)
@@ -3150,21 +4046,20 @@ def handle_media_message(message):
 
     # 3) Загрузка файла в public/<dir> через «Управление файлами»
     if state == "upload_file":
-        dir_name = chat_upload_dirs.get(chat_id)
+        dir_name = ctx.upload_dir
         if not dir_name:
             bot.send_message(
                 chat_id,
                 "Не удалось определить папку для загрузки. Начните снова через «Управление файлами».",
                 reply_markup=make_blog_keyboard(),
             )
-            chat_state[chat_id] = None
+            clear_state(chat_id)
             return
 
         target_dir = PUBLIC_DIR / dir_name
         target_dir.mkdir(parents=True, exist_ok=True)
 
         file_id = None
-        data = None
         ext = ""
 
         try:
@@ -3192,7 +4087,6 @@ def handle_media_message(message):
                 return
 
             file_info = bot.get_file(file_id)
-            data = bot.download_file(file_info.file_path)
         except Exception as e:
             bot.send_message(
                 chat_id,
@@ -3205,16 +4099,15 @@ def handle_media_message(message):
         if message.document and message.document.file_name:
             filename = message.document.file_name
         else:
-            filename = f"upload-{datetime.now().strftime('%Y%m%d-%H%M%S')}{ext}"
+            filename = f"upload-{file_stamp()}{ext}"
 
         target_path = target_dir / filename
         try:
-            with open(target_path, "wb") as f:
-                f.write(data)
+            download_telegram_file(file_info.file_path, target_path)
         except Exception as e:
             bot.send_message(
                 chat_id,
-                f"Не удалось сохранить файл: {e}",
+                f"Не удалось скачать или сохранить файл: {e}",
                 reply_markup=make_blog_keyboard(),
             )
             return
@@ -3247,44 +4140,30 @@ def handle_media_message(message):
             parse_mode="Markdown",
             reply_markup=kb,
         )
-        chat_state[chat_id] = None
-        chat_upload_dirs.pop(chat_id, None)
+        ctx.upload_dir = None
+        clear_state(chat_id)
         return
 
     # Если медиасообщение пришло вне ожидаемого состояния — пока игнорируем
 
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("confirm_del:"))
+@on_callback("confirm_del")
 def handle_confirm_delete_callback(call: types.CallbackQuery):
     chat_id = call.message.chat.id
-    _, payload = call.data.split(":", 1)
-    try:
-        date_str, time = payload.split("|", 1)
-    except ValueError:
+    date_str, sep, time = call.data.partition(":")[2].partition("|")
+    if not sep:
         bot.answer_callback_query(call.id, "Ошибка данных слота.")
         return
 
     # Здесь реально удаляем слот и связанные с ним записи
-    slots = read_slots()
-    bookings = read_bookings()
-
-    # Разделяем записи: какие отменяем и какие оставляем
-    cancelled_bookings = [b for b in bookings if b.get("date") == date_str and b.get("time") == time]
-    remaining_bookings = [b for b in bookings if not (b.get("date") == date_str and b.get("time") == time)]
+    slots = read_slots_for_update()
 
     # Удаляем слот
-    if date_str in slots and time in slots[date_str]:
-        new_times = [t for t in slots[date_str] if t != time]
-        if new_times:
-            slots[date_str] = new_times
-        else:
-            del slots[date_str]
+    if _remove_slot_time(slots, date_str, time):
         write_slots(slots)
 
     # Перезаписываем bookings.json только с оставшимися записями
-    BOOKINGS_FILE.parent.mkdir(parents=True, exist_ok=True)
-    with open(BOOKINGS_FILE, "w", encoding="utf-8") as f:
-        json.dump(remaining_bookings, f, ensure_ascii=False, indent=2)
+    cancelled_bookings = cancel_slot_bookings(date_str, time)
 
     if cancelled_bookings:
         lines = [
@@ -3292,10 +4171,7 @@ def handle_confirm_delete_callback(call: types.CallbackQuery):
             "",
             "Клиенты, которых нужно уведомить:",
         ]
-        for b in cancelled_bookings:
-            name = b.get("name") or "Без имени"
-            phone = b.get("phone") or "без телефона"
-            lines.append(f"• {name}, телефон: {phone}")
+        lines += _client_lines(cancelled_bookings)
         bot.send_message(chat_id, "\n".join(lines), reply_markup=make_main_keyboard())
     else:
         bot.send_message(
@@ -3307,678 +4183,742 @@ def handle_confirm_delete_callback(call: types.CallbackQuery):
     bot.answer_callback_query(call.id, "Слот и связанные записи удалены.")
 
 
-@bot.callback_query_handler(func=lambda c: c.data == "cancel_del")
+@on_callback("cancel_del")
 def handle_cancel_delete_callback(call: types.CallbackQuery):
     bot.answer_callback_query(call.id, "Удаление слота отменено.")
 
 
-@bot.message_handler(func=lambda m: True)
-def handle_text(message):
-    chat_id = message.chat.id
-    state = chat_state.get(chat_id)
-
-    if state == "add_post":
-        # Пользователь прислал markdown‑текст для нового поста
-        content = (message.text or "").strip()
-        if not content:
-            bot.send_message(
-                chat_id,
-                "Пост пустой. Отправьте, пожалуйста, текст поста в формате markdown одним сообщением.",
-                reply_markup=make_blog_keyboard(),
-            )
-            return
+# Обработчики текстовых сообщений в режимах диалога: состояние чата -> функция.
+# Вместо цепочки if state == ... — один поиск в dict, как и для inline‑кнопок.
+_STATE_HANDLERS: Dict[str, Callable[[int, ChatCtx, types.Message], None]] = {}
 
-        try:
-            filename = create_blog_post_file(content)
-        except Exception as e:
-            bot.send_message(
-                chat_id,
-                f"Не удалось сохранить пост: {e}",
-                reply_markup=make_blog_keyboard(),
-            )
-            chat_state[chat_id] = None
-            return
 
-        # Сохраняем файл и переходим к шагу с превью
-        chat_post_files[chat_id] = filename
-        chat_state[chat_id] = "add_post_preview"
+def on_state(*states: str):
+    """
+    Регистрирует обработчик текста для одного или нескольких состояний диалога.
+    """
+    def decorator(func):
+        for state in states:
+            _STATE_HANDLERS[state] = func
+        return func
+    return decorator
+
+
+@on_state("add_post")
+def _state_add_post(chat_id: int, ctx: ChatCtx, message: types.Message) -> None:
+    # Пользователь прислал markdown‑текст для нового поста
+    content = (message.text or "").strip()
+    if not content:
         bot.send_message(
             chat_id,
-            f"✅ Пост сохранён как файл `{filename}` в `content/posts/`.\n\n"
-            "Хотите добавить превью‑изображение?\n"
-            "• Если да — просто отправьте фото одним сообщением.\n"
-            "• Если нет — отправьте текст `Без превью`.",
-            parse_mode="Markdown",
+            "Пост пустой. Отправьте, пожалуйста, текст поста в формате markdown одним сообщением.",
             reply_markup=make_blog_keyboard(),
         )
         return
 
-    if state == "add_post_preview":
-        text = (message.text or "").strip().lower()
-        if text in ("без превью", "нет превью", "нет"):
-            # Завершаем без превью
-            bot.send_message(
-                chat_id,
-                "Пост сохранён без превью‑изображения.",
-                reply_markup=make_blog_keyboard(),
-            )
-            chat_state[chat_id] = None
-            chat_post_files.pop(chat_id, None)
-            return
-        # Любой другой текст в этом режиме игнорируем и напоминаем про фото/«Без превью»
+    try:
+        filename = create_blog_post_file(content)
+    except Exception as e:
         bot.send_message(
             chat_id,
-            "Чтобы добавить превью, отправьте фото.\n"
-            "Если не нужно превью — отправьте текст `Без превью`.",
+            f"Не удалось сохранить пост: {e}",
             reply_markup=make_blog_keyboard(),
         )
+        clear_state(chat_id)
         return
 
-    if state == "edit_post":
-        # Пользователь прислал отредактированный markdown‑текст существующего поста
-        content = (message.text or "").strip()
-        if not content:
-            bot.send_message(
-                chat_id,
-                "Пост пустой. Отправьте, пожалуйста, полный текст поста в формате markdown.",
-                reply_markup=make_blog_keyboard(),
-            )
-            return
+    # Сохраняем файл и переходим к шагу с превью
+    ctx.post_file = filename
+    ctx.state = "add_post_preview"
+    bot.send_message(
+        chat_id,
+        f"✅ Пост сохранён как файл `{filename}` в `content/posts/`.\n\n"
+        "Хотите добавить превью‑изображение?\n"
+        "• Если да — просто отправьте фото одним сообщением.\n"
+        "• Если нет — отправьте текст `Без превью`.",
+        parse_mode="Markdown",
+        reply_markup=make_blog_keyboard(),
+    )
 
-        filename = chat_edit_post_files.get(chat_id)
-        if not filename:
-            bot.send_message(
-                chat_id,
-                "Не удалось определить, какой пост редактируется. Начните заново через «Редактировать пост».",
-                reply_markup=make_blog_keyboard(),
-            )
-            chat_state[chat_id] = None
-            return
 
-        path = POSTS_DIR / filename
-        try:
-            path.write_text(content, encoding="utf-8")
-        except Exception as e:
-            bot.send_message(
-                chat_id,
-                f"Не удалось сохранить изменения поста: {e}",
-                reply_markup=make_blog_keyboard(),
-            )
-            chat_state[chat_id] = None
-            chat_edit_post_files.pop(chat_id, None)
-            return
+@on_state("add_post_preview")
+def _state_add_post_preview(chat_id: int, ctx: ChatCtx, message: types.Message) -> None:
+    text = (message.text or "").strip().lower()
+    if text in ("без превью", "нет превью", "нет"):
+        # Завершаем без превью
+        bot.send_message(
+            chat_id,
+            "Пост сохранён без превью‑изображения.",
+            reply_markup=make_blog_keyboard(),
+        )
+        ctx.post_file = None
+        clear_state(chat_id)
+        return
+    # Любой другой текст в этом режиме игнорируем и напоминаем про фото/«Без превью»
+    bot.send_message(
+        chat_id,
+        "Чтобы добавить превью, отправьте фото.\n"
+        "Если не нужно превью — отправьте текст `Без превью`.",
+        reply_markup=make_blog_keyboard(),
+    )
+
 
+@on_state("edit_post")
+def _state_edit_post(chat_id: int, ctx: ChatCtx, message: types.Message) -> None:
+    # Пользователь прислал отредактированный markdown‑текст существующего поста
+    content = (message.text or "").strip()
+    if not content:
         bot.send_message(
             chat_id,
-            f"✅ Пост `{filename}` обновлён.\n\n"
-            "Изменения появятся в блоге после следующей перезагрузки сайта/сборки.",
-            parse_mode="Markdown",
+            "Пост пустой. Отправьте, пожалуйста, полный текст поста в формате markdown.",
             reply_markup=make_blog_keyboard(),
         )
-        chat_state[chat_id] = None
-        chat_edit_post_files.pop(chat_id, None)
         return
 
-    if state == "rename_file":
-        new_name = (message.text or "").strip()
-        if not new_name:
-            bot.send_message(
-                chat_id,
-                "Имя файла не может быть пустым. Попробуйте ещё раз или воспользуйтесь «Управление файлами» заново.",
-                reply_markup=make_blog_keyboard(),
-            )
-            return
-        if any(ch in new_name for ch in ["/", "\\"]):
-            bot.send_message(
-                chat_id,
-                "В имени файла не должны быть символы `/` или `\\`. Укажите только имя с расширением, например `photo-1.jpg`.",
-                reply_markup=make_blog_keyboard(),
-            )
-            return
+    filename = ctx.edit_post_file
+    if not filename:
+        bot.send_message(
+            chat_id,
+            "Не удалось определить, какой пост редактируется. Начните заново через «Редактировать пост».",
+            reply_markup=make_blog_keyboard(),
+        )
+        clear_state(chat_id)
+        return
 
-        target_info = chat_rename_targets.get(chat_id)
-        if not target_info:
-            bot.send_message(
-                chat_id,
-                "Не удалось определить, какой файл переименовать. Начните снова через «Управление файлами».",
-                reply_markup=make_blog_keyboard(),
-            )
-            chat_state[chat_id] = None
-            return
+    path = POSTS_DIR / filename
+    try:
+        _write_bytes_atomic(path, content.encode("utf-8"), durable=True)
+    except Exception as e:
+        bot.send_message(
+            chat_id,
+            f"Не удалось сохранить изменения поста: {e}",
+            reply_markup=make_blog_keyboard(),
+        )
+        ctx.edit_post_file = None
+        clear_state(chat_id)
+        return
 
-        dir_name, old_name = target_info
-        old_path = PUBLIC_DIR / dir_name / old_name
+    bot.send_message(
+        chat_id,
+        f"✅ Пост `{filename}` обновлён.\n\n"
+        "Изменения появятся в блоге после следующей перезагрузки сайта/сборки.",
+        parse_mode="Markdown",
+        reply_markup=make_blog_keyboard(),
+    )
+    ctx.edit_post_file = None
+    clear_state(chat_id)
 
-        # Если пользователь не указал расширение, сохраняем старое
-        from pathlib import Path as _Path
-        old_suffix = _Path(old_name).suffix
-        new_suffix = _Path(new_name).suffix
-        if not new_suffix and old_suffix:
-            new_name = new_name + old_suffix
 
-        new_path = PUBLIC_DIR / dir_name / new_name
+@on_state("rename_file")
+def _state_rename_file(chat_id: int, ctx: ChatCtx, message: types.Message) -> None:
+    new_name = (message.text or "").strip()
+    if not new_name:
+        bot.send_message(
+            chat_id,
+            "Имя файла не может быть пустым. Попробуйте ещё раз или воспользуйтесь «Управление файлами» заново.",
+            reply_markup=make_blog_keyboard(),
+        )
+        return
+    if "/" in new_name or "\\" in new_name:
+        bot.send_message(
+            chat_id,
+            "В имени файла не должны быть символы `/` или `\\`. Укажите только имя с расширением, например `photo-1.jpg`.",
+            reply_markup=make_blog_keyboard(),
+        )
+        return
+
+    target_info = ctx.rename_target
+    if not target_info:
+        bot.send_message(
+            chat_id,
+            "Не удалось определить, какой файл переименовать. Начните снова через «Управление файлами».",
+            reply_markup=make_blog_keyboard(),
+        )
+        clear_state(chat_id)
+        return
 
-        if not old_path.exists():
-            bot.send_message(
-                chat_id,
-                "Исходный файл уже не существует.",
-                reply_markup=make_blog_keyboard(),
-            )
-            chat_state[chat_id] = None
-            chat_rename_targets.pop(chat_id, None)
-            return
+    dir_name, old_name = target_info
+    old_path = PUBLIC_DIR / dir_name / old_name
 
-        if new_path.exists():
-            bot.send_message(
-                chat_id,
-                "Файл с таким именем уже существует в этой папке. Выберите другое имя.",
-                reply_markup=make_blog_keyboard(),
-            )
-            return
+    # Если пользователь не указал расширение, сохраняем старое
+    old_suffix = Path(old_name).suffix
+    if old_suffix and not Path(new_name).suffix:
+        new_name = new_name + old_suffix
 
-        try:
-            old_path.rename(new_path)
-            bot.send_message(
-                chat_id,
-                f"✅ Файл переименован:\n`{old_name}` → `{new_name}`",
-                parse_mode="Markdown",
-                reply_markup=make_blog_keyboard(),
-            )
-        except Exception as e:
-            bot.send_message(
-                chat_id,
-                f"Не удалось переименовать файл: {e}",
-                reply_markup=make_blog_keyboard(),
-            )
+    new_path = PUBLIC_DIR / dir_name / new_name
 
-        chat_state[chat_id] = None
-        chat_rename_targets.pop(chat_id, None)
+    try:
+        rename_no_clobber(old_path, new_path)
+    except FileNotFoundError:
+        bot.send_message(
+            chat_id,
+            "Исходный файл уже не существует.",
+            reply_markup=make_blog_keyboard(),
+        )
+        ctx.rename_target = None
+        clear_state(chat_id)
         return
+    except FileExistsError:
+        bot.send_message(
+            chat_id,
+            "Файл с таким именем уже существует в этой папке. Выберите другое имя.",
+            reply_markup=make_blog_keyboard(),
+        )
+        return
+    except Exception as e:
+        bot.send_message(
+            chat_id,
+            f"Не удалось переименовать файл: {e}",
+            reply_markup=make_blog_keyboard(),
+        )
+    else:
+        bot.send_message(
+            chat_id,
+            f"✅ Файл переименован:\n`{old_name}` → `{new_name}`",
+            parse_mode="Markdown",
+            reply_markup=make_blog_keyboard(),
+        )
 
-    # ── Редактирование пакетов и видео ──
+    ctx.rename_target = None
+    clear_state(chat_id)
 
-    if state == "edit_pkg_name":
-        new_name = (message.text or "").strip()
-        if not new_name:
-            bot.send_message(chat_id, "Название не может быть пустым. Введите новое название:", reply_markup=make_yoga_keyboard())
-            return
 
-        pkg_id = chat_pkg_target.get(chat_id)
-        packages = read_packages()
-        pkg = next((p for p in packages if p["id"] == pkg_id), None)
-        if not pkg:
-            bot.send_message(chat_id, "Пакет не найден.", reply_markup=make_yoga_keyboard())
-            chat_state[chat_id] = None
-            return
+# ── Редактирование пакетов и видео ──
+
+
+@on_state("edit_pkg_name")
+def _state_edit_pkg_name(chat_id: int, ctx: ChatCtx, message: types.Message) -> None:
+    new_name = (message.text or "").strip()
+    if not new_name:
+        bot.send_message(chat_id, _MSG_EMPTY_TITLE, reply_markup=make_yoga_keyboard())
+        return
 
-        old_name = pkg.get("name", pkg_id)
+    pkg_id = ctx.pkg_target
+    packages = read_packages_for_update()
+    pkg = get_package(pkg_id, packages)
+    if not pkg:
+        bot.send_message(chat_id, _MSG_PKG_NOT_FOUND, reply_markup=make_yoga_keyboard())
+        clear_state(chat_id)
+        return
+
+    old_name = pkg.get("name", pkg_id)
+    if pkg.get("name") != new_name:
         pkg["name"] = new_name
         write_packages(packages)
 
-        bot.send_message(
-            chat_id,
-            f"✅ Название изменено: «{old_name}» → «{new_name}»",
-            reply_markup=make_yoga_keyboard(),
-        )
-        chat_state[chat_id] = None
-        _send_edit_pkg_menu(chat_id, pkg_id)
-        return
+    clear_state(chat_id)
+    _send_edit_pkg_menu(chat_id, pkg_id, notice=f"✅ Название изменено: «{old_name}» → «{new_name}»")
 
-    if state == "edit_pkg_desc":
-        new_desc = (message.text or "").strip()
-        if not new_desc:
-            bot.send_message(chat_id, "Описание не может быть пустым. Введите новое описание:", reply_markup=make_yoga_keyboard())
-            return
 
-        pkg_id = chat_pkg_target.get(chat_id)
-        packages = read_packages()
-        pkg = next((p for p in packages if p["id"] == pkg_id), None)
-        if not pkg:
-            bot.send_message(chat_id, "Пакет не найден.", reply_markup=make_yoga_keyboard())
-            chat_state[chat_id] = None
-            return
+@on_state("edit_pkg_desc")
+def _state_edit_pkg_desc(chat_id: int, ctx: ChatCtx, message: types.Message) -> None:
+    new_desc = (message.text or "").strip()
+    if not new_desc:
+        bot.send_message(chat_id, "Описание не может быть пустым. Введите новое описание:", reply_markup=make_yoga_keyboard())
+        return
+
+    pkg_id = ctx.pkg_target
+    packages = read_packages_for_update()
+    pkg = get_package(pkg_id, packages)
+    if not pkg:
+        bot.send_message(chat_id, _MSG_PKG_NOT_FOUND, reply_markup=make_yoga_keyboard())
+        clear_state(chat_id)
+        return
 
+    if pkg.get("description") != new_desc:
         pkg["description"] = new_desc
         write_packages(packages)
 
-        bot.send_message(chat_id, "✅ Описание обновлено.", reply_markup=make_yoga_keyboard())
-        chat_state[chat_id] = None
-        _send_edit_pkg_menu(chat_id, pkg_id)
-        return
+    clear_state(chat_id)
+    _send_edit_pkg_menu(chat_id, pkg_id, notice="✅ Описание обновлено.")
 
-    if state == "edit_pkg_price":
-        price_text = (message.text or "").strip()
-        try:
-            price = int(price_text)
-            if price < 0:
-                raise ValueError()
-        except ValueError:
-            bot.send_message(chat_id, "Введите корректную цену (целое число >= 0):", reply_markup=make_yoga_keyboard())
-            return
 
-        pkg_id = chat_pkg_target.get(chat_id)
-        packages = read_packages()
-        pkg = next((p for p in packages if p["id"] == pkg_id), None)
-        if not pkg:
-            bot.send_message(chat_id, "Пакет не найден.", reply_markup=make_yoga_keyboard())
-            chat_state[chat_id] = None
-            return
+@on_state("edit_pkg_price")
+def _state_edit_pkg_price(chat_id: int, ctx: ChatCtx, message: types.Message) -> None:
+    price_text = (message.text or "").strip()
+    try:
+        price = int(price_text)
+        if price < 0:
+            raise ValueError()
+    except ValueError:
+        bot.send_message(chat_id, _MSG_BAD_PRICE, reply_markup=make_yoga_keyboard())
+        return
 
-        old_price = pkg.get("price", 0)
+    pkg_id = ctx.pkg_target
+    packages = read_packages_for_update()
+    pkg = get_package(pkg_id, packages)
+    if not pkg:
+        bot.send_message(chat_id, _MSG_PKG_NOT_FOUND, reply_markup=make_yoga_keyboard())
+        clear_state(chat_id)
+        return
+
+    old_price = pkg.get("price", 0)
+    if pkg.get("price") != price:
         pkg["price"] = price
         write_packages(packages)
 
-        price_str = f"{price} ₽" if price > 0 else "Бесплатно"
-        bot.send_message(chat_id, f"✅ Цена изменена: {old_price} ₽ → {price_str}", reply_markup=make_yoga_keyboard())
-        chat_state[chat_id] = None
-        _send_edit_pkg_menu(chat_id, pkg_id)
+    price_str = f"{price} ₽" if price > 0 else "Бесплатно"
+    clear_state(chat_id)
+    _send_edit_pkg_menu(chat_id, pkg_id, notice=f"✅ Цена изменена: {old_price} ₽ → {price_str}")
+
+
+@on_state("edit_pkg_position")
+def _state_edit_pkg_position(chat_id: int, ctx: ChatCtx, message: types.Message) -> None:
+    pos_text = (message.text or "").strip()
+    pkg_id = ctx.pkg_target
+
+    packages = read_packages_for_update()
+    total = len(packages)
+
+    try:
+        new_pos = int(pos_text)
+        if new_pos < 1 or new_pos > total:
+            raise ValueError()
+    except ValueError:
+        bot.send_message(chat_id, f"Введите число от 1 до {total}:", reply_markup=make_yoga_keyboard())
         return
 
-    if state == "edit_pkg_position":
-        pos_text = (message.text or "").strip()
-        pkg_id = chat_pkg_target.get(chat_id)
+    # Находим текущий индекс
+    old_idx = next((i for i, p in enumerate(packages) if p["id"] == pkg_id), None)
+    if old_idx is None:
+        bot.send_message(chat_id, _MSG_PKG_NOT_FOUND, reply_markup=make_yoga_keyboard())
+        clear_state(chat_id)
+        return
 
-        packages = read_packages()
-        total = len(packages)
+    new_idx = new_pos - 1
+    if old_idx == new_idx:
+        clear_state(chat_id)
+        _send_edit_pkg_menu(chat_id, pkg_id, notice="Пакет уже на этой позиции.")
+        return
 
-        try:
-            new_pos = int(pos_text)
-            if new_pos < 1 or new_pos > total:
-                raise ValueError()
-        except ValueError:
-            bot.send_message(chat_id, f"Введите число от 1 до {total}:", reply_markup=make_yoga_keyboard())
-            return
+    # Перемещаем
+    pkg = packages.pop(old_idx)
+    packages.insert(new_idx, pkg)
+    write_packages(packages)
 
-        # Находим текущий индекс
-        old_idx = next((i for i, p in enumerate(packages) if p["id"] == pkg_id), None)
-        if old_idx is None:
-            bot.send_message(chat_id, "Пакет не найден.", reply_markup=make_yoga_keyboard())
-            chat_state[chat_id] = None
+    clear_state(chat_id)
+    _send_edit_pkg_menu(chat_id, pkg_id, notice=f"✅ Пакет «{pkg.get('name', pkg_id)}» перемещён на позицию {new_pos}.")
+
+
+@on_state("edit_pkg_preview")
+def _state_edit_pkg_preview(chat_id: int, ctx: ChatCtx, message: types.Message) -> None:
+    # Эмодзи как превью при редактировании
+    text = (message.text or "").strip()
+    if text and len(text) <= 10 and not text.startswith("/"):
+        pkg_id = ctx.pkg_target
+        if not pkg_id:
+            bot.send_message(chat_id, "Ошибка: пакет не определён.", reply_markup=make_yoga_keyboard())
+            clear_state(chat_id)
             return
 
-        new_idx = new_pos - 1
-        if old_idx == new_idx:
-            bot.send_message(chat_id, "Пакет уже на этой позиции.", reply_markup=make_yoga_keyboard())
-            chat_state[chat_id] = None
-            _send_edit_pkg_menu(chat_id, pkg_id)
+        packages = read_packages_for_update()
+        pkg = get_package(pkg_id, packages)
+        if not pkg:
+            bot.send_message(chat_id, _MSG_PKG_NOT_FOUND, reply_markup=make_yoga_keyboard())
+            clear_state(chat_id)
             return
 
-        # Перемещаем
-        pkg = packages.pop(old_idx)
-        packages.insert(new_idx, pkg)
+        # Удаляем старое фото-превью (если было файлом)
+        old_image = pkg.get("image", "")
+        if old_image and old_image.startswith("/notgallery/"):
+            old_path = PUBLIC_DIR / old_image.lstrip("/")
+            try:
+                old_path.unlink()
+            except Exception:
+                pass
+
+        pkg["image"] = text
         write_packages(packages)
 
+        clear_state(chat_id)
+        _send_edit_pkg_menu(chat_id, pkg_id, notice=f"✅ Превью обновлено: {text}")
+        return
+
+    bot.send_message(
+        chat_id,
+        "Отправьте фото или эмодзи для превью.",
+        reply_markup=make_yoga_keyboard(),
+    )
+
+
+@on_state("edit_vid_title")
+def _state_edit_vid_title(chat_id: int, ctx: ChatCtx, message: types.Message) -> None:
+    new_title = (message.text or "").strip()
+    if not new_title:
+        bot.send_message(chat_id, _MSG_EMPTY_TITLE, reply_markup=make_yoga_keyboard())
+        return
+
+    pkg_id = ctx.pkg_target
+    idx = ctx.edit_vid_idx
+    if pkg_id is None or idx is None:
+        bot.send_message(chat_id, "Ошибка: потеряны данные. Начните заново.", reply_markup=make_yoga_keyboard())
+        clear_state(chat_id)
+        return
+
+    packages = read_packages_for_update()
+    pkg = get_package(pkg_id, packages)
+    if not pkg or idx >= len(pkg.get("videos", [])):
+        bot.send_message(chat_id, "Пакет или видео не найдены.", reply_markup=make_yoga_keyboard())
+        clear_state(chat_id)
+        return
+
+    old_title = pkg["videos"][idx].get("title", "Без названия")
+    pkg["videos"][idx]["title"] = new_title
+    write_packages(packages)
+
+    bot.send_message(
+        chat_id,
+        f"✅ Видео переименовано: «{old_title}» → «{new_title}»",
+        reply_markup=make_yoga_keyboard(),
+    )
+    ctx.edit_vid_idx = None
+    clear_state(chat_id)
+    _send_edit_video_list(chat_id, pkg_id)
+
+
+# ── Создание пакетов и добавление видео ──
+
+
+@on_state("add_pkg_name")
+def _state_add_pkg_name(chat_id: int, ctx: ChatCtx, message: types.Message) -> None:
+    name = (message.text or "").strip()
+    if not name:
         bot.send_message(
             chat_id,
-            f"✅ Пакет «{pkg.get('name', pkg_id)}» перемещён на позицию {new_pos}.",
+            "Название не может быть пустым. Введите название пакета:",
             reply_markup=make_yoga_keyboard(),
         )
-        chat_state[chat_id] = None
-        _send_edit_pkg_menu(chat_id, pkg_id)
         return
 
-    if state == "edit_pkg_preview":
-        # Эмодзи как превью при редактировании
-        text = (message.text or "").strip()
-        if text and len(text) <= 10 and not text.startswith("/"):
-            pkg_id = chat_pkg_target.get(chat_id)
-            if not pkg_id:
-                bot.send_message(chat_id, "Ошибка: пакет не определён.", reply_markup=make_yoga_keyboard())
-                chat_state[chat_id] = None
-                return
-
-            packages = read_packages()
-            pkg = next((p for p in packages if p["id"] == pkg_id), None)
-            if not pkg:
-                bot.send_message(chat_id, "Пакет не найден.", reply_markup=make_yoga_keyboard())
-                chat_state[chat_id] = None
-                return
+    draft = ctx.pkg_draft
+    draft["name"] = name
+    # Генерируем ID из названия (транслит)
+    slug = _PKG_NAME_JUNK_RE.sub("", name.lower())
+    slug = _WHITESPACE_RUN_RE.sub("-", slug.strip())
+    # Простая транслитерация
+    transliterated = slug.translate(_RU_TRANSLIT)
+    transliterated = _DASH_RUN_RE.sub("-", transliterated).strip("-")
+    if not transliterated:
+        transliterated = f"pkg-{file_stamp()}"
+    draft["id"] = transliterated
 
-            # Удаляем старое фото-превью (если было файлом)
-            old_image = pkg.get("image", "")
-            if old_image and old_image.startswith("/notgallery/"):
-                old_path = PUBLIC_DIR / old_image.lstrip("/")
-                if old_path.exists():
-                    try:
-                        old_path.unlink()
-                    except Exception:
-                        pass
+    ctx.state = "add_pkg_level"
 
-            pkg["image"] = text
-            write_packages(packages)
+    bot.send_message(
+        chat_id,
+        f"Название: *{name}* (ID: `{transliterated}`).\n\n"
+        "Шаг 2/4: Выберите *уровень* пакета:",
+        parse_mode="Markdown",
+        reply_markup=make_pkg_level_keyboard(),
+    )
 
-            bot.send_message(
-                chat_id,
-                f"✅ Превью обновлено: {text}",
-                reply_markup=make_yoga_keyboard(),
-            )
-            chat_state[chat_id] = None
-            _send_edit_pkg_menu(chat_id, pkg_id)
-            return
 
+@on_state("add_pkg_desc")
+def _state_add_pkg_desc(chat_id: int, ctx: ChatCtx, message: types.Message) -> None:
+    desc = (message.text or "").strip()
+    if not desc:
         bot.send_message(
             chat_id,
-            "Отправьте фото или эмодзи для превью.",
+            "Описание не может быть пустым. Введите описание пакета:",
             reply_markup=make_yoga_keyboard(),
         )
         return
 
-    if state == "edit_vid_title":
-        new_title = (message.text or "").strip()
-        if not new_title:
-            bot.send_message(chat_id, "Название не может быть пустым. Введите новое название:", reply_markup=make_yoga_keyboard())
-            return
+    draft = ctx.pkg_draft
+    draft["description"] = desc
+    ctx.state = "add_pkg_price"
 
-        pkg_id = chat_pkg_target.get(chat_id)
-        idx = chat_edit_vid_idx.get(chat_id)
-        if pkg_id is None or idx is None:
-            bot.send_message(chat_id, "Ошибка: потеряны данные. Начните заново.", reply_markup=make_yoga_keyboard())
-            chat_state[chat_id] = None
-            return
-
-        packages = read_packages()
-        pkg = next((p for p in packages if p["id"] == pkg_id), None)
-        if not pkg or idx >= len(pkg.get("videos", [])):
-            bot.send_message(chat_id, "Пакет или видео не найдены.", reply_markup=make_yoga_keyboard())
-            chat_state[chat_id] = None
-            return
+    bot.send_message(
+        chat_id,
+        "Шаг 4/4: Введите *цену* пакета в рублях.\n"
+        "Для бесплатного пакета введите `0`:",
+        parse_mode="Markdown",
+        reply_markup=make_yoga_keyboard(),
+    )
 
-        old_title = pkg["videos"][idx].get("title", "Без названия")
-        pkg["videos"][idx]["title"] = new_title
-        write_packages(packages)
 
+@on_state("add_pkg_price")
+def _state_add_pkg_price(chat_id: int, ctx: ChatCtx, message: types.Message) -> None:
+    price_text = (message.text or "").strip()
+    try:
+        price = int(price_text)
+        if price < 0:
+            raise ValueError()
+    except ValueError:
         bot.send_message(
             chat_id,
-            f"✅ Видео переименовано: «{old_title}» → «{new_title}»",
+            _MSG_BAD_PRICE,
             reply_markup=make_yoga_keyboard(),
         )
-        chat_state[chat_id] = None
-        chat_edit_vid_idx.pop(chat_id, None)
-        _send_edit_video_list(chat_id, pkg_id)
         return
 
-    # ── Создание пакетов и добавление видео ──
+    draft = ctx.pkg_draft
+    draft["price"] = price
+    ctx.state = "add_pkg_preview"
 
-    if state == "add_pkg_name":
-        name = (message.text or "").strip()
-        if not name:
-            bot.send_message(
-                chat_id,
-                "Название не может быть пустым. Введите название пакета:",
-                reply_markup=make_yoga_keyboard(),
-            )
-            return
+    bot.send_message(
+        chat_id,
+        (f"Цена: *{price} ₽*.\n\n" if price > 0 else "Цена: *Бесплатно*.\n\n")
+        + "Шаг 5/5: Задайте *превью* для пакета.\n\n"
+        "• Отправьте *фото* — обложка пакета\n"
+        "• Отправьте *эмодзи* (например 🧘 или 🔥) — будет вместо картинки\n"
+        "• Или напишите `Без превью`",
+        parse_mode="Markdown",
+        reply_markup=make_yoga_keyboard(),
+    )
 
-        draft = chat_pkg_draft.get(chat_id, {})
-        draft["name"] = name
-        # Генерируем ID из названия (транслит)
-        slug = re.sub(r"[^a-zA-Zа-яА-ЯёЁ0-9\s-]", "", name.lower())
-        slug = re.sub(r"\s+", "-", slug.strip())
-        # Простая транслитерация
-        tr = {
-            "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ё": "yo",
-            "ж": "zh", "з": "z", "и": "i", "й": "y", "к": "k", "л": "l", "м": "m",
-            "н": "n", "о": "o", "п": "p", "р": "r", "с": "s", "т": "t", "у": "u",
-            "ф": "f", "х": "kh", "ц": "ts", "ч": "ch", "ш": "sh", "щ": "shch",
-            "ъ": "", "ы": "y", "ь": "", "э": "e", "ю": "yu", "я": "ya",
-        }
-        transliterated = "".join(tr.get(c, c) for c in slug)
-        transliterated = re.sub(r"-+", "-", transliterated).strip("-")
-        if not transliterated:
-            transliterated = f"pkg-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
-        draft["id"] = transliterated
-        chat_pkg_draft[chat_id] = draft
-
-        chat_state[chat_id] = "add_pkg_level"
 
-        kb = types.InlineKeyboardMarkup()
-        for level in ["Начинающий", "Средний", "Продвинутый", "Все уровни"]:
-            kb.add(
-                types.InlineKeyboardButton(
-                    text=level,
-                    callback_data=f"pkg_level:{level}",
-                )
-            )
+@on_state("add_pkg_preview")
+def _state_add_pkg_preview(chat_id: int, ctx: ChatCtx, message: types.Message) -> None:
+    text = (message.text or "").strip()
+    if text.lower() in ("без превью", "нет превью", "нет"):
+        _finalize_new_package(chat_id, image_path="")
+        return
+    # Короткий текст (до 10 символов, не начинается с /) — считаем эмодзи
+    if text and len(text) <= 10 and not text.startswith("/"):
+        _finalize_new_package(chat_id, image_path=text)
+        return
+    bot.send_message(
+        chat_id,
+        "Отправьте фото, эмодзи или напишите `Без превью`.",
+        reply_markup=make_yoga_keyboard(),
+    )
+
 
+@on_state("add_video_title")
+def _state_add_video_title(chat_id: int, ctx: ChatCtx, message: types.Message) -> None:
+    title = (message.text or "").strip()
+    if not title:
         bot.send_message(
             chat_id,
-            f"Название: *{name}* (ID: `{transliterated}`).\n\n"
-            "Шаг 2/4: Выберите *уровень* пакета:",
-            parse_mode="Markdown",
-            reply_markup=kb,
+            "Название видео не может быть пустым. Введите название:",
+            reply_markup=make_yoga_keyboard(),
         )
         return
 
-    if state == "add_pkg_desc":
-        desc = (message.text or "").strip()
-        if not desc:
-            bot.send_message(
-                chat_id,
-                "Описание не может быть пустым. Введите описание пакета:",
-                reply_markup=make_yoga_keyboard(),
-            )
-            return
+    draft = ctx.video_draft
+    draft["title"] = title
+    ctx.state = "add_video_duration"
+
+    bot.send_message(
+        chat_id,
+        f"Название: *{title}*.\n\n"
+        "Шаг 2/3: Введите *длительность* видео (например, `30 мин`):",
+        parse_mode="Markdown",
+        reply_markup=make_yoga_keyboard(),
+    )
 
-        draft = chat_pkg_draft.get(chat_id, {})
-        draft["description"] = desc
-        chat_pkg_draft[chat_id] = draft
-        chat_state[chat_id] = "add_pkg_price"
 
+@on_state("add_video_duration")
+def _state_add_video_duration(chat_id: int, ctx: ChatCtx, message: types.Message) -> None:
+    duration = (message.text or "").strip()
+    if not duration:
         bot.send_message(
             chat_id,
-            "Шаг 4/4: Введите *цену* пакета в рублях.\n"
-            "Для бесплатного пакета введите `0`:",
-            parse_mode="Markdown",
+            "Длительность не может быть пустой. Введите длительность (напр. `25 мин`):",
             reply_markup=make_yoga_keyboard(),
         )
         return
 
-    if state == "add_pkg_price":
-        price_text = (message.text or "").strip()
-        try:
-            price = int(price_text)
-            if price < 0:
-                raise ValueError()
-        except ValueError:
-            bot.send_message(
-                chat_id,
-                "Введите корректную цену (целое число >= 0):",
-                reply_markup=make_yoga_keyboard(),
-            )
-            return
+    draft = ctx.video_draft
+    draft["duration"] = duration
 
-        draft = chat_pkg_draft.get(chat_id, {})
-        draft["price"] = price
-        chat_pkg_draft[chat_id] = draft
-        chat_state[chat_id] = "add_pkg_preview"
+    # Показываем текущий список видео и спрашиваем позицию
+    pkg_id = ctx.pkg_target
+    packages = read_packages()
+    pkg = get_package(pkg_id, packages)
+    videos = pkg.get("videos", []) if pkg else []
 
+    if not videos:
+        # Пакет пуст — видео будет первым, пропускаем вопрос о позиции
+        draft["position"] = 1
+        ctx.state = "add_video_file"
         bot.send_message(
             chat_id,
-            f"Цена: *{price} ₽*.\n\n" if price > 0 else "Цена: *Бесплатно*.\n\n",
+            f"Длительность: *{duration}*.\n"
+            "Пакет пока пуст — видео будет первым.\n\n"
+            + _MSG_ASK_VIDEO_FILE,
             parse_mode="Markdown",
+            reply_markup=make_yoga_keyboard(),
         )
+    else:
+        ctx.state = "add_video_position"
+        lines = [f"Длительность: *{duration}*.\n"]
+        lines.append("Текущие видео в пакете:")
+        for i, v in enumerate(videos, 1):
+            lines.append(f"  {i}. {v.get('title', 'Без названия')}")
+        lines.append(f"\nШаг 3/4: Введите *номер позиции* для нового видео (1–{len(videos)+1}).")
+        lines.append(f"Например, `{len(videos)+1}` — в конец, `1` — в начало.")
         bot.send_message(
             chat_id,
-            "Шаг 5/5: Задайте *превью* для пакета.\n\n"
-            "• Отправьте *фото* — обложка пакета\n"
-            "• Отправьте *эмодзи* (например 🧘 или 🔥) — будет вместо картинки\n"
-            "• Или напишите `Без превью`",
+            "\n".join(lines),
             parse_mode="Markdown",
             reply_markup=make_yoga_keyboard(),
         )
-        return
 
-    if state == "add_pkg_preview":
-        text = (message.text or "").strip()
-        if text.lower() in ("без превью", "нет превью", "нет"):
-            _finalize_new_package(chat_id, image_path="")
-            return
-        # Короткий текст (до 10 символов, не начинается с /) — считаем эмодзи
-        if text and len(text) <= 10 and not text.startswith("/"):
-            _finalize_new_package(chat_id, image_path=text)
-            return
+
+@on_state("add_video_position")
+def _state_add_video_position(chat_id: int, ctx: ChatCtx, message: types.Message) -> None:
+    pos_text = (message.text or "").strip()
+    pkg_id = ctx.pkg_target
+    packages = read_packages()
+    pkg = get_package(pkg_id, packages)
+    total = len(pkg.get("videos", [])) if pkg else 0
+
+    try:
+        pos = int(pos_text)
+        if pos < 1 or pos > total + 1:
+            raise ValueError()
+    except ValueError:
         bot.send_message(
             chat_id,
-            "Отправьте фото, эмодзи или напишите `Без превью`.",
+            f"Введите число от 1 до {total + 1}:",
             reply_markup=make_yoga_keyboard(),
         )
         return
 
-    if state == "add_video_title":
-        title = (message.text or "").strip()
-        if not title:
-            bot.send_message(
-                chat_id,
-                "Название видео не может быть пустым. Введите название:",
-                reply_markup=make_yoga_keyboard(),
-            )
-            return
+    draft = ctx.video_draft
+    draft["position"] = pos
+    ctx.state = "add_video_file"
+
+    bot.send_message(
+        chat_id,
+        f"Позиция: *{pos}*.\n\n" + _MSG_ASK_VIDEO_FILE,
+        parse_mode="Markdown",
+        reply_markup=make_yoga_keyboard(),
+    )
 
-        draft = chat_video_draft.get(chat_id, {})
-        draft["title"] = title
-        chat_video_draft[chat_id] = draft
-        chat_state[chat_id] = "add_video_duration"
 
+@on_state("add_video_file")
+def _state_add_video_file(chat_id: int, ctx: ChatCtx, message: types.Message) -> None:
+    # Текстовое сообщение: либо URL, либо «Пропустить»
+    text = (message.text or "").strip()
+    if not text:
         bot.send_message(
             chat_id,
-            f"Название: *{title}*.\n\n"
-            "Шаг 2/3: Введите *длительность* видео (например, `30 мин`):",
-            parse_mode="Markdown",
+            "Отправьте видеофайл или ссылку на видео.",
             reply_markup=make_yoga_keyboard(),
         )
         return
 
-    if state == "add_video_duration":
-        duration = (message.text or "").strip()
-        if not duration:
-            bot.send_message(
-                chat_id,
-                "Длительность не может быть пустой. Введите длительность (напр. `25 мин`):",
-                reply_markup=make_yoga_keyboard(),
-            )
-            return
-
-        draft = chat_video_draft.get(chat_id, {})
-        draft["duration"] = duration
-        chat_video_draft[chat_id] = draft
-
-        # Показываем текущий список видео и спрашиваем позицию
-        pkg_id = chat_pkg_target.get(chat_id)
-        packages = read_packages()
-        pkg = next((p for p in packages if p["id"] == pkg_id), None) if pkg_id else None
-        videos = pkg.get("videos", []) if pkg else []
-
-        if not videos:
-            # Пакет пуст — видео будет первым, пропускаем вопрос о позиции
-            draft["position"] = 1
-            chat_video_draft[chat_id] = draft
-            chat_state[chat_id] = "add_video_file"
-            bot.send_message(
-                chat_id,
-                f"Длительность: *{duration}*.\n"
-                "Пакет пока пуст — видео будет первым.\n\n"
-                "Шаг 4/4: Отправьте *видеофайл*.\n\n"
-                "• Отправьте видео или документ — файл сохранится в `public/videos/`\n"
-                "• Или отправьте текстом ссылку на видео (URL)",
-                parse_mode="Markdown",
-                reply_markup=make_yoga_keyboard(),
-            )
-        else:
-            chat_state[chat_id] = "add_video_position"
-            lines = [f"Длительность: *{duration}*.\n"]
-            lines.append("Текущие видео в пакете:")
-            for i, v in enumerate(videos, 1):
-                lines.append(f"  {i}. {v.get('title', 'Без названия')}")
-            lines.append(f"\nШаг 3/4: Введите *номер позиции* для нового видео (1–{len(videos)+1}).")
-            lines.append(f"Например, `{len(videos)+1}` — в конец, `1` — в начало.")
-            bot.send_message(
-                chat_id,
-                "\n".join(lines),
-                parse_mode="Markdown",
-                reply_markup=make_yoga_keyboard(),
-            )
-        return
-
-    if state == "add_video_position":
-        pos_text = (message.text or "").strip()
-        pkg_id = chat_pkg_target.get(chat_id)
-        packages = read_packages()
-        pkg = next((p for p in packages if p["id"] == pkg_id), None) if pkg_id else None
-        total = len(pkg.get("videos", [])) if pkg else 0
-
-        try:
-            pos = int(pos_text)
-            if pos < 1 or pos > total + 1:
-                raise ValueError()
-        except ValueError:
-            bot.send_message(
-                chat_id,
-                f"Введите число от 1 до {total + 1}:",
-                reply_markup=make_yoga_keyboard(),
-            )
-            return
-
-        draft = chat_video_draft.get(chat_id, {})
-        draft["position"] = pos
-        chat_video_draft[chat_id] = draft
-        chat_state[chat_id] = "add_video_file"
+    pkg_id = ctx.pkg_target
+    draft = ctx.video_draft
 
+    if text.startswith("http://") or text.startswith("https://") or text.startswith("/"):
+        draft["videoUrl"] = text
+    else:
         bot.send_message(
             chat_id,
-            f"Позиция: *{pos}*.\n\n"
-            "Шаг 4/4: Отправьте *видеофайл*.\n\n"
-            "• Отправьте видео или документ — файл сохранится в `public/videos/`\n"
-            "• Или отправьте текстом ссылку на видео (URL)",
-            parse_mode="Markdown",
+            "Отправьте видеофайл или ссылку на видео (начинается с http).",
             reply_markup=make_yoga_keyboard(),
         )
         return
 
-    if state == "add_video_file":
-        # Текстовое сообщение: либо URL, либо «Пропустить»
-        text = (message.text or "").strip()
-        if not text:
-            bot.send_message(
-                chat_id,
-                "Отправьте видеофайл или ссылку на видео.",
-                reply_markup=make_yoga_keyboard(),
-            )
-            return
+    # Сохраняем видео в пакет
+    _save_video_to_package(chat_id, pkg_id, draft)
 
-        pkg_id = chat_pkg_target.get(chat_id)
-        draft = chat_video_draft.get(chat_id, {})
 
-        if text.startswith("http://") or text.startswith("https://") or text.startswith("/"):
-            draft["videoUrl"] = text
-        else:
-            bot.send_message(
-                chat_id,
-                "Отправьте видеофайл или ссылку на видео (начинается с http).",
-                reply_markup=make_yoga_keyboard(),
-            )
-            return
+@on_state("add_slot")
+def _state_add_slot(chat_id: int, ctx: ChatCtx, message: types.Message) -> None:
+    handle_add_slot(chat_id, message.text)
 
-        # Сохраняем видео в пакет
-        _save_video_to_package(chat_id, pkg_id, draft)
-        return
 
-    if state == "add_slot":
-        handle_add_slot(chat_id, message.text)
-        return
-    if state == "del_slot":
-        handle_delete_slot(chat_id, message.text)
+@on_state("del_slot")
+def _state_del_slot(chat_id: int, ctx: ChatCtx, message: types.Message) -> None:
+    handle_delete_slot(chat_id, message.text)
+
+
+_MSG_UNKNOWN = (
+    "Я вас понял, но не знаю, что с этим сделать 🙂\n\n"
+    "Используйте команды /start, /slots или кнопки под клавиатурой."
+)
+
+
+@bot.message_handler(func=lambda m: True)
+def handle_text(message):
+    chat_id = message.chat.id
+    # Без get_ctx: случайное сообщение не должно заводить контекст в chat_ctx
+    ctx = chat_ctx.get(chat_id)
+    handler = _STATE_HANDLERS.get(ctx.state) if ctx is not None else None
+    if handler is not None:
+        handler(chat_id, ctx, message)
         return
 
     # Если никакого спец-режима нет — подскажем, что можно сделать
-    bot.send_message(
-        chat_id,
-        "Я вас понял, но не знаю, что с этим сделать 🙂\n\n"
-        "Используйте команды /start, /slots или кнопки под клавиатурой.",
-        reply_markup=make_main_keyboard(),
+    bot.send_message(chat_id, _MSG_UNKNOWN, reply_markup=make_main_keyboard())
+
+
+# ─── Webhook ───────────────────────────────────────────────────────
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+    """
+    Принимает апдейты, которые Telegram присылает POST‑запросом на WEBHOOK_URL.
+    """
+
+    def do_POST(self):
+        if self.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            self.send_response(403)
+            self.end_headers()
+            return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            # Разбираем тело сами (orjson, без decode в str); de_json принимает готовый dict
+            update = types.Update.de_json(_json_loads(self.rfile.read(length)))
+        except Exception:
+            self.send_response(400)
+            self.end_headers()
+            return
+        # Отвечаем сразу: обработчики всё равно выполняются в пуле потоков бота
+        self.send_response(200)
+        self.end_headers()
+        try:
+            bot.process_new_updates([update])
+        except Exception as e:
+            print(f"Ошибка обработки апдейта из webhook: {e}")
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run_webhook() -> None:
+    bot.set_webhook(
+        url=WEBHOOK_URL,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=["message", "callback_query"],
+    )
+    server = ThreadingHTTPServer((WEBHOOK_LISTEN, WEBHOOK_PORT), _WebhookHandler)
+    print(f"Webhook: {WEBHOOK_URL} -> {WEBHOOK_LISTEN}:{WEBHOOK_PORT}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def run_polling() -> None:
+    # Если раньше был включён webhook, getUpdates без его снятия не работает
+    bot.remove_webhook()
+    # Продолжаем с последнего обработанного апдейта; long polling держит запрос
+    # getUpdates открытым до 50 секунд, так что в простое бот почти не ходит в сеть
+    bot.last_update_id = _load_update_offset()
+    bot.infinity_polling(
+        timeout=20,
+        long_polling_timeout=50,
+        allowed_updates=["message", "callback_query"],
     )
 
 
-if __name__ == "__main__":
+def main() -> None:
+    """
+    Единственная точка запуска: один экземпляр бота и один источник апдейтов
+    (webhook или polling) на процесс.
+    """
     print("Бот запущен. Уведомления приходят с сайта, бот отвечает на /start.")
     print("Нажмите Ctrl+C для остановки.")
-    bot.infinity_polling()
+    if WEBHOOK_URL:
+        run_webhook()
+    else:
+        run_polling()
+
+
+if __name__ == "__main__":
+    main()